@@ -1,17 +1,49 @@
 import os
 import secrets
+import socket
+import sys
 import hashlib
+import io
+import atexit
+import base64
+import cProfile
+import gzip
+import hmac
+import json
+import logging
+import mmap
+import queue
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
+from typing import IO, Optional, cast
 
-from flask import Flask, request, redirect, url_for, render_template_string, session, send_file, jsonify, abort  # type: ignore
+from flask import Flask, Request, Response, request, redirect, url_for, render_template_string, session, send_file, jsonify, abort, g, stream_with_context  # type: ignore
+from markupsafe import Markup  # type: ignore
 from werkzeug.utils import secure_filename  # type: ignore
-from PIL import Image  # type: ignore
-from cryptography.fernet import Fernet  # type: ignore
-from pymongo import MongoClient  # type: ignore
-from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure  # type: ignore
+from PIL import Image, features  # type: ignore
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken  # type: ignore
+import pymongo  # type: ignore
+from pymongo import MongoClient, ReturnDocument, monitoring  # type: ignore
+from pymongo.collection import Collection  # type: ignore
+from pymongo.read_concern import ReadConcern  # type: ignore
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest  # type: ignore
+from pymongo.write_concern import WriteConcern  # type: ignore
+from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure, DuplicateKeyError, PyMongoError  # type: ignore
 from bson import ObjectId  # type: ignore
 import bcrypt  # type: ignore
 from dotenv import load_dotenv  # type: ignore
+from schema import INBOX_FIELDS, PAIRING_FIELDS, ensure_indexes, key_id
+from stego import (MAX_PAYLOAD_BYTES, embed_bytes_in_image, embed_mode_of, extract_bytes_from_image,
+                   image_has_alpha, payload_capacity)
 
 load_dotenv()
 
@@ -21,10 +53,142 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 MONGO_URI = os.environ.get("MONGO_URI") or "mongodb://localhost:27017/"
 FLASK_SECRET_KEY = os.environ.get("FLASK_SECRET_KEY") or secrets.token_urlsafe(16)
 FERNET_KEY_ENV = os.environ.get("FERNET_KEY")
+FERNET_KEYS_ENV = os.environ.get("FERNET_KEYS")
+FERNET_KEY_FILE = os.environ.get("FERNET_KEY_FILE", ".fernet_keys")
 
 VIEW_SECONDS = int(os.environ.get("VIEW_SECONDS", "10"))
+# 0 = run embed/extract inline in the request worker (fine for sync workers).
+# >0 runs CPU-bound stego work in a separate process pool so it doesn't block the
+# other requests of the worker; gunicorn.conf.py defaults it to 2 for gevent/gthread.
+STEGO_POOL_WORKERS = int(os.environ.get("STEGO_POOL_WORKERS", "0"))
+# Per-stage timings for /send, /view and /api/reveal: Server-Timing header + log line.
+# Set OTEL_EXPORTER_OTLP_ENDPOINT (e.g. http://localhost:4318) to also export spans.
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "true").lower() == "true"
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+# On-demand profiling. With PROFILE_SECRET set, a request carrying
+# "X-Profile: <token>" (mint one with `python app.py profile-token`) is profiled;
+# PROFILE_SAMPLE_RATE profiles that fraction of all requests. Profiles go to
+# PROFILE_DIR as cProfile .prof files, or as collapsed stacks sampled every
+# PROFILE_INTERVAL_MS with PROFILE_FORMAT=collapsed (flamegraph.pl, speedscope).
+# With neither set the profiling hooks are not even registered.
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_FORMAT = os.environ.get("PROFILE_FORMAT", "prof").lower()
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+# Peak memory of /send and /api/reveal, recorded in metrics and the trace log line.
+# "rss" samples the worker's resident set (Linux) while they run; "tracemalloc"
+# also counts Python allocations, at a noticeable CPU cost; "off" disables both.
+MEMORY_TRACKING = os.environ.get("MEMORY_TRACKING", "rss").lower()
+# Memory guard, checked from the image header before any decode (0 = off):
+# images whose estimated processing cost exceeds REQUEST_MEMORY_BUDGET_MB get 413,
+# and while the worker's RSS plus that estimate would pass WORKER_MEMORY_LIMIT_MB
+# (set it somewhat below the container limit) image work is refused with 503.
+REQUEST_MEMORY_BUDGET_MB = float(os.environ.get("REQUEST_MEMORY_BUDGET_MB", "0"))
+WORKER_MEMORY_LIMIT_MB = float(os.environ.get("WORKER_MEMORY_LIMIT_MB", "0"))
+# If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Upload admission for /send: request byte limit and cover megapixel ceiling,
+# both checked before any pixel data is decoded.
+MAX_UPLOAD_MB = float(os.environ.get("MAX_UPLOAD_MB", "25"))
+MAX_IMAGE_MEGAPIXELS = float(os.environ.get("MAX_IMAGE_MEGAPIXELS", "40"))
+# Uploads bigger than this are spooled to a temp file (in UPLOAD_SPOOL_DIR, default
+# system temp) and memory-mapped for Pillow instead of being held in worker memory.
+UPLOAD_SPOOL_KB = int(os.environ.get("UPLOAD_SPOOL_KB", "256"))
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+# Per-worker LRU of decoded RGBA covers keyed by upload SHA-256 (0 disables)
+COVER_CACHE_MB = float(os.environ.get("COVER_CACHE_MB", "128"))
+# Embed new secrets in the compact envelope (raw Fernet bytes, zlib for long text).
+# Turn off while older deployments that only read plain Fernet tokens still serve reveals.
+PAYLOAD_ENVELOPE = os.environ.get("PAYLOAD_ENVELOPE", "true").lower() == "true"
+# Background job that re-encrypts unviewed images still under an old key (after rotation)
+KEY_REEMBED = os.environ.get("KEY_REEMBED", "false").lower() == "true"
+REEMBED_BATCH = int(os.environ.get("REEMBED_BATCH", "20"))
+REEMBED_PAUSE_SECONDS = float(os.environ.get("REEMBED_PAUSE_SECONDS", "2"))
+REEMBED_INTERVAL_SECONDS = float(os.environ.get("REEMBED_INTERVAL_SECONDS", "600"))
+# /view shows a downscaled WebP (or progressive JPEG) copy of the stego image
+# instead of the full uncompressed PNG; the PNG stays downloadable until reveal.
+# DISPLAY_MAX_PX bounds the longest side, 0 turns derivatives off.
+DISPLAY_MAX_PX = int(os.environ.get("DISPLAY_MAX_PX", "1280"))
+DISPLAY_QUALITY = int(os.environ.get("DISPLAY_QUALITY", "75"))
+DISPLAY_FORMAT = os.environ.get("DISPLAY_FORMAT", "webp").lower()
+# Token-bucket rate limits, checked before any MongoDB or Pillow work. Every user
+# (by session) and every client IP gets a bucket of RATE_LIMIT_BURST tokens that
+# refills at RATE_LIMIT_PER_SECOND; routes cost ROUTE_COSTS tokens (plus one per
+# megapixel for /send). "memory" is per worker process; "sqlite" shares buckets
+# between the workers of one host through RATE_LIMIT_SQLITE; "off" disables.
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_SQLITE = os.environ.get("RATE_LIMIT_SQLITE", "rate_limits.sqlite3")
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "60"))
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", "1"))
+# Clients share an IP behind NAT, so the per-IP bucket is this many times larger
+RATE_LIMIT_IP_FACTOR = float(os.environ.get("RATE_LIMIT_IP_FACTOR", "4"))
+# Reverse proxies in front of the app (Render/Railway: 1); the client IP is read
+# from X-Forwarded-For that many hops back. 0 = use the socket address.
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", "0"))
+# Where "code accepted for this message" grants live between /view and /api/reveal:
+# "mongo" (reveal_grants collection with a TTL index) or "sqlite" (REVEAL_GRANT_SQLITE,
+# one host only). Defaults to mongo when the database is reachable.
+REVEAL_GRANT_STORE = os.environ.get("REVEAL_GRANT_STORE")
+REVEAL_GRANT_SQLITE = os.environ.get("REVEAL_GRANT_SQLITE", "reveal_grants.sqlite3")
+REVEAL_GRANT_SECONDS = int(os.environ.get("REVEAL_GRANT_SECONDS", "900"))
+# Per-query-class MongoDB settings as JSON, merged over QUERY_CLASS_DEFAULTS, e.g.
+# {"dashboard": {"read_preference": "nearest", "max_staleness_seconds": 90}}
+MONGO_QUERY_CLASSES = os.environ.get("MONGO_QUERY_CLASSES")
+# Inbox clears delete this many messages per round trip; past the first batch
+# the rest continue in a background thread and the dashboard shows progress.
+CLEAR_BATCH = int(os.environ.get("CLEAR_BATCH", "500"))
+# Unread/viewed/pending counters on user documents are kept with $inc; this job
+# recounts them from messages and pairings every so often (0 disables it).
+COUNTS_REPAIR_SECONDS = float(os.environ.get("COUNTS_REPAIR_SECONDS", "3600"))
+# Inbox push over server-sent events: "auto" uses MongoDB change streams when the
+# server is a replica set and falls back to polling; "poll" forces polling, "off"
+# disables the stream (the dashboard then polls /api/v1/inbox with its ETag).
+INBOX_EVENTS = os.environ.get("INBOX_EVENTS", "auto").lower()
+INBOX_POLL_SECONDS = float(os.environ.get("INBOX_POLL_SECONDS", "2"))
+# Every open stream holds a thread under gthread, so by default streams may use
+# at most half of them; extra clients get 204 and poll instead.
+WEB_WORKER_CLASS = os.environ.get("WEB_WORKER_CLASS", "sync")
+SSE_MAX_CLIENTS = int(os.environ.get("SSE_MAX_CLIENTS") or (
+    int(os.environ.get("WEB_WORKER_CONNECTIONS", "200")) // 2 if WEB_WORKER_CLASS == "gevent"
+    else max(1, int(os.environ.get("WEB_THREADS", "8")) // 2)))
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+trace_log = logging.getLogger("secapp.trace")
+profile_log = logging.getLogger("secapp.profile")
+
+class SpooledUpload(tempfile.SpooledTemporaryFile):
+    """Upload buffer that rolls over to disk past UPLOAD_SPOOL_KB and hashes while streaming."""
+
+    def __init__(self):
+        super().__init__(max_size=UPLOAD_SPOOL_KB * 1024, mode="w+b", dir=UPLOAD_SPOOL_DIR)
+        self.sha256 = hashlib.sha256()
+        self.nbytes = 0
+        self.spooled = False  # True once rolled over to a file on disk
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.nbytes += len(data)
+        return super().write(data)
+
+    def rollover(self):
+        super().rollover()
+        self.spooled = True
+
+    def open_for_decode(self) -> IO[bytes]:
+        """A read-only view for Pillow: an mmap of the temp file once spooled, else self."""
+        self.seek(0)
+        if not self.spooled or self.nbytes == 0:
+            return self
+        # mmap has the read/seek/tell Pillow uses, it just isn't typed as a file
+        return cast(IO[bytes], mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ))
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledUpload()
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 app.secret_key = FLASK_SECRET_KEY
 
 # Configure session cookies for mobile/HTTPS compatibility
@@ -34,25 +198,166 @@ app.config['SESSION_COOKIE_SECURE'] = is_production  # Secure cookies for HTTPS
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Works better on mobile browsers
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)  # Sessions last 30 days
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_UPLOAD_MB * 1024 * 1024)  # Werkzeug answers 413 past this
+# Pillow refuses (DecompressionBombError) images over 2x this at open time
+Image.MAX_IMAGE_PIXELS = int(MAX_IMAGE_MEGAPIXELS * 1_000_000)
 
-# Generate or validate Fernet key
-try:
-    if FERNET_KEY_ENV and FERNET_KEY_ENV != "your-generated-key-here":
-        # Try to use the provided key
-        fernet = Fernet(FERNET_KEY_ENV.encode())
-        FERNET_KEY = FERNET_KEY_ENV
-    else:
-        # Generate a new key
-        FERNET_KEY = Fernet.generate_key().decode()
-        fernet = Fernet(FERNET_KEY.encode())
-        print("⚠️  Generated new FERNET_KEY (not set in .env or invalid)")
-        print(f"   Add this to your .env file: FERNET_KEY={FERNET_KEY}")
-except (ValueError, Exception):
-    # Invalid key, generate a new one
-    FERNET_KEY = Fernet.generate_key().decode()
-    fernet = Fernet(FERNET_KEY.encode())
-    print("⚠️  Invalid FERNET_KEY in .env, generated a new one")
-    print(f"   Add this to your .env file: FERNET_KEY={FERNET_KEY}")
+# ---------- metrics (Prometheus text format) ----------
+# Values are per worker process; scrape each worker (or run a single worker)
+# when exact totals matter.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MEGAPIXEL_BUCKETS = (0.1, 0.3, 1, 2, 4, 8, 12, 16, 24, 50)
+_metrics = []
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Gauge:
+    """Gauge whose value is computed by a callback at scrape time."""
+
+    def __init__(self, name, help_text, fn):
+        self.name, self.help, self.fn = name, help_text, fn
+        _metrics.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.fn()}"]
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        self.values = {}  # label key -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self.lock:
+            state = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, state in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, state):
+                    lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames + ('le',), key + (str(bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames + ('le',), key + ('+Inf',))} {state[-1]}")
+                lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {state[-2]}")
+                lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+def _fmt_labels(names, values):
+    if not names:
+        return ""
+    escaped = [v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values]
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+def _upload_dir_stats():
+    count = size = 0
+    try:
+        for entry in os.scandir(UPLOAD_DIR):
+            if entry.is_file() and not entry.name.startswith("."):
+                count += 1
+                size += entry.stat().st_size
+    except OSError:
+        pass
+    return count, size
+
+HTTP_REQUESTS = Counter("secapp_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("secapp_http_request_duration_seconds", "HTTP request latency by route.", ("route", "method"))
+MONGO_LATENCY = Histogram("secapp_mongo_command_duration_seconds", "MongoDB command latency.", ("command",))
+MONGO_FAILURES = Counter("secapp_mongo_command_failures_total", "Failed MongoDB commands.", ("command",))
+STEGO_LATENCY = Histogram("secapp_stego_duration_seconds", "Embed/extract duration.", ("op",))
+STEGO_BYTES = Counter("secapp_stego_payload_bytes_total", "Payload bytes embedded/extracted.", ("op",))
+STEGO_MEGAPIXELS = Histogram("secapp_stego_image_megapixels", "Image size handled by embed/extract.", ("op",), MEGAPIXEL_BUCKETS)
+BCRYPT_LATENCY = Histogram("secapp_bcrypt_duration_seconds", "bcrypt hash/check duration.", ("op",), (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2))
+UPLOAD_BYTES = Counter("secapp_upload_bytes_total", "Bytes received in file uploads.", ("spooled",))
+# source=user_doc: answered from the partners array current_user() loaded;
+# source=pairings: that array did not exist yet and was built from pairings first
+PAIRING_LOOKUPS = Counter("secapp_send_pairing_lookups_total", "How /send authorized the recipient.", ("source", "result"))
+Gauge("secapp_upload_dir_files", "Files in UPLOAD_DIR.", lambda: _upload_dir_stats()[0])
+Gauge("secapp_upload_dir_bytes", "Total size of UPLOAD_DIR in bytes.", lambda: _upload_dir_stats()[1])
+
+class _MongoMetricsListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, command=event.command_name)
+        MONGO_FAILURES.inc(command=event.command_name)
+
+def observe_stego(op, timings, payload_len, size):
+    """Record embed/extract metrics from a stego job's stage timings."""
+    STEGO_LATENCY.observe(dict(timings).get(op, 0.0), op=op)
+    STEGO_BYTES.inc(payload_len, op=op)
+    STEGO_MEGAPIXELS.observe(size[0] * size[1] / 1e6, op=op)
+
+# ---------- key ring ----------
+# FERNET_KEYS="new,old,..." (primary first): new sends use the primary key, every key
+# can decrypt. Falls back to FERNET_KEY, then to keys in FERNET_KEY_FILE, which is
+# created once with a generated key so all gunicorn workers share the same one.
+def _valid_fernet_key(key):
+    try:
+        Fernet(key.encode())
+        return True
+    except (ValueError, TypeError):
+        return False
+
+def load_key_ring():
+    keys = [k.strip() for k in (FERNET_KEYS_ENV or "").split(",") if k.strip()]
+    if not keys and FERNET_KEY_ENV and FERNET_KEY_ENV != "your-generated-key-here":
+        keys = [FERNET_KEY_ENV.strip()]
+    valid = [k for k in keys if _valid_fernet_key(k)]
+    if len(valid) != len(keys):
+        print(f"⚠️  Ignoring {len(keys) - len(valid)} invalid key(s) in FERNET_KEYS/FERNET_KEY")
+    if valid:
+        return valid
+
+    try:
+        fd = os.open(FERNET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        generated = Fernet.generate_key().decode()
+        with os.fdopen(fd, "w") as f:
+            f.write(generated + "\n")
+        print(f"⚠️  Generated new FERNET_KEY (not set in .env), saved to {FERNET_KEY_FILE}")
+        print(f"   Add this to your .env file: FERNET_KEY={generated}")
+    except FileExistsError:
+        pass
+    # another worker may have just created the file and not written it yet
+    for _ in range(50):
+        with open(FERNET_KEY_FILE, encoding="utf-8") as f:
+            keys = [k.strip() for k in f if k.strip() and _valid_fernet_key(k.strip())]
+        if keys:
+            return keys
+        time.sleep(0.1)
+    raise RuntimeError(f"No valid Fernet key in {FERNET_KEY_FILE}")
+
+FERNET_KEYS = load_key_ring()
+FERNET_KEY = FERNET_KEYS[0]
+PRIMARY_KEY_ID = key_id(FERNET_KEY)
+fernet = MultiFernet([Fernet(k.encode()) for k in FERNET_KEYS])
 
 # mongo - with timeout settings
 try:
@@ -60,7 +365,8 @@ try:
         MONGO_URI,
         serverSelectionTimeoutMS=5000,  # 5 second timeout
         connectTimeoutMS=5000,
-        socketTimeoutMS=20000
+        socketTimeoutMS=20000,
+        event_listeners=[_MongoMetricsListener()]
     )
     # Test the connection
     client.admin.command('ping')
@@ -68,6 +374,7 @@ try:
     users = db.get_collection("users")
     messages = db.get_collection("messages")
     pairings = db.get_collection("pairings")
+    ensure_indexes(db)
     print("✓ MongoDB connection successful")
 except (ServerSelectionTimeoutError, ConnectionFailure) as e:
     print(f"✗ MongoDB connection failed: {e}")
@@ -80,117 +387,1385 @@ except (ServerSelectionTimeoutError, ConnectionFailure) as e:
     messages = None
     pairings = None
 
+NOT_CONNECTED = "MongoDB is not connected"
+
 def get_db_error_msg():
+    if wants_json():
+        return jsonify({"error": "database_unavailable", "message": "Database connection error"}), 503
     return "Database connection error. Please ensure MongoDB is running.", 503
 
+# ---------- query classes ----------
+# Each kind of query gets its own read preference, read/write concern and time
+# budget, so latency and durability can be tuned separately. With a replica set,
+# dashboard lists can come from secondaries while one-time-view state is only
+# ever read and written with majority guarantees. On a standalone mongod the
+# read preferences are no-ops. Try it locally with the replset profile in
+# docker-compose.yml.
+QUERY_CLASS_DEFAULTS = {
+    # inbox, partner and pending-request lists, SSE polling: may lag, must be quick
+    "dashboard": {"read_preference": "secondaryPreferred", "read_concern": "local", "max_time_ms": 2000},
+    # session user lookup, login, register
+    "auth": {"read_preference": "primaryPreferred", "read_concern": "local", "write_concern": 1, "max_time_ms": 2000},
+    # message insert, token lookup and the viewed flag: never lost, never stale
+    "one_time": {"read_preference": "primary", "read_concern": "majority", "write_concern": "majority",
+                 "journal": True, "max_time_ms": 5000},
+}
+READ_PREFERENCES = {"primary": Primary, "primaryPreferred": PrimaryPreferred, "secondary": Secondary,
+                    "secondaryPreferred": SecondaryPreferred, "nearest": Nearest}
+
+class QueryClass:
+    """users / messages / pairings handles carrying one query class's settings.
+
+    The handles raise ConnectionFailure (answered with a 503) when MongoDB was
+    unreachable at startup, so callers never see None.
+    """
+
+    def __init__(self, name, read_preference="primary", read_concern=None, write_concern=None,
+                 journal=None, max_time_ms=None, max_staleness_seconds=-1):
+        self.name = name
+        self.max_time_ms = max_time_ms
+        pref = READ_PREFERENCES[read_preference]
+        self.read_preference = pref() if pref is Primary else pref(max_staleness=max_staleness_seconds)
+        self.read_concern = ReadConcern(read_concern) if read_concern else None
+        self.write_concern = (WriteConcern(w=write_concern, j=journal)
+                              if write_concern is not None or journal is not None else None)
+        self._users, self._messages, self._pairings = (self._bind(c) for c in (users, messages, pairings))
+
+    def _bind(self, collection: Optional[Collection]) -> Optional[Collection]:
+        if collection is None:
+            return None
+        # None leaves the client's default in place
+        return collection.with_options(read_preference=self.read_preference, read_concern=self.read_concern,
+                                       write_concern=self.write_concern)
+
+    @staticmethod
+    def _connected(collection: Optional[Collection]) -> Collection:
+        if collection is None:
+            raise ConnectionFailure(NOT_CONNECTED)
+        return collection
+
+    @property
+    def users(self) -> Collection:
+        return self._connected(self._users)
+
+    @property
+    def messages(self) -> Collection:
+        return self._connected(self._messages)
+
+    @property
+    def pairings(self) -> Collection:
+        return self._connected(self._pairings)
+
+    def timeout(self):
+        """Client-side time budget (pymongo.timeout) covering every operation inside it."""
+        return pymongo.timeout(self.max_time_ms / 1000 if self.max_time_ms else None)
+
+def load_query_classes():
+    settings = {name: dict(opts) for name, opts in QUERY_CLASS_DEFAULTS.items()}
+    if MONGO_QUERY_CLASSES:
+        for name, opts in json.loads(MONGO_QUERY_CLASSES).items():
+            settings.setdefault(name, {}).update(opts)
+    return {name: QueryClass(name, **opts) for name, opts in settings.items()}
+
+query_classes = load_query_classes()
+Q_DASHBOARD = query_classes["dashboard"]
+Q_AUTH = query_classes["auth"]
+Q_ONE_TIME = query_classes["one_time"]
+
+@app.errorhandler(PyMongoError)
+def _mongo_error(e):
+    # query-class timeouts (ExecutionTimeout, WTimeoutError, ...) and anything else
+    # a route didn't catch itself
+    print(f"MongoDB error on {request.path}: {e}")
+    return get_db_error_msg()
+
+# ---------- shared queries ----------
+# Used by both the HTML pages and /api/v1 so the two never drift apart.
+# Projections (INBOX_FIELDS, PAIRING_FIELDS) live in schema.py.
+
+def inbox_for(email, limit=0):
+    """Messages addressed to `email`, newest first."""
+    with Q_DASHBOARD.timeout():
+        return list(Q_DASHBOARD.messages.find({"recipient": email}, INBOX_FIELDS).sort("created_at", -1).limit(limit))
+
+def pending_requests_for(email):
+    """Pairing requests waiting for `email` to accept or reject."""
+    with Q_DASHBOARD.timeout():
+        return list(Q_DASHBOARD.pairings.find({"user2_email": email, "status": "pending"}, PAIRING_FIELDS))
+
+def partners_of(email):
+    """(partner_email, pairing_doc) for every accepted pairing of `email`.
+
+    Read from the primary: this builds the user's partners array, and a lagging
+    secondary could leave out a pairing accepted a moment ago.
+    """
+    if pairings is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    found = pairings.with_options(read_preference=Primary()).find({"$or": [
+        {"user1_email": email, "status": "paired"},
+        {"user2_email": email, "status": "paired"},
+    ]}, PAIRING_FIELDS | {"accepted_at": 1})
+    return [(p["user2_email"] if p["user1_email"] == email else p["user1_email"], p) for p in found]
+
+# Accepted pairings are also kept on both user documents as a "partners" array of
+# {email, pairing_id, code_hash, since}, so the dashboard and /send read them from
+# the user doc current_user() already loaded. The pairings collection stays the
+# source of truth; check_partner_links() compares the two and can repair drift.
+def _partner_entry(partner_email, pairing):
+    return {
+        "email": partner_email,
+        "pairing_id": str(pairing["_id"]),
+        "code_hash": pairing.get("secret_code_hash"),
+        "since": pairing.get("accepted_at"),
+    }
+
+def _add_partners(email):
+    """Add every accepted pairing of `email` to its partners array, creating the array
+    if missing. $addToSet merges with entries a concurrent link_partners() wrote, where
+    a $set would overwrite them. Returns the entries read."""
+    if users is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    entries = [_partner_entry(other, p) for other, p in partners_of(email)]
+    users.update_one({"email": email}, {"$addToSet": {"partners": {"$each": entries}}})
+    return entries
+
+def user_partners(user):
+    """The user's partner entries; builds the list from pairings the first time."""
+    if "partners" in user:
+        return user["partners"]
+    user["partners"] = _add_partners(user["email"])
+    return user["partners"]
+
+def link_partners(pairing):
+    """Record an accepted pairing on both users. Each update is atomic per document
+    and idempotent, so a retry (or the checker) can safely finish a partial link."""
+    if users is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    for me, other in ((pairing["user1_email"], pairing["user2_email"]), (pairing["user2_email"], pairing["user1_email"])):
+        entry = _partner_entry(other, pairing)
+        if users.update_one({"email": me, "partners.email": other}, {"$set": {"partners.$": entry}}).matched_count:
+            continue
+        if not users.update_one({"email": me, "partners": {"$exists": True}, "partners.email": {"$ne": other}},
+                                {"$addToSet": {"partners": entry}}).matched_count:
+            # no array yet (or a concurrent backfill just added this entry): build it in
+            # full from pairings, which already include this one as paired
+            _add_partners(me)
+
+def check_partner_links(repair=False):
+    """Compare every user's partners array with the paired pairings.
+
+    Returns {email: (expected, actual)} for users that differ; with repair=True
+    their arrays are rewritten from pairings. Users that never had the array
+    built are skipped, since user_partners() or link_partners() builds it on first use.
+    """
+    if users is None or pairings is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    expected = {}
+    for p in pairings.find({"status": "paired"}, PAIRING_FIELDS | {"accepted_at": 1}):
+        expected.setdefault(p["user1_email"], []).append(_partner_entry(p["user2_email"], p))
+        expected.setdefault(p["user2_email"], []).append(_partner_entry(p["user1_email"], p))
+    key = lambda e: (e["email"], e["pairing_id"], e.get("code_hash"))
+    drift = {}
+    for u in users.find({"partners": {"$exists": True}}, {"email": 1, "partners": 1}):
+        want = expected.get(u["email"], [])
+        if sorted(map(key, want)) != sorted(map(key, u["partners"])):
+            drift[u["email"]] = (want, u["partners"])
+            if repair:
+                users.update_one({"_id": u["_id"]}, {"$set": {"partners": want}})
+    return drift
+
+def find_pairing(email_a, email_b, status):
+    """The pairing between two users in either direction, or None."""
+    if pairings is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    return pairings.find_one({"$or": [
+        {"user1_email": email_a, "user2_email": email_b, "status": status},
+        {"user1_email": email_b, "user2_email": email_a, "status": status},
+    ]})
+
+def pairing_id_filter(request_id):
+    """_id filter for a pairing id from a URL (ObjectId, or a legacy string id)."""
+    try:
+        return {"_id": ObjectId(request_id)}
+    except Exception:
+        return {"_id": request_id}
+
+def request_field(name):
+    """A form field, or the same key from a JSON body (API clients)."""
+    value = request.form.get(name)
+    if value is None:
+        value = (request.get_json(silent=True) or {}).get(name)
+    return value if isinstance(value, str) else ""
+
+# ---------- inbox counters ----------
+# Each user document carries counts = {unread, viewed, pending}, adjusted with $inc
+# next to every write that changes them, so badges never count messages. The $inc
+# only applies once counts exist (user_counts() builds them on first use), and
+# recount_inbox() rebuilds them from messages and pairings if they ever drift.
+COUNT_FIELDS = ("unread", "viewed", "pending")
+
+def bump_counts(email, **deltas):
+    """$inc counters on one user, e.g. bump_counts(email, unread=-1, viewed=1)."""
+    if users is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    inc = {f"counts.{name}": n for name, n in deltas.items() if n}
+    if inc:
+        users.update_one({"email": email, "counts": {"$exists": True}}, {"$inc": inc})
+
+def _tally_counts(email=None):
+    """{email: counts} straight from messages and pairings (one user or everyone)."""
+    if messages is None or pairings is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    match = {"recipient": email} if email else {}
+    tally = {}
+    for row in messages.aggregate([{"$match": match},
+                                   {"$group": {"_id": {"to": "$recipient", "viewed": "$viewed"}, "n": {"$sum": 1}}}]):
+        counts = tally.setdefault(row["_id"]["to"], dict.fromkeys(COUNT_FIELDS, 0))
+        counts["viewed" if row["_id"].get("viewed") else "unread"] += row["n"]
+    match = {"user2_email": email} if email else {}
+    for row in pairings.aggregate([{"$match": {**match, "status": "pending"}},
+                                   {"$group": {"_id": "$user2_email", "n": {"$sum": 1}}}]):
+        tally.setdefault(row["_id"], dict.fromkeys(COUNT_FIELDS, 0))["pending"] = row["n"]
+    return tally
+
+def user_counts(user):
+    """The user's counters; counts them once the first time they are needed."""
+    if "counts" in user:
+        return user["counts"]
+    if users is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    counts = _tally_counts(user["email"]).get(user["email"], dict.fromkeys(COUNT_FIELDS, 0))
+    users.update_one({"_id": user["_id"], "counts": {"$exists": False}}, {"$set": {"counts": counts}})
+    user["counts"] = counts
+    return counts
+
+def recount_inbox(email=None):
+    """Reconcile stored counters with a fresh tally. Returns {email: (stored, actual)}.
+
+    Stored counters are read before the tally and each fix is a compare-and-set
+    against that snapshot, so a user whose counters were bumped while the tally
+    ran is left alone and fixed next run.
+    """
+    if users is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    query = {"email": email} if email else {"counts": {"$exists": True}}
+    stored = list(users.find(query, {"email": 1, "counts": 1}))
+    tally = _tally_counts(email)
+    drift = {}
+    for u in stored:
+        actual = tally.get(u["email"], dict.fromkeys(COUNT_FIELDS, 0))
+        if u.get("counts") != actual:
+            drift[u["email"]] = (u.get("counts"), actual)
+            users.update_one({"_id": u["_id"], "counts": u.get("counts")}, {"$set": {"counts": actual}})
+    return drift
+
+def _recount_loop():
+    while True:
+        try:
+            if _acquire_job_lease("recount", COUNTS_REPAIR_SECONDS):
+                drift = recount_inbox()
+                if drift:
+                    print(f"Inbox counters: repaired {len(drift)} user(s)")
+        except (ServerSelectionTimeoutError, ConnectionFailure) as e:
+            print(f"Recount job: database error: {e}")
+        time.sleep(COUNTS_REPAIR_SECONDS)
+
 # ---------- simple auth helpers ----------
 def current_user():
     uid = session.get("user_id")
     if not uid or users is None:
         return None
     try:
-        return users.find_one({"_id": uid})
+        with Q_AUTH.timeout():
+            return Q_AUTH.users.find_one({"_id": uid})
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return None
 
-# ---------- stego helpers (LSB RGB) ----------
-def _bytes_to_bits(b: bytes):
-    for byte in b:
-        for i in range(8):
-            yield (byte >> (7 - i)) & 1
+# ---------- payload envelope ----------
+# Embedded payloads used to be the base64 Fernet token as-is (always starts with "g").
+# The envelope stores [version, flags] + the base64-decoded token, and compresses the
+# plaintext first when that makes it smaller: ~25% fewer bits to embed before compression.
+ENVELOPE_VERSION = 0x01
+ENVELOPE_ZLIB = 0x01
+COMPRESS_MIN_BYTES = 64
+MAX_SECRET_BYTES = 1024 * 1024  # decompression bound
 
-def embed_bytes_in_image(img: Image.Image, payload: bytes) -> Image.Image:
-    """Embed encrypted payload into image using LSB steganography in RGB channels."""
-    if len(payload) > 2000*10:  # crude safety
-        raise ValueError("Payload too large")
-    
-    # Calculate required pixels: 4 bytes (length) + payload, each byte needs 8 bits, each pixel provides 3 bits
-    required_pixels = ((4 + len(payload)) * 8 + 2) // 3  # +2 for rounding up
-    
-    # Convert to RGBA to ensure we have RGB channels
-    if img.mode not in ("RGB", "RGBA"):
-        rgba_img = img.convert("RGBA")
+def seal_payload(plaintext: bytes) -> bytes:
+    """Encrypt plaintext into the bytes that get embedded in the image."""
+    if not PAYLOAD_ENVELOPE:
+        return fernet.encrypt(plaintext)
+    flags = 0
+    body = plaintext
+    if len(plaintext) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(plaintext, 9)
+        if len(packed) < len(plaintext):
+            body, flags = packed, flags | ENVELOPE_ZLIB
+    token = base64.urlsafe_b64decode(fernet.encrypt(body))
+    return bytes([ENVELOPE_VERSION, flags]) + token
+
+def open_payload(payload: bytes) -> bytes:
+    """Decrypt an embedded payload, either an envelope or a legacy base64 Fernet token."""
+    if payload[:1] == b"g":
+        return fernet.decrypt(payload)
+    if len(payload) < 2 or payload[0] != ENVELOPE_VERSION:
+        raise ValueError(f"Unknown payload version: {payload[:1].hex()}")
+    flags = payload[1]
+    body = fernet.decrypt(base64.urlsafe_b64encode(payload[2:]))
+    if flags & ENVELOPE_ZLIB:
+        inflater = zlib.decompressobj()
+        body = inflater.decompress(body, MAX_SECRET_BYTES)
+        if inflater.unconsumed_tail:
+            raise ValueError("Decompressed secret too large")
+    return body
+
+def rotate_payload(payload: bytes) -> bytes:
+    """Re-encrypt an embedded payload under the primary key, keeping its format."""
+    if payload[:1] == b"g":
+        return fernet.rotate(payload)
+    token = fernet.rotate(base64.urlsafe_b64encode(payload[2:]))
+    return payload[:2] + base64.urlsafe_b64decode(token)
+
+# ---------- key rotation re-embed ----------
+def _job_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _acquire_job_lease(name, seconds):
+    """Cross-worker lease in the jobs collection so only one process runs a job."""
+    if db is None:
+        return False
+    now = datetime.now(timezone.utc)
+    try:
+        db.jobs.find_one_and_update(
+            {"_id": name, "$or": [{"lease_until": {"$lt": now}}, {"lease_until": {"$exists": False}}]},
+            {"$set": {"lease_until": now + timedelta(seconds=seconds), "owner": _job_owner()}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+def _renew_job_lease(name, seconds):
+    """Push our lease on `name` out by `seconds`. False if it expired and another process took it."""
+    if db is None:
+        return False
+    return db.jobs.update_one(
+        {"_id": name, "owner": _job_owner()},
+        {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=seconds)}},
+    ).matched_count == 1
+
+def _reembed_message(doc):
+    if messages is None:
+        return False
+    path = doc.get("image_path")
+    tmp_path = None
+    try:
+        img = Image.open(path)
+        img.load()
+        mode = embed_mode_of(img)
+        payload = rotate_payload(extract_bytes_from_image(img))
+        stego = embed_bytes_in_image(img, payload, use_alpha=mode[1])
+        # a name of our own, so two writers can never interleave in one temp file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".reembed")
+        with os.fdopen(fd, "wb") as f:
+            stego.save(f, "PNG", compress_level=0, optimize=False)
+        os.replace(tmp_path, path)
+    except (OSError, ValueError, InvalidToken) as e:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        print(f"Re-embed of {doc.get('message_id')} failed: {e}")
+        messages.update_one({"_id": doc["_id"]}, {"$set": {"reembed_failed": True}})
+        return False
+    result = messages.update_one({"_id": doc["_id"], "viewed": False, "key_id": doc.get("key_id")},
+                                 {"$set": {"key_id": PRIMARY_KEY_ID}})
+    if result.matched_count == 0 and not messages.find_one({"_id": doc["_id"], "viewed": False}, {"_id": 1}):
+        # revealed while we were rewriting it: don't leave the new file behind
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return result.matched_count == 1
+
+def reembed_old_keys(batch_size=REEMBED_BATCH, pause=REEMBED_PAUSE_SECONDS, max_batches=None, lease=None):
+    """Move unviewed messages off old keys in throttled batches. Returns how many moved.
+
+    With `lease` (the jobs lease name the caller holds) the lease is extended
+    before every message, and the run stops as soon as another process owns it.
+    """
+    if messages is None:
+        return 0
+    migrated = batches = 0
+    query = {"viewed": False, "key_id": {"$ne": PRIMARY_KEY_ID}, "reembed_failed": {"$exists": False}}
+    while max_batches is None or batches < max_batches:
+        batch = list(messages.find(query, {"message_id": 1, "image_path": 1, "key_id": 1}).limit(batch_size))
+        if not batch:
+            break
+        for doc in batch:
+            if lease and not _renew_job_lease(lease, REEMBED_INTERVAL_SECONDS):
+                print("Re-embed job: lease taken over by another process, stopping")
+                return migrated
+            migrated += _reembed_message(doc)
+        batches += 1
+        time.sleep(pause)
+    return migrated
+
+def _reembed_loop():
+    while True:
+        try:
+            if _acquire_job_lease("reembed", REEMBED_INTERVAL_SECONDS):
+                migrated = reembed_old_keys(lease="reembed")
+                if migrated:
+                    print(f"✓ Re-embedded {migrated} message(s) under key {PRIMARY_KEY_ID}")
+        except (ServerSelectionTimeoutError, ConnectionFailure) as e:
+            print(f"Re-embed job: database error: {e}")
+        time.sleep(REEMBED_INTERVAL_SECONDS)
+
+if KEY_REEMBED and messages is not None and len(FERNET_KEYS) > 1:
+    threading.Thread(target=_reembed_loop, daemon=True, name="reembed").start()
+
+if COUNTS_REPAIR_SECONDS and messages is not None:
+    threading.Thread(target=_recount_loop, daemon=True, name="recount").start()
+
+if DISPLAY_FORMAT == "webp" and not features.check("webp"):
+    print("⚠️  Pillow was built without WebP support, display images fall back to JPEG")
+    DISPLAY_FORMAT = "jpeg"
+DISPLAY_EXT = {"webp": ".webp", "jpeg": ".jpg"}
+
+def _write_display(img: Image.Image, path: str, has_alpha: bool):
+    """Write the bounded-size display copy of a cover and a tiny blurred placeholder.
+
+    Lossy re-encoding and downscaling wipe the LSB plane, so the derivative
+    carries nothing of the payload. `has_alpha` is about the original cover
+    (img is usually its RGBA conversion). Returns the metadata stored on the message.
+    """
+    scale = min(1.0, DISPLAY_MAX_PX / max(img.size))
+    size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+    keep_alpha = DISPLAY_FORMAT == "webp" and has_alpha
+    small = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    small = small if keep_alpha else small.convert("RGB")
+    if DISPLAY_FORMAT == "webp":
+        small.save(path, "WEBP", quality=DISPLAY_QUALITY, method=4)
     else:
-        rgba_img = img.convert("RGBA")
-    
-    pixels = list(rgba_img.getdata())  # type: ignore
-    
-    if len(pixels) < required_pixels:
-        raise ValueError(f"Image too small to hold payload. Need {required_pixels} pixels, have {len(pixels)}")
-    
-    # Prepare data: 4-byte length prefix + payload
-    length_prefix = len(payload).to_bytes(4, "big")
-    data = length_prefix + payload
-    bits = list(_bytes_to_bits(data))
-    
-    # Embed bits into LSB of RGB channels
-    new_pixels = []
-    bit_idx = 0
-    for px in pixels:
-        r, g, b, a = px
-        if bit_idx < len(bits):
-            r = (r & ~1) | bits[bit_idx]  # Clear LSB, set to data bit
-            bit_idx += 1
-        if bit_idx < len(bits):
-            g = (g & ~1) | bits[bit_idx]
-            bit_idx += 1
-        if bit_idx < len(bits):
-            b = (b & ~1) | bits[bit_idx]
-            bit_idx += 1
-        new_pixels.append((r, g, b, a))
-    
-    if bit_idx < len(bits):
-        raise ValueError(f"Not all bits embedded. Embedded {bit_idx}/{len(bits)} bits")
-    
-    # Create new image with embedded data
-    out = Image.new("RGBA", rgba_img.size)
-    out.putdata(new_pixels)
+        small.save(path, "JPEG", quality=DISPLAY_QUALITY, optimize=True, progressive=True)
+    # ~20px preview inlined into the page, shown blurred until the real image arrives
+    buf = io.BytesIO()
+    preview = small.convert("RGB")
+    preview.thumbnail((20, 20))
+    preview.save(buf, "JPEG", quality=50)
+    return {
+        "display_path": path,
+        "display_size": list(size),
+        "display_placeholder": "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode(),
+    }
+
+def _embed_to_file(img: Image.Image, payload: bytes, path: str, use_alpha=None, display_path=None):
+    """Embed payload and write the stego PNG to path (plus the display copy to display_path).
+
+    Returns (stego size, stage timings, display metadata or None) so callers in
+    the request process can record spans even when this runs in the stego pool.
+    """
+    timings = []
+    t0 = time.perf_counter()
+    rgba_img = img if img.mode == "RGBA" else img.convert("RGBA")
+    t1 = time.perf_counter()
+    if rgba_img is not img:
+        timings.append(("convert", t1 - t0))
+    if use_alpha is None:
+        use_alpha = image_has_alpha(img)
+    stego = embed_bytes_in_image(rgba_img, payload, use_alpha=use_alpha)
+    t2 = time.perf_counter()
+    timings.append(("embed", t2 - t1))
+    # Save PNG with no compression to preserve LSB data
+    # compress_level=0 means no compression, which preserves exact pixel values
+    stego.save(path, "PNG", compress_level=0, optimize=False)
+    t3 = time.perf_counter()
+    timings.append(("png_save", t3 - t2))
+    display = None
+    if display_path:
+        display = _write_display(rgba_img, display_path, use_alpha)
+        timings.append(("display", time.perf_counter() - t3))
+    return stego.size, timings, display
+
+def _extract_from_file(path: str):
+    """Load a stego PNG from disk and extract its payload. Returns (payload, stage timings, image size)."""
+    t0 = time.perf_counter()
+    img = Image.open(path)
+    # Ensure image is fully loaded
+    img.load()
+    t1 = time.perf_counter()
+    payload = extract_bytes_from_image(img)
+    return payload, [("decode", t1 - t0), ("extract", time.perf_counter() - t1)], img.size
+
+# ---------- upload admission ----------
+def admit_image(file):
+    """Open an upload header-only and enforce the size limits before any decode.
+
+    Image.open only parses the header, so dimensions and mode are known without
+    touching pixel data. Returns (img, None) or (None, (message, status)).
+    """
+    stream = file.stream
+    if isinstance(stream, SpooledUpload):
+        UPLOAD_BYTES.inc(stream.nbytes, spooled=stream.spooled)
+        stream = stream.open_for_decode()
+    else:
+        stream.seek(0)  # Reset stream to beginning
+    try:
+        img = Image.open(stream)
+    except Image.DecompressionBombError:
+        return None, (f"image too large (max {MAX_IMAGE_MEGAPIXELS:g} megapixels)", 413)
+    except Exception:
+        return None, ("unsupported or corrupt image", 400)
+    width, height = img.size
+    if width * height > MAX_IMAGE_MEGAPIXELS * 1_000_000:
+        return None, (f"image too large: {width}x{height} (max {MAX_IMAGE_MEGAPIXELS:g} megapixels)", 413)
+    return img, None
+
+def upload_sha256(file):
+    """Hex SHA-256 of an upload, computed while it was streamed in (None if unavailable)."""
+    if isinstance(file.stream, SpooledUpload):
+        return file.stream.sha256.hexdigest()
+    return None
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    if wants_json():
+        return jsonify({"error": "upload_too_large", "message": f"upload too large (max {MAX_UPLOAD_MB:g} MB)"}), 413
+    return f"upload too large (max {MAX_UPLOAD_MB:g} MB)", 413
+
+# ---------- cover cache ----------
+class CoverCache:
+    """Bounded LRU of decoded RGBA covers keyed by the SHA-256 of the upload bytes.
+
+    A resent cover skips decode and convert("RGBA") and goes straight to embedding.
+    get() hands out a copy (a memcpy, far cheaper than a decode), so nothing a
+    caller does to its image can reach the cached one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()  # sha256 -> (image, nbytes)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = Counter("secapp_cover_cache_hits_total", "Cover cache hits.")
+        self.misses = Counter("secapp_cover_cache_misses_total", "Cover cache misses.")
+        self.evictions = Counter("secapp_cover_cache_evictions_total", "Covers evicted from the cache.")
+        Gauge("secapp_cover_cache_bytes", "Decoded bytes held by the cover cache.", lambda: self.size)
+        Gauge("secapp_cover_cache_entries", "Covers held by the cover cache.", lambda: len(self.items))
+        Gauge("secapp_cover_cache_hit_ratio", "Cover cache hits / lookups.", self.hit_ratio)
+
+    def hit_ratio(self):
+        hits = self.hits.values.get((), 0)
+        lookups = hits + self.misses.values.get((), 0)
+        return round(hits / lookups, 4) if lookups else 0.0
+
+    def get(self, key):
+        if not key or self.max_bytes <= 0:
+            return None
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                self.items.move_to_end(key)
+        if entry is None:
+            self.misses.inc()
+            return None
+        self.hits.inc()
+        return entry[0].copy()
+
+    def put(self, key, img):
+        nbytes = img.size[0] * img.size[1] * 4
+        if not key or nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = (img, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.size -= evicted
+                self.evictions.inc()
+
+cover_cache = CoverCache(int(COVER_CACHE_MB * 1024 * 1024))
+
+# ---------- stego worker pool ----------
+_stego_pool = None
+_stego_pool_pid = None
+
+def run_stego(fn, *args):
+    """Run a CPU-heavy stego job, in the process pool when STEGO_POOL_WORKERS > 0."""
+    global _stego_pool, _stego_pool_pid
+    if STEGO_POOL_WORKERS <= 0:
+        return fn(*args)
+    # the pool is created lazily per worker process, never inherited across fork
+    if _stego_pool is None or _stego_pool_pid != os.getpid():
+        _stego_pool = ProcessPoolExecutor(max_workers=STEGO_POOL_WORKERS)
+        _stego_pool_pid = os.getpid()
+        atexit.register(_stego_pool.shutdown, wait=False)
+    return _stego_pool.submit(fn, *args).result()
+
+# ---------- request tracing ----------
+class span:
+    """Time a named stage of the current request: `with span("encrypt"): ...`"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_span(self.name, time.perf_counter() - self.t0, self.start)
+        return False
+
+def add_span(name, duration, start=None):
+    """Record an already-measured stage (e.g. timings returned from the stego pool)."""
+    memory_checkpoint()
+    if not TRACE_ENABLED:
+        return
+    spans = g.setdefault("spans", [])
+    if start is None:
+        start = time.time() - duration
+    spans.append((name, start, duration))
+
+def add_spans(timings):
+    """Record sequential (name, seconds) stage timings ending now."""
+    start = time.time() - sum(d for _, d in timings)
+    for name, duration in timings:
+        add_span(name, duration, start)
+        start += duration
+
+@app.before_request
+def _trace_start():
+    g.trace_start = time.time()
+
+@app.after_request
+def _trace_finish(response):
+    spans = g.get("spans")
+    if not spans:
+        return response
+    total = time.time() - g.trace_start
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{name};dur={duration * 1000:.1f}" for name, _, duration in spans] + [f"total;dur={total * 1000:.1f}"]
+    )
+    trace_log.info(json.dumps({
+        "route": request.url_rule.rule if request.url_rule else request.path,
+        "method": request.method,
+        "status": response.status_code,
+        "total_ms": round(total * 1000, 2),
+        "spans": {name: round(duration * 1000, 2) for name, _, duration in spans},
+        **({"mem_peak_mb": round(g.mem_peak / MB, 1)} if "mem_peak" in g else {}),
+    }))
+    if OTEL_EXPORTER_OTLP_ENDPOINT:
+        _otlp_enqueue(request.url_rule.rule if request.url_rule else request.path, g.trace_start, total, response.status_code, spans)
+    return response
+
+@app.after_request
+def _record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    HTTP_LATENCY.observe(time.time() - g.trace_start, route=route, method=request.method)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# OTLP/HTTP JSON exporter: spans are queued and posted by one background thread,
+# so a slow or missing collector never delays a response.
+_otlp_queue = queue.Queue(maxsize=1000)
+_otlp_thread = None
+
+def _otlp_enqueue(route, start, total, status, spans):
+    global _otlp_thread
+    if _otlp_thread is None or not _otlp_thread.is_alive():
+        _otlp_thread = threading.Thread(target=_otlp_worker, daemon=True)
+        _otlp_thread.start()
+    try:
+        _otlp_queue.put_nowait((route, start, total, status, list(spans)))
+    except queue.Full:
+        pass
+
+def _otlp_span(trace_id, span_id, parent_id, name, start, duration, attributes=None):
+    out = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": 2 if parent_id is None else 1,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int((start + duration) * 1e9)),
+        "attributes": [{"key": k, "value": v} for k, v in (attributes or {}).items()],
+    }
+    if parent_id:
+        out["parentSpanId"] = parent_id
     return out
 
-def extract_bytes_from_image(img: Image.Image) -> bytes:
-    """Extract encrypted payload from image using LSB steganography in RGB channels."""
-    # Convert to RGBA to ensure consistent format
-    rgba_img = img.convert("RGBA")
-    pixels = list(rgba_img.getdata())  # type: ignore
-    
-    # Extract LSB from RGB channels
-    bits = []
-    for px in pixels:
-        r, g, b, _ = px  # Alpha channel not used for extraction
-        bits.append(r & 1)  # Extract LSB from red channel
-        bits.append(g & 1)  # Extract LSB from green channel
-        bits.append(b & 1)  # Extract LSB from blue channel
-    
-    if len(bits) < 32:
-        raise ValueError("Image too small or contains no embedded data")
-    
-    # Read 32-bit length prefix
-    length = 0
-    for bit in bits[:32]:
-        length = (length << 1) | bit
-    
-    if length == 0 or length > 20000:  # Sanity check
-        raise ValueError(f"Invalid payload length: {length}")
-    
-    # Calculate total bits needed
-    total_bits_needed = 32 + length * 8
-    if total_bits_needed > len(bits):
-        raise ValueError(f"Incomplete payload in image. Need {total_bits_needed} bits, have {len(bits)}")
-    
-    # Extract payload bits (after 32-bit length prefix)
-    payload_bits = bits[32:32 + length * 8]
-    
-    # Convert bits back to bytes
-    payload_bytes = bytearray()
-    for i in range(0, len(payload_bits), 8):
-        if i + 8 > len(payload_bits):
-            break
-        byte = 0
-        for bit in payload_bits[i:i+8]:
-            byte = (byte << 1) | bit
-        payload_bytes.append(byte)
-    
-    return bytes(payload_bytes)
+def _otlp_worker():
+    if not OTEL_EXPORTER_OTLP_ENDPOINT:
+        return
+    url = OTEL_EXPORTER_OTLP_ENDPOINT.rstrip("/") + "/v1/traces"
+    while True:
+        route, start, total, status, spans = _otlp_queue.get()
+        trace_id = secrets.token_hex(16)
+        root_id = secrets.token_hex(8)
+        otel_spans = [_otlp_span(trace_id, root_id, None, route, start, total,
+                                 {"http.route": {"stringValue": route}, "http.status_code": {"intValue": status}})]
+        otel_spans += [_otlp_span(trace_id, secrets.token_hex(8), root_id, name, s_start, duration)
+                       for name, s_start, duration in spans]
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "secapp"}}]},
+            "scopeSpans": [{"scope": {"name": "secapp"}, "spans": otel_spans}],
+        }]}).encode()
+        try:
+            req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(req, timeout=2).read()
+        except Exception as e:
+            trace_log.debug(f"OTLP export failed: {e}")
+
+# ---------- request profiling ----------
+# One request at a time per worker is profiled (cProfile is process-wide on newer
+# Pythons, and it keeps the overhead bounded). Only the request thread is seen:
+# embeds running in the stego pool show up as time waiting in run_stego.
+PROFILE_TOP = 10
+_profile_lock = threading.Lock()
+
+def profile_token(seconds=300):
+    """X-Profile header value that is valid for `seconds`."""
+    if not PROFILE_SECRET:
+        raise RuntimeError("PROFILE_SECRET is not set")
+    expires = str(int(time.time() + seconds))
+    return f"{expires}.{hmac.new(PROFILE_SECRET.encode(), expires.encode(), hashlib.sha256).hexdigest()}"
+
+def _valid_profile_token(value):
+    if not PROFILE_SECRET:
+        return False
+    expires, _, sig = value.partition(".")
+    if not expires.isdigit() or not time.time() < int(expires) < time.time() + 86400:
+        return False
+    expected = hmac.new(PROFILE_SECRET.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(sig, expected)
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer; output is collapsed stacks."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+    def top(self, n):
+        """Frames with the most samples on top of the stack."""
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        total = sum(leaves.values()) or 1
+        return [f"{count / total:6.1%} {leaf}" for leaf, count in sorted(leaves.items(), key=lambda kv: -kv[1])[:n]]
+
+def _profile_top(profiler, n):
+    """The n functions with the most cumulative time, from the profiler's own entries."""
+    rows = []
+    for entry in sorted(profiler.getstats(), key=lambda e: e.totaltime, reverse=True)[:n]:
+        code = entry.code
+        where = code if isinstance(code, str) else f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        rows.append(f"{entry.totaltime * 1000:8.1f}ms cum {entry.inlinetime * 1000:8.1f}ms self {entry.callcount:>6}x {where}")
+    return rows
+
+def _profile_start():
+    header = request.headers.get("X-Profile")
+    if header and PROFILE_SECRET and _valid_profile_token(header):
+        reason = "header"
+    elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        reason = "sampled"
+    else:
+        return
+    if not _profile_lock.acquire(blocking=False):
+        return  # another request in this worker is being profiled
+    if PROFILE_FORMAT == "collapsed":
+        profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+    else:
+        profiler = cProfile.Profile()
+    g.profile = (profiler, reason, time.perf_counter())
+    profiler.enable()
+
+def _profile_stop(response=None):
+    profiler, reason, t0 = g.pop("profile")
+    try:
+        profiler.disable()
+        total = time.perf_counter() - t0
+        route = request.url_rule.rule if request.url_rule else request.path
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = secure_filename(route.strip("/").replace("/", "_")) or "index"
+        ext = ".collapsed" if isinstance(profiler, StackSampler) else ".prof"
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}-{slug}-{os.getpid()}-{secrets.token_hex(3)}{ext}")
+        if isinstance(profiler, StackSampler):
+            profiler.dump(path)
+            top = profiler.top(PROFILE_TOP)
+        else:
+            profiler.dump_stats(path)
+            top = _profile_top(profiler, PROFILE_TOP)
+        profile_log.info(json.dumps({
+            "route": route,
+            "method": request.method,
+            "status": response.status_code if response is not None else None,
+            "reason": reason,
+            "total_ms": round(total * 1000, 2),
+            "file": path,
+        }) + "".join(f"\n    {row}" for row in top))
+        if response is not None and reason == "header":
+            response.headers["X-Profile-File"] = os.path.basename(path)
+    except OSError as e:
+        profile_log.warning(f"Could not write profile: {e}")
+    finally:
+        _profile_lock.release()
+
+def _profile_finish(response):
+    if "profile" in g:
+        _profile_stop(response)
+    return response
+
+def _profile_abort(exc):
+    # the request raised before after_request ran
+    if "profile" in g:
+        _profile_stop()
+
+if PROFILE_SECRET or PROFILE_SAMPLE_RATE:
+    app.before_request(_profile_start)
+    app.after_request(_profile_finish)
+    app.teardown_request(_profile_abort)
+
+# ---------- memory accounting ----------
+# While a tracked request runs, one sampler thread per worker reads RSS every
+# MEMORY_SAMPLE_SECONDS (and every span boundary adds a sample), so short peaks
+# inside embed/extract are seen too. RSS is process-wide: requests overlapping
+# in a threaded worker see each other's memory. Work done in the stego pool
+# (STEGO_POOL_WORKERS > 0) happens in another process and is not counted here.
+MEMORY_ROUTES = {"send", "api_send", "api_reveal"}
+# Bytes per cover pixel a request needs at its peak, measured with the metric
+# below (7.8 MP cover, 1-bit RGB mode, cover cache off). The 1-bit path holds a
+# tuple per pixel, which is what dominates.
+SEND_BYTES_PER_PIXEL = 200
+REVEAL_BYTES_PER_PIXEL = 110
+MEMORY_SAMPLE_SECONDS = 0.005
+MB = 1024 * 1024
+REQUEST_MEMORY = Histogram("secapp_request_memory_peak_bytes", "Memory growth at the peak of image-handling requests.",
+                           ("route", "source"), tuple(n * MB for n in (1, 4, 16, 64, 128, 256, 512, 1024, 2048, 4096)))
+MEMORY_REJECTED = Counter("secapp_memory_rejected_total", "Image requests refused by the memory guard.", ("route", "reason"))
+_PAGE_SIZE = 4096 if sys.platform == "win32" else os.sysconf("SC_PAGE_SIZE")  # no sysconf on Windows
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+def memory_checkpoint():
+    """Fold the current RSS into this request's peak (cheap; called per span)."""
+    mem = g.get("mem")
+    if mem is not None and mem["rss0"] is not None:
+        mem["rss_peak"] = max(mem["rss_peak"], rss_bytes() or 0)
+
+_mem_active = set()  # ids of g.mem dicts of requests in flight
+_mem_requests = {}
+_mem_wake = threading.Event()
+_mem_thread = None
+_mem_pid = None
+
+def _memory_sampler():
+    while True:
+        _mem_wake.wait()
+        while _mem_active:
+            rss = rss_bytes() or 0
+            for key in list(_mem_active):
+                mem = _mem_requests.get(key)
+                if mem is not None and rss > mem["rss_peak"]:
+                    mem["rss_peak"] = rss
+            time.sleep(MEMORY_SAMPLE_SECONDS)
+        _mem_wake.clear()
+        if _mem_active:  # a request arrived between the loop and clear()
+            _mem_wake.set()
+
+def memory_guard(pixels, bytes_per_pixel):
+    """Check an image of `pixels` against the memory limits before decoding it.
+
+    Returns None, or (message, status) like admit_image: 413 when the image can
+    never fit REQUEST_MEMORY_BUDGET_MB, 503 when this worker is too full right now.
+    """
+    need = pixels * bytes_per_pixel
+    route = request.endpoint or "unmatched"
+    if REQUEST_MEMORY_BUDGET_MB and need > REQUEST_MEMORY_BUDGET_MB * MB:
+        MEMORY_REJECTED.inc(route=route, reason="budget")
+        return (f"image needs about {need // MB} MB to process, the limit is {REQUEST_MEMORY_BUDGET_MB:g} MB; "
+                f"try a smaller image", 413)
+    rss = rss_bytes() if WORKER_MEMORY_LIMIT_MB else None
+    if rss is not None and rss + need > WORKER_MEMORY_LIMIT_MB * MB:
+        MEMORY_REJECTED.inc(route=route, reason="worker")
+        print(f"Memory guard: {route} needs ~{need // MB} MB, worker RSS {rss // MB} MB of {WORKER_MEMORY_LIMIT_MB:g} MB")
+        return ("the server is busy, please try again in a moment", 503)
+    return None
+
+def _memory_start():
+    if request.endpoint not in MEMORY_ROUTES:
+        return
+    global _mem_thread, _mem_pid
+    rss = rss_bytes()
+    g.mem = {"rss0": rss, "rss_peak": rss or 0}
+    if rss is not None:
+        if _mem_thread is None or _mem_pid != os.getpid():
+            _mem_pid = os.getpid()
+            _mem_thread = threading.Thread(target=_memory_sampler, name="memory-sampler", daemon=True)
+            _mem_thread.start()
+        _mem_requests[id(g.mem)] = g.mem
+        _mem_active.add(id(g.mem))
+        _mem_wake.set()
+    if MEMORY_TRACKING == "tracemalloc":
+        # process-wide: concurrent requests in the same worker share this peak
+        tracemalloc.reset_peak()
+        g.mem["py0"] = tracemalloc.get_traced_memory()[0]
+
+def _memory_finish(response):
+    mem = g.get("mem")
+    if mem is None:
+        return response
+    memory_checkpoint()
+    _memory_release()
+    route = request.url_rule.rule if request.url_rule else request.path
+    if mem["rss0"] is not None:
+        g.mem_peak = mem["rss_peak"] - mem["rss0"]
+        REQUEST_MEMORY.observe(g.mem_peak, route=route, source="rss")
+    if "py0" in mem:
+        py_peak = max(0, tracemalloc.get_traced_memory()[1] - mem["py0"])
+        REQUEST_MEMORY.observe(py_peak, route=route, source="tracemalloc")
+        g.mem_peak = max(g.get("mem_peak", 0), py_peak)
+    return response
+
+def _memory_release(exc=None):
+    mem = g.get("mem")
+    if mem is not None:
+        _mem_active.discard(id(mem))
+        _mem_requests.pop(id(mem), None)
+
+if MEMORY_TRACKING in ("rss", "tracemalloc"):
+    if MEMORY_TRACKING == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    app.before_request(_memory_start)
+    app.after_request(_memory_finish)
+    app.teardown_request(_memory_release)  # requests that raised
+
+# ---------- rate limiting ----------
+# Endpoint -> token cost. /pairing/search is a regex scan over users and /send
+# runs a multi-second embed, so they cost the most; /send also pays one token
+# per cover megapixel once the header has been read (see send()).
+ROUTE_COSTS = {
+    "send": 5,
+    "api_send": 5,
+    "search_user": 3,
+    "login": 3,
+    "register": 3,
+    "api_reveal": 2,
+}
+RATE_LIMITED = Counter("secapp_rate_limited_total", "Requests rejected by the rate limiter.", ("route", "scope"))
+
+class TokenBuckets:
+    """In-process buckets: key -> (tokens, last refill). Oldest keys are evicted past max_keys."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, burst, rate):
+        """Spend `cost` tokens. Returns 0 if allowed, else seconds until it would be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SqliteTokenBuckets:
+    """Buckets in a SQLite file so all workers on a host draw from the same ones."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _conn(self):
+        # sqlite3 connections can't be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, cost, burst, rate):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                # a bucket idle long enough to refill completely is the same as no row
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - burst * RATE_LIMIT_IP_FACTOR / rate,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+rate_buckets = {"memory": TokenBuckets, "sqlite": lambda: SqliteTokenBuckets(RATE_LIMIT_SQLITE)}.get(RATE_LIMIT_BACKEND, lambda: None)()
+
+def client_ip():
+    if RATE_LIMIT_PROXY_HOPS:
+        hops = [h.strip() for h in request.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+        if len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return hops[-RATE_LIMIT_PROXY_HOPS]
+    return request.remote_addr or "unknown"
+
+def rate_limit(cost):
+    """Charge `cost` tokens to the caller's user and IP buckets.
+
+    Returns None when allowed, or a 429 response. The user comes straight from
+    the session cookie, so this never touches MongoDB.
+    """
+    if rate_buckets is None:
+        return None
+    route = request.endpoint or "unmatched"
+    checks = [("ip", f"ip:{client_ip()}", RATE_LIMIT_BURST * RATE_LIMIT_IP_FACTOR, RATE_LIMIT_PER_SECOND * RATE_LIMIT_IP_FACTOR)]
+    if session.get("user_id"):
+        checks.append(("user", f"user:{session['user_id']}", RATE_LIMIT_BURST, RATE_LIMIT_PER_SECOND))
+    for scope, key, burst, rate in checks:
+        wait = rate_buckets.take(key, min(cost, burst), burst, rate)
+        if wait:
+            RATE_LIMITED.inc(route=route, scope=scope)
+            resp = app.make_response(error_page(429, "rate_limited", "Slow Down",
+                "Too many requests. Please wait a moment and try again.", icon="⏳", tone="warn"))
+            resp.headers["Retry-After"] = str(int(wait) + 1)
+            return resp
+    return None
+
+@app.before_request
+def _rate_limit_request():
+    endpoint = request.endpoint
+    if endpoint is None:
+        return None  # no route matched: the 404 costs nothing
+    cost = ROUTE_COSTS.get(endpoint)
+    # rendering the login/register forms is free; submitting them is not
+    if cost and not (request.method == "GET" and endpoint in ("login", "register")):
+        return rate_limit(cost)
+
+# ---------- reveal grants ----------
+# After the recipient enters the right code on /view, /api/reveal needs to know
+# that without asking again. That used to be a secret_code_<id> key per message
+# in the signed cookie, which only ever grew. Grants now live server-side, keyed
+# by a random per-session id, and are deleted on reveal, so the cookie stays a
+# fixed size.
+class MongoGrantStore:
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def put(self, key, code_hash, seconds):
+        expires = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+        self.collection.update_one({"_id": key}, {"$set": {"code_hash": code_hash, "expires_at": expires}}, upsert=True)
+
+    def get(self, key):
+        # the TTL monitor only runs once a minute, so check expiry here too
+        doc = self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+        return doc.get("code_hash") if doc else None
+
+    def delete(self, key):
+        self.collection.delete_one({"_id": key})
+
+
+class SqliteGrantStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS grants (key TEXT PRIMARY KEY, code_hash TEXT, expires_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS grants_expiry ON grants (expires_at)")
+
+    def _conn(self):
+        # sqlite3 connections can't be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, key, code_hash, seconds):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("DELETE FROM grants WHERE expires_at < ?", (now,))
+            conn.execute("INSERT OR REPLACE INTO grants VALUES (?, ?, ?)", (key, code_hash, now + seconds))
+
+    def get(self, key):
+        row = self._conn().execute("SELECT code_hash FROM grants WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM grants WHERE key = ?", (key,))
+
+
+if (REVEAL_GRANT_STORE or ("mongo" if db is not None else "sqlite")) == "mongo" and db is not None:
+    reveal_grants = MongoGrantStore(db.get_collection("reveal_grants"))
+else:
+    reveal_grants = SqliteGrantStore(REVEAL_GRANT_SQLITE)
+
+def _grant_key(message_id):
+    sid = session.get("sid")
+    if not sid:
+        sid = session["sid"] = secrets.token_urlsafe(12)
+    return f"{sid}:{message_id}"
+
+def grant_reveal(message_id, code_hash):
+    reveal_grants.put(_grant_key(message_id), code_hash, REVEAL_GRANT_SECONDS)
+
+def reveal_grant(message_id):
+    """Hash of the code accepted for this message in this session, or None."""
+    return reveal_grants.get(_grant_key(message_id)) if session.get("sid") else None
+
+def revoke_reveal(message_id):
+    if session.get("sid"):
+        reveal_grants.delete(_grant_key(message_id))
+
+@app.before_request
+def _drop_legacy_code_keys():
+    # cookies issued before grants moved server-side still carry secret_code_<id> keys
+    if any(k.startswith("secret_code_") for k in session):
+        for k in [k for k in session if k.startswith("secret_code_")]:
+            session.pop(k)
+
+# ---------- batched clears ----------
+# Deletes go out in _id chunks so no single delete_many holds locks for long,
+# and the stego PNGs those messages pointed at are unlinked off the request thread.
+_unlink_queue = queue.Queue()
+_unlink_thread = None
+_unlink_pid = None
+
+def _unlink_worker():
+    upload_root = os.path.realpath(UPLOAD_DIR)
+    while True:
+        path = os.path.realpath(_unlink_queue.get())
+        if os.path.dirname(path) != upload_root:
+            continue  # only ever remove files this app wrote
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already removed on reveal
+        except OSError as e:
+            print(f"Could not remove {path}: {e}")
+
+def queue_unlink(paths):
+    """Remove image files in the background (best-effort)."""
+    global _unlink_thread, _unlink_pid
+    if _unlink_thread is None or _unlink_pid != os.getpid():
+        _unlink_pid = os.getpid()
+        _unlink_thread = threading.Thread(target=_unlink_worker, name="unlink", daemon=True)
+        _unlink_thread.start()
+    for path in paths:
+        if path:
+            _unlink_queue.put(path)
+
+def _clear_batch(query):
+    """Delete up to CLEAR_BATCH matching messages. Returns (deleted, more_left)."""
+    if messages is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    docs = list(messages.find(query, {"_id": 1, "viewed": 1, "image_path": 1, "display_path": 1})
+                .sort("_id", 1).limit(CLEAR_BATCH))
+    if not docs:
+        return 0, False
+    ids = {"$in": [d["_id"] for d in docs]}
+    # deleted separately by state so the counters match what was really removed,
+    # even if a message was revealed in between (viewed is never unset)
+    viewed = messages.delete_many({"_id": ids, "viewed": True}).deleted_count
+    unread = 0
+    if not all(d.get("viewed") for d in docs):
+        unread = messages.delete_many({"_id": ids, "viewed": {"$ne": True}}).deleted_count
+    bump_counts(query["recipient"], unread=-unread, viewed=-viewed)
+    queue_unlink(p for d in docs for p in (d.get("image_path"), d.get("display_path")))
+    return viewed + unread, len(docs) == CLEAR_BATCH
+
+def _clear_rest(job_id, query, deleted):
+    if db is None:
+        return
+    more = True
+    try:
+        while more:
+            n, more = _clear_batch(query)
+            deleted += n
+            db.jobs.update_one({"_id": job_id}, {"$set": {"deleted": deleted, "done": not more}})
+    except PyMongoError as e:
+        print(f"Clear job {job_id} stopped after {deleted} message(s): {e}")
+        try:
+            db.jobs.update_one({"_id": job_id}, {"$set": {"done": True, "error": str(e)}})
+        except PyMongoError:
+            pass
+
+def start_clear(email, query):
+    """Clear the first batch inline and the rest in the background.
+
+    Returns (deleted_so_far, job_id); job_id is None when everything fit in one batch.
+    Only messages that existed when the clear started are touched.
+    """
+    if db is None:
+        raise ConnectionFailure(NOT_CONNECTED)
+    now = datetime.now(timezone.utc)
+    query = {**query, "recipient": email, "created_at": {"$lte": now}}
+    deleted, more = _clear_batch(query)
+    if not more:
+        return deleted, None
+    job_id = f"clear:{secrets.token_urlsafe(8)}"
+    db.jobs.insert_one({"_id": job_id, "kind": "clear", "user": email, "deleted": deleted,
+                        "done": False, "started_at": now, "expires_at": now + timedelta(hours=1)})
+    threading.Thread(target=_clear_rest, args=(job_id, query, deleted), name="clear", daemon=True).start()
+    return deleted, job_id
+
+def clear_redirect(deleted, job_id):
+    if wants_json():
+        return jsonify({"status": "clearing" if job_id else "cleared", "deleted": deleted, "job": job_id})
+    if job_id:
+        return redirect(url_for("index", cleared=deleted, clearing=job_id))
+    return redirect(url_for("index", cleared=deleted))
+
+# ---------- status pages ----------
+# One compiled, autoescaped template for every error/notice page. The styling
+# lives in a single stylesheet served with a long cache lifetime, so repeated
+# error pages cost a few hundred bytes instead of a full inline <style> block.
+PAGE_CSS = """
+*{margin:0;padding:0;box-sizing:border-box}
+body{font-family:'Segoe UI',Tahoma,Geneva,Verdana,sans-serif;background:linear-gradient(135deg,#667eea 0%,#764ba2 25%,#f093fb 50%,#4facfe 75%,#00f2fe 100%);background-size:400% 400%;animation:bg 15s ease infinite;min-height:100vh;display:flex;align-items:center;justify-content:center;padding:20px}
+@keyframes bg{0%{background-position:0% 50%}50%{background-position:100% 50%}100%{background-position:0% 50%}}
+.page{background:rgba(255,255,255,.95);border-radius:20px;box-shadow:0 20px 60px rgba(0,0,0,.3);padding:40px;max-width:500px;width:100%;text-align:center}
+.icon{font-size:2.5em;margin-bottom:10px}
+h2{color:#764ba2;margin-bottom:20px}
+.error h2{color:#c33}.warn h2{color:#b7791f}.ok h2{color:#2f855a}
+p{color:#666;margin:10px 0;line-height:1.6}
+.notice{padding:15px;border-radius:8px;margin:20px 0;text-align:left;background:#e3f2fd;border-left:4px solid #2196f3;color:#1565c0}
+.error .notice{background:#fee;border-left-color:#c33;color:#c33}
+.warn .notice{background:#fff3cd;border-left-color:#ffc107;color:#856404}
+.ok .notice{background:#e8f5e9;border-left-color:#4caf50;color:#2e7d32}
+form{margin-top:20px;text-align:left}
+label{display:block;margin:15px 0 5px;color:#555;font-weight:600}
+input{width:100%;padding:12px;border:2px solid #ddd;border-radius:8px;font-size:16px}
+input:focus{outline:none;border-color:#667eea}
+button,a.button{display:inline-block;margin-top:20px;padding:12px 24px;background:linear-gradient(135deg,#667eea,#764ba2);color:#fff;border:none;border-radius:8px;font-size:16px;font-weight:600;cursor:pointer;text-decoration:none}
+button{width:100%}
+"""
+PAGE_CSS_ETAG = hashlib.sha256(PAGE_CSS.encode()).hexdigest()[:16]
+
+PAGE_HTML = """<!doctype html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>{{ heading }}</title><link rel="stylesheet" href="/assets/page.css?v={{ css_version }}"></head>
+<body><div class="page {{ tone }}"><div class="icon">{{ icon }}</div><h2>{{ heading }}</h2>
+{% if notice %}<div class="notice">{{ notice }}</div>{% endif %}
+{% for p in paragraphs %}<p>{{ p }}</p>{% endfor %}
+{% if form_action %}<form action="{{ form_action }}" method="post"><label>Secret Code:</label>
+<input type="text" name="secret_code" placeholder="e.g., kiwi" required autofocus><button type="submit">🔓 View Message</button></form>
+{% else %}<a href="/" class="button">{{ back_label }}</a>{% endif %}
+</div></body></html>"""
+_page_template = app.jinja_env.from_string(PAGE_HTML)
+
+TONE_ICONS = {"error": "❌", "warn": "⚠️", "ok": "✅", "info": "ℹ️"}
+
+
+def wants_json():
+    """True for XHR/fetch callers that asked for JSON rather than a page."""
+    if request.path.startswith("/api/v1/") or request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return True
+    best = request.accept_mimetypes.best_match(["text/html", "application/json"])
+    return best == "application/json" and request.accept_mimetypes[best] > request.accept_mimetypes["text/html"]
+
+
+def error_page(status, code, heading, *paragraphs, icon=None, tone="error", notice=None,
+               form_action=None, back_label="← Back", json_status=None, **data):
+    """Render a status page, or a compact JSON body for API-style callers.
+
+    `code` is a stable machine-readable identifier. Text arguments are escaped;
+    wrap trusted markup in Markup(...) with the values passed through .format().
+    `json_status` overrides the HTTP status for JSON only (e.g. 401 for the
+    code prompt), since the HTML pages keep their historical statuses. Extra
+    keyword arguments are added to the JSON body only.
+    """
+    if wants_json():
+        text = " ".join(Markup(t).striptags() for t in (notice, *paragraphs) if t)
+        key = "error" if (json_status or status) >= 400 else "status"
+        return jsonify({key: code, "message": text or heading, **data}), json_status or status
+    html = _page_template.render(
+        heading=heading, paragraphs=paragraphs, icon=icon or TONE_ICONS.get(tone, ""), tone=tone,
+        notice=notice, form_action=form_action, back_label=back_label, css_version=PAGE_CSS_ETAG,
+    )
+    return html, status
+
+
+def action_done(code, status=200, **data):
+    """Finish a form action: back to the dashboard, or a JSON status for API callers."""
+    if wants_json():
+        return jsonify({"status": code, **data}), status
+    return redirect(url_for('index'))
+
+
+@app.route("/assets/page.css")
+def page_css():
+    resp = app.response_class(PAGE_CSS, mimetype="text/css")
+    resp.set_etag(PAGE_CSS_ETAG)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp.make_conditional(request)
 
 # ---------- routes ----------
 INDEX_HTML = """
@@ -473,7 +2048,7 @@ INDEX_HTML = """
     {% endif %}
     <hr>
     <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px; flex-wrap: wrap; gap: 10px;">
-      <h3 style="margin: 0;">📥 Your Inbox</h3>
+      <h3 style="margin: 0;">📥 Your Inbox <span id="unread-badge" title="unread" style="background: #f44336; color: white; border-radius: 10px; padding: 2px 8px; font-size: 13px; vertical-align: middle;{% if not counts.unread %} display: none;{% endif %}">{{ counts.unread }}</span></h3>
       {% if inbox %}
         {% set viewed_count = inbox|selectattr('viewed')|list|length %}
         {% set total_count = inbox|length %}
@@ -493,7 +2068,25 @@ INDEX_HTML = """
         {% endif %}
       {% endif %}
     </div>
-    {% if request.args.get('cleared') %}
+    {% if request.args.get('clearing') %}
+      <div id="clear-progress" data-job="{{ request.args.get('clearing') }}" style="background: #fff3cd; color: #856404; padding: 12px; border-radius: 8px; margin-bottom: 15px; border-left: 4px solid #ffc107;">
+        ⏳ Clearing messages... <span id="clear-count">{{ request.args.get('cleared') }}</span> removed so far.
+      </div>
+      <script>
+      (function () {
+        var box = document.getElementById('clear-progress');
+        var timer = setInterval(function () {
+          fetch('/api/v1/clear/' + encodeURIComponent(box.dataset.job), {credentials: 'same-origin'})
+            .then(function (r) { return r.ok ? r.json() : null; })
+            .then(function (job) {
+              if (!job) return clearInterval(timer);
+              document.getElementById('clear-count').textContent = job.deleted;
+              if (job.done) { clearInterval(timer); location.replace('/?cleared=' + job.deleted); }
+            });
+        }, 1000);
+      })();
+      </script>
+    {% elif request.args.get('cleared') %}
       <div style="background: #d4edda; color: #155724; padding: 12px; border-radius: 8px; margin-bottom: 15px; border-left: 4px solid #28a745;">
         ✅ Successfully cleared {{ request.args.get('cleared') }} message(s)!
       </div>
@@ -507,7 +2100,7 @@ INDEX_HTML = """
       {% if inbox %}
         <ul>
         {% for m in inbox %}
-          <li>
+          <li data-id="{{ m['message_id'] }}">
             <strong>From:</strong> {{ m['sender_email'] }} → <strong>You</strong><br>
             <strong>ID:</strong> {{ m['message_id'] }}<br>
             <strong>Created:</strong> {{ m['created_at'] }}<br>
@@ -525,6 +2118,77 @@ INDEX_HTML = """
         <p style="text-align: center; color: #999; padding: 20px;">No messages yet! 🎉</p>
       {% endif %}
     </div>
+    <div id="pairing-notice" style="display: none; background: #e3f2fd; color: #1565c0; padding: 12px; border-radius: 8px; margin-top: 15px; border-left: 4px solid #2196f3;">
+      🤝 Pairing requests changed. <a href="/">Reload</a> to see them.
+    </div>
+    <script>
+    // Live inbox: server-sent events, or polling the counters and fetching /api/v1/inbox
+    // (ETag) only when they moved, when streams are unavailable
+    (function () {
+      var box = document.querySelector('.inbox');
+      var badge = document.getElementById('unread-badge');
+      var lastCounts = '{{ counts.unread }}/{{ counts.viewed }}';
+      function fetchCounts() {
+        return fetch('/api/inbox/count', {cache: 'no-cache', credentials: 'same-origin'})
+          .then(function (r) { return r.ok ? r.json() : null; })
+          .then(function (c) {
+            if (!c) return false;
+            badge.textContent = c.unread;
+            badge.style.display = c.unread ? '' : 'none';
+            var changed = c.unread + '/' + c.viewed !== lastCounts;
+            lastCounts = c.unread + '/' + c.viewed;
+            return changed;
+          })
+          .catch(function () { return false; });
+      }
+      function markViewed(id) {
+        var li = box.querySelector('li[data-id="' + CSS.escape(id) + '"]');
+        var link = li && li.querySelector('a');
+        if (!link) return;
+        var span = document.createElement('span');
+        span.style.color = '#999';
+        span.textContent = '(already viewed - message deleted)';
+        link.replaceWith(span);
+      }
+      function addMessage(m) {
+        if (m.viewed) return markViewed(m.id);
+        if (box.querySelector('li[data-id="' + CSS.escape(m.id) + '"]')) return;
+        var ul = box.querySelector('ul');
+        if (!ul) { box.innerHTML = ''; ul = box.appendChild(document.createElement('ul')); }
+        var li = document.createElement('li');
+        li.dataset.id = m.id;
+        [['From:', m.from + ' → You'], ['ID:', m.id], ['Created:', (m.at || '').slice(0, 16).replace('T', ' ')]].forEach(function (row) {
+          var b = li.appendChild(document.createElement('strong'));
+          b.textContent = row[0];
+          li.appendChild(document.createTextNode(' ' + row[1]));
+          li.appendChild(document.createElement('br'));
+        });
+        var a = li.appendChild(document.createElement('a'));
+        a.href = '/view/' + encodeURIComponent(m.token);
+        a.textContent = '👁️ View Message';
+        a.style.cssText = 'display: inline-block; margin-top: 10px; padding: 10px 20px; background: linear-gradient(135deg, #667eea, #764ba2); color: white; text-decoration: none; border-radius: 8px; font-weight: 600;';
+        ul.insertBefore(li, ul.firstChild);
+      }
+      function fetchInbox() {
+        fetch('/api/v1/inbox', {cache: 'no-cache', credentials: 'same-origin'})
+          .then(function (r) { return r.ok ? r.json() : null; })
+          .then(function (data) { if (data) data.messages.slice().reverse().forEach(addMessage); })
+          .catch(function () {});
+      }
+      function poll() { fetchCounts().then(function (changed) { if (changed) fetchInbox(); }); }
+      function pairingChanged() { document.getElementById('pairing-notice').style.display = 'block'; }
+      var polling = null;
+      function startPolling() { if (!polling) polling = setInterval(poll, 30000); }
+      if (!window.EventSource) return startPolling();
+      var es = new EventSource('/api/v1/events');
+      es.addEventListener('message', function (e) { addMessage(JSON.parse(e.data)); fetchCounts(); });
+      es.addEventListener('viewed', function (e) { markViewed(JSON.parse(e.data).id); fetchCounts(); });
+      es.addEventListener('pairing_request', pairingChanged);
+      es.addEventListener('paired', pairingChanged);
+      es.addEventListener('ready', function () { fetchCounts(); fetchInbox(); });  // catch up after a reconnect
+      es.onerror = function () { if (es.readyState === EventSource.CLOSED) startPolling(); };
+    })();
+    </script>
   {% else %}
     <div class="nav-links">
       <a href="/register">✨ Register</a>
@@ -829,11 +2493,12 @@ def index():
     pairing_code = None
     pairing_requests = []
     partners = []
+    counts = dict.fromkeys(COUNT_FIELDS, 0)
     
     if user:
         try:
             # Get inbox messages
-            for doc in messages.find({"recipient": user["email"]}).sort("created_at", -1):
+            for doc in inbox_for(user["email"]):
                 inbox.append({
                     "message_id": doc["message_id"],
                     "sender_email": doc.get("sender"),
@@ -847,26 +2512,20 @@ def index():
             
             # Get pairing requests (pending, where user is recipient)
             if pairings is not None:
-                for req in pairings.find({"user2_email": user["email"], "status": "pending"}):
+                for req in pending_requests_for(user["email"]):
                     pairing_requests.append({
                         "id": str(req["_id"]),
                         "from_email": req.get("user1_email"),
                         "created_at": req.get("created_at").strftime("%Y-%m-%d %H:%M") if req.get("created_at") else "N/A"
                     })
                 
-                # Get paired partners with their secret codes
-                for pair in pairings.find({
-                    "$or": [
-                        {"user1_email": user["email"], "status": "paired"},
-                        {"user2_email": user["email"], "status": "paired"}
-                    ]
-                }):
-                    partner_email = pair["user2_email"] if pair["user1_email"] == user["email"] else pair["user1_email"]
+                # Paired partners, from the user document
+                for entry in user_partners(user):
                     partners.append({
-                        "email": partner_email,
-                        "pairing_id": str(pair["_id"]),
-                        "secret_code_hash": pair.get("secret_code_hash")
+                        "email": entry["email"],
+                        "pairing_id": entry["pairing_id"],
                     })
+            counts = user_counts(user)
         except (ServerSelectionTimeoutError, ConnectionFailure):
             return get_db_error_msg()
     
@@ -875,7 +2534,8 @@ def index():
                                  inbox=inbox, 
                                  pairing_code=pairing_code,
                                  pairing_requests=pairing_requests,
-                                 partners=partners)
+                                 partners=partners,
+                                 counts=counts)
 
 @app.route("/clear-logs", methods=["POST"])
 def clear_logs():
@@ -887,24 +2547,9 @@ def clear_logs():
         return redirect(url_for("index"))
     
     try:
-        # Delete all viewed messages for this user
-        # This query covers:
-        # 1. Messages with viewed: True
-        # 2. Messages with viewed_at timestamp (even if viewed field is missing)
-        # 3. Expired messages (older than 24 hours)
-        expired_cutoff = datetime.now(timezone.utc) - timedelta(hours=24)
-        
-        result = messages.delete_many({
-            "recipient": user["email"],
-            "$or": [
-                {"viewed": True},
-                {"viewed_at": {"$exists": True}},
-                {"viewed_at": {"$lt": expired_cutoff}}
-            ]
-        })
-        
-        deleted_count = result.deleted_count
-        return redirect(url_for("index") + f"?cleared={deleted_count}")
+        # Viewed messages. viewed and viewed_at are always set together on reveal,
+        # so a plain equality on viewed (indexed with recipient) finds them all.
+        return clear_redirect(*start_clear(user["email"], {"viewed": True}))
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
     except Exception as e:
@@ -922,10 +2567,7 @@ def clear_all():
     
     try:
         # Delete ALL messages for this user (viewed and unviewed)
-        result = messages.delete_many({
-            "recipient": user["email"]
-        })
-        return redirect(url_for("index") + f"?cleared={result.deleted_count}")
+        return clear_redirect(*start_clear(user["email"], {}))
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
     except Exception as e:
@@ -955,17 +2597,22 @@ def register():
         return render_template_string(REGISTER_HTML, error="❌ Password must be at least 3 characters")
     
     try:
-        if users.find_one({"email": email}):
+        with Q_AUTH.timeout():
+            existing = Q_AUTH.users.find_one({"email": email})
+        if existing:
             return render_template_string(REGISTER_HTML, error="❌ This email is already registered. Try logging in instead!")
+        t0 = time.perf_counter()
         pw_hash = bcrypt.hashpw(pw, bcrypt.gensalt())
+        BCRYPT_LATENCY.observe(time.perf_counter() - t0, op="hash")
         uid = secrets.token_urlsafe(12)
         pairing_code = secrets.token_urlsafe(8).upper()  # Generate pairing code
-        users.insert_one({
-            "_id": uid,
-            "email": email,
-            "password": pw_hash,
-            "pairing_code": pairing_code
-        })
+        with Q_AUTH.timeout():
+            Q_AUTH.users.insert_one({
+                "_id": uid,
+                "email": email,
+                "password": pw_hash,
+                "pairing_code": pairing_code
+            })
         session['user_id'] = uid
         session.permanent = True  # Make session persistent
         return redirect(url_for('index'))
@@ -996,10 +2643,14 @@ def login():
     
     pw = pw_val.encode()
     try:
-        u = users.find_one({"email": email})
+        with Q_AUTH.timeout():
+            u = Q_AUTH.users.find_one({"email": email})
         if not u:
             return render_template_string(LOGIN_HTML, error="❌ Invalid email or password. Please try again or register a new account.")
-        if not bcrypt.checkpw(pw, u.get('password', b'')):
+        t0 = time.perf_counter()
+        pw_ok = bcrypt.checkpw(pw, u.get('password', b''))
+        BCRYPT_LATENCY.observe(time.perf_counter() - t0, op="check")
+        if not pw_ok:
             return render_template_string(LOGIN_HTML, error="❌ Invalid email or password. Please try again or register a new account.")
         session['user_id'] = u['_id']
         session.permanent = True  # Make session persistent
@@ -1050,106 +2701,48 @@ def request_pairing():
         return get_db_error_msg()
     user = current_user()
     if not user:
-        return "login required", 401
+        return error_page(401, "login_required", "Login Required", "Please log in first.")
     
-    partner_email = (request.form.get("partner_email") or "").strip().lower()
-    secret_code = (request.form.get("secret_code") or "").strip()
+    partner_email = request_field("partner_email").strip().lower()
+    secret_code = request_field("secret_code").strip()
     
     if not partner_email:
-        error_html = """
-        <!doctype html>
-        <html><head><meta charset="utf-8"><title>Error</title></head>
-        <body style="font-family: Arial; padding: 50px; text-align: center;">
-        <h2>❌ Partner Email Required</h2>
-        <p>Please enter the email address of the user you want to pair with.</p>
-        <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-        </body></html>
-        """
-        return error_html, 400
+        return error_page(400, "partner_email_required", "Partner Email Required",
+            "Please enter the email address of the user you want to pair with.")
     if not secret_code:
-        error_html = """
-        <!doctype html>
-        <html><head><meta charset="utf-8"><title>Error</title></head>
-        <body style="font-family: Arial; padding: 50px; text-align: center;">
-        <h2>❌ Secret Code Required</h2>
-        <p>Please enter a secret code that you and your partner will both know.</p>
-        <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-        </body></html>
-        """
-        return error_html, 400
+        return error_page(400, "secret_code_required", "Secret Code Required",
+            "Please enter a secret code that you and your partner will both know.")
     
     try:
         # Find user by email
         partner = users.find_one({"email": partner_email})
         if not partner:
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>User Not Found</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>❌ User Not Found</h2>
-            <p>The user with email <strong>{}</strong> does not exist.</p>
-            <p>Make sure they have registered an account first.</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """.format(partner_email)
-            return error_html, 404
+            return error_page(404, "user_not_found", "User Not Found",
+                Markup("The user with email <strong>{}</strong> does not exist.").format(partner_email),
+                "Make sure they have registered an account first.")
         
         if partner.get('email') == user.get('email'):
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Error</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>❌ Cannot Pair With Yourself</h2>
-            <p>You cannot send a pairing request to yourself.</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """
-            return error_html, 400
+            return error_page(400, "cannot_pair_with_self", "Cannot Pair With Yourself",
+                "You cannot send a pairing request to yourself.")
         
         # Check if already paired
-        existing = pairings.find_one({
-            "$or": [
-                {"user1_email": user.get('email'), "user2_email": partner.get('email'), "status": "paired"},
-                {"user1_email": partner.get('email'), "user2_email": user.get('email'), "status": "paired"}
-            ]
-        })
+        existing = find_pairing(user.get('email'), partner.get('email'), "paired")
         if existing:
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Already Paired</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>✅ Already Paired</h2>
-            <p>You are already paired with <strong>{}</strong>.</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """.format(partner_email)
-            return error_html, 400
+            return error_page(400, "already_paired", "Already Paired",
+                Markup("You are already paired with <strong>{}</strong>.").format(partner_email), icon="✅", tone="ok")
         
         # Check if request already exists
-        existing_request = pairings.find_one({
-            "$or": [
-                {"user1_email": user.get('email'), "user2_email": partner.get('email'), "status": "pending"},
-                {"user1_email": partner.get('email'), "user2_email": user.get('email'), "status": "pending"}
-            ]
-        })
+        existing_request = find_pairing(user.get('email'), partner.get('email'), "pending")
         if existing_request:
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Request Already Exists</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>⏳ Pairing Request Already Exists</h2>
-            <p>A pairing request between you and <strong>{}</strong> is already pending.</p>
-            <p>Please wait for them to accept or reject the existing request.</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """.format(partner_email)
-            return error_html, 400
+            return error_page(400, "pairing_request_exists", "Pairing Request Already Exists",
+                Markup("A pairing request between you and <strong>{}</strong> is already pending.").format(partner_email),
+                "Please wait for them to accept or reject the existing request.", icon="⏳", tone="warn")
         
         # Store secret code hash for verification
         secret_hash = hashlib.sha256(secret_code.encode()).hexdigest()
         
         # Create pairing request with secret code
-        pairings.insert_one({
+        result = pairings.insert_one({
             "user1_email": user['email'],
             "user2_email": partner['email'],
             "status": "pending",
@@ -1157,7 +2750,8 @@ def request_pairing():
             "secret_code_hash": secret_hash,  # Store hash of secret code
             "created_at": datetime.now(timezone.utc)
         })
-        return redirect(url_for('index'))
+        bump_counts(partner['email'], pending=1)
+        return action_done("pending", 201, id=str(result.inserted_id))
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
 
@@ -1167,92 +2761,57 @@ def accept_pairing(request_id):
         return get_db_error_msg()
     user = current_user()
     if not user:
-        return "login required", 401
+        return error_page(401, "login_required", "Login Required", "Please log in first.")
     
-    secret_code = (request.form.get("secret_code") or "").strip()
+    secret_code = request_field("secret_code").strip()
     if not secret_code:
-        error_html = """
-        <!doctype html>
-        <html><head><meta charset="utf-8"><title>Error</title></head>
-        <body style="font-family: Arial; padding: 50px; text-align: center;">
-        <h2>❌ Secret Code Required</h2>
-        <p>Please enter the secret code to accept the pairing request.</p>
-        <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-        </body></html>
-        """
-        return error_html, 400
+        return error_page(400, "secret_code_required", "Secret Code Required",
+            "Please enter the secret code to accept the pairing request.")
     
     try:
         # Find the pairing request
-        try:
-            pairing = pairings.find_one({"_id": ObjectId(request_id)})
-        except Exception:
-            # Try as string if ObjectId fails
-            pairing = pairings.find_one({"_id": request_id})
+        pairing = pairings.find_one(pairing_id_filter(request_id))
         
         if not pairing:
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Error</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>❌ Pairing Request Not Found</h2>
-            <p>The pairing request may have expired or been deleted.</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """
-            return error_html, 404
+            return error_page(404, "pairing_request_not_found", "Pairing Request Not Found",
+                "The pairing request may have expired or been deleted.")
         
         # Check if user is the recipient
         if pairing.get('user2_email') != user.get('email'):
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Access Denied</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>⚠️ Access Denied</h2>
-            <p>This pairing request was sent to someone else. You can only accept requests sent to you.</p>
-            <p><strong>Expected recipient:</strong> {}</p>
-            <p><strong>Your email:</strong> {}</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """.format(pairing.get('user2_email', 'Unknown'), user.get('email', 'Unknown'))
-            return error_html, 403
+            return error_page(403, "not_your_pairing_request", "Access Denied",
+                "This pairing request was sent to someone else. You can only accept requests sent to you.",
+                Markup("<strong>Expected recipient:</strong> {}").format(pairing.get('user2_email', 'Unknown')),
+                Markup("<strong>Your email:</strong> {}").format(user.get('email', 'Unknown')), icon="⚠️")
         
         # Verify secret code
         secret_hash = hashlib.sha256(secret_code.encode()).hexdigest()
         stored_hash = pairing.get('secret_code_hash')
         if stored_hash and stored_hash != secret_hash:
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Invalid Secret Code</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>❌ Invalid Secret Code</h2>
-            <p>The secret code you entered is incorrect. Please enter the exact code that the sender provided.</p>
-            <p><strong>Tip:</strong> Make sure you're using the same secret code that was used when the pairing request was created.</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back to Try Again</a>
-            </body></html>
-            """
-            return error_html, 403
+            return error_page(403, "invalid_secret_code", "Invalid Secret Code",
+                "The secret code you entered is incorrect. Please enter the exact code that the sender provided.",
+                Markup("<strong>Tip:</strong> Make sure you're using the same secret code that was used when the pairing request was created."),
+                back_label="← Back to Try Again")
         
-        # Store the secret code hash with pairing (for message decryption)
-        try:
-            pairings.update_one(
-                {"_id": ObjectId(request_id)},
-                {"$set": {
-                    "status": "paired", 
-                    "accepted_at": datetime.now(timezone.utc),
-                    "secret_code_hash": secret_hash  # Store for later use
-                }}
-            )
-        except:
-            pairings.update_one(
-                {"_id": request_id},
-                {"$set": {
-                    "status": "paired", 
-                    "accepted_at": datetime.now(timezone.utc),
-                    "secret_code_hash": secret_hash
-                }}
-            )
-        return redirect(url_for('index'))
+        # Store the secret code hash with pairing (for message decryption).
+        # A pending request flips to paired; re-accepting a paired one is a no-op retry
+        # that finishes a partial link. A concurrent reject deletes the request, so it wins cleanly.
+        update = {
+            "status": "paired", 
+            "accepted_at": pairing.get("accepted_at") or datetime.now(timezone.utc),
+            "secret_code_hash": secret_hash  # Store for later use
+        }
+        before = pairings.find_one_and_update(
+            {"_id": pairing["_id"], "status": {"$in": ["pending", "paired"]}},
+            {"$set": update},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if not before:
+            return error_page(404, "pairing_request_not_found", "Pairing Request Not Found",
+                "The pairing request may have expired or been deleted.")
+        if before["status"] == "pending":
+            bump_counts(user['email'], pending=-1)
+        link_partners({**before, **update})
+        return action_done("paired", id=str(pairing["_id"]), partner=pairing.get("user1_email"))
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
 
@@ -1262,25 +2821,25 @@ def reject_pairing(request_id):
         return get_db_error_msg()
     user = current_user()
     if not user:
-        return "login required", 401
+        return error_page(401, "login_required", "Login Required", "Please log in first.")
     
     try:
-        try:
-            pairing = pairings.find_one({"_id": ObjectId(request_id)})
-        except:
-            pairing = pairings.find_one({"_id": request_id})
+        pairing = pairings.find_one(pairing_id_filter(request_id))
         
         if not pairing:
-            return "Pairing request not found", 404
+            return error_page(404, "pairing_request_not_found", "Pairing Request Not Found",
+                "The pairing request may have expired or been deleted.")
         
         if pairing['user2_email'] != user['email']:
-            return "Not authorized", 403
+            return error_page(403, "not_your_pairing_request", "Access Denied",
+                "You can only reject pairing requests sent to you.", icon="⚠️")
         
-        try:
-            pairings.delete_one({"_id": ObjectId(request_id)})
-        except:
-            pairings.delete_one({"_id": request_id})
-        return redirect(url_for('index'))
+        # only pending requests; an accepted pairing is already on both users' partner lists
+        if not pairings.delete_one({"_id": pairing["_id"], "status": "pending"}).deleted_count:
+            return error_page(404, "pairing_request_not_found", "Pairing Request Not Found",
+                "The pairing request may have expired or been deleted.")
+        bump_counts(user['email'], pending=-1)
+        return action_done("rejected", id=str(pairing["_id"]))
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
 
@@ -1290,175 +2849,127 @@ def send():
         return get_db_error_msg()
     user = current_user()
     if not user:
-        return "login required", 401
+        return error_page(401, "login_required", "Login Required", "Please log in first.")
     recipient = (request.form.get("recipient") or "").strip().lower()
     secret_val = request.form.get("secret") or ""
     secret_text = secret_val.encode()
     file = request.files.get("image")
     if not file or not recipient or not secret_text:
-        return "missing fields", 400
+        return error_page(400, "missing_fields", "Missing Fields",
+            "A recipient, a secret and a cover image are all required.")
+    with span("admission"):
+        img, error = admit_image(file)
+    if img is None:
+        message, status = error or ("unsupported or corrupt image", 400)
+        return error_page(status, "image_rejected", "Image Rejected", message)
+    # bigger covers cost more; charged from the header, before any decode or query
+    limited = rate_limit(img.size[0] * img.size[1] / 1_000_000)
+    if limited:
+        return limited
+    error = memory_guard(img.size[0] * img.size[1], SEND_BYTES_PER_PIXEL)
+    if error:
+        resp = app.make_response(error_page(error[1], "image_rejected" if error[1] == 413 else "server_busy",
+                                            "Image Rejected" if error[1] == 413 else "Server Busy", error[0]))
+        if error[1] == 503:
+            resp.headers["Retry-After"] = "5"
+        return resp
     try:
-        # ensure recipient exists
-        rec = users.find_one({"email": recipient})
-        if not rec:
-            return "recipient not found (they must register first)", 404
-        
-        # Check if users are paired
-        if pairings is None:
-            return get_db_error_msg()
-        
-        paired = pairings.find_one({
-            "$or": [
-                {"user1_email": user['email'], "user2_email": recipient, "status": "paired"},
-                {"user1_email": recipient, "user2_email": user['email'], "status": "paired"}
-            ]
-        })
+        # Check if users are paired (from the user doc; a partner is always a registered user)
+        with span("pairing_lookup"):
+            source = "user_doc" if "partners" in user else "pairings"
+            paired = next((p for p in user_partners(user) if p["email"] == recipient), None)
+        PAIRING_LOOKUPS.inc(source=source, result="paired" if paired else "not_paired")
         if not paired:
-            error_html = """
-            <!doctype html>
-            <html><head><meta charset="utf-8"><title>Pairing Required</title></head>
-            <body style="font-family: Arial; padding: 50px; text-align: center;">
-            <h2>❌ Pairing Required</h2>
-            <p>You must be paired with this user to send messages.</p>
-            <p>Go back and request a pairing first!</p>
-            <a href="/" style="display: inline-block; margin-top: 20px; padding: 10px 20px; background: #667eea; color: white; text-decoration: none; border-radius: 5px;">← Back</a>
-            </body></html>
-            """
-            return error_html, 403
+            # only the error path needs to know whether the recipient exists at all
+            with span("recipient_lookup"):
+                rec = users.find_one({"email": recipient}, {"_id": 1})
+            if not rec:
+                return error_page(404, "recipient_not_found", "Recipient Not Found",
+                    "The recipient must register first.")
+            return error_page(403, "pairing_required", "Pairing Required",
+                "You must be paired with this user to send messages.", "Go back and request a pairing first!")
         
         # Get the secret code hash from pairing for message decryption
-        secret_code_hash = paired.get('secret_code_hash')
+        secret_code_hash = paired.get('code_hash')
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
 
     # encrypt secret
-    cipher = fernet.encrypt(secret_text)
+    with span("encrypt"):
+        cipher = seal_payload(secret_text)
 
-    # embed into image - ensure we read from the beginning of the stream
-    file.stream.seek(0)  # Reset stream to beginning
-    img = Image.open(file.stream)
-    # Ensure image is loaded into memory
-    img.load()
-    
-    try:
-        stego = embed_bytes_in_image(img, cipher)
-        # Verify embedding worked by checking image was modified
-        if stego.size != img.size:
-            return "Error: Stego image size mismatch", 500
-    except Exception as e:
-        return f"embed error: {e}", 400
+    # capacity is known from the header dimensions, so reject before decoding
+    if len(cipher) > MAX_PAYLOAD_BYTES:
+        return error_page(400, "payload_too_large", "Message Too Long",
+            f"The encrypted message may be at most {MAX_PAYLOAD_BYTES} bytes.")
+    has_alpha = image_has_alpha(img)
+    if len(cipher) > payload_capacity(img.size, has_alpha):
+        return error_page(400, "image_too_small", "Image Too Small",
+            f"Image too small to hold payload. Need {len(cipher)} bytes, {img.size[0]}x{img.size[1]} holds {payload_capacity(img.size, has_alpha)}")
 
+    cover_key = upload_sha256(file)
+    cover = cover_cache.get(cover_key)
+    if cover is None:
+        with span("decode"):
+            # Ensure image is loaded into memory
+            img.load()
+        with span("convert"):
+            cover = img.convert("RGBA")
+        cover_cache.put(cover_key, cover)
+    
     message_id = secrets.token_urlsafe(10)
     fname = secure_filename(f"stego_{message_id}.png")
     path = os.path.join(UPLOAD_DIR, fname)
-    
-    # Save PNG with no compression to preserve LSB data
-    # compress_level=0 means no compression, which preserves exact pixel values
-    stego.save(path, "PNG", compress_level=0, optimize=False)
+    display_path = os.path.join(UPLOAD_DIR, f"display_{message_id}{DISPLAY_EXT[DISPLAY_FORMAT]}") if DISPLAY_MAX_PX else None
+
+    try:
+        stego_size, timings, display = run_stego(_embed_to_file, cover, cipher, path, has_alpha, display_path)
+        add_spans(timings)
+        observe_stego("embed", timings, len(cipher), stego_size)
+        # Verify embedding worked by checking image was modified
+        if stego_size != img.size:
+            return error_page(500, "embed_failed", "Embedding Failed", "Stego image size mismatch")
+    except Exception as e:
+        return error_page(400, "embed_failed", "Embedding Failed", f"embed error: {e}")
     
     # Verify the stego image can be loaded and contains data
     try:
-        verify_img = Image.open(path)
-        verify_img.load()
         # Try to extract to verify data is there (we'll decrypt later)
-        test_extract = extract_bytes_from_image(verify_img)
+        with span("verify"):
+            test_extract, timings, size = run_stego(_extract_from_file, path)
+        observe_stego("extract", timings, len(test_extract), size)
         if len(test_extract) == 0:
-            return "Error: Failed to embed data in image", 500
+            return error_page(500, "embed_failed", "Embedding Failed", "Failed to embed data in image")
     except Exception as e:
         # If extraction fails, the embedding might have failed
-        return f"Error: Could not verify embedded data: {e}", 500
+        return error_page(500, "embed_failed", "Embedding Failed", f"Could not verify embedded data: {e}")
 
     token = secrets.token_urlsafe(18)
     token_hash = hashlib.sha256(token.encode()).hexdigest()
     try:
-        messages.insert_one({
-            "message_id": message_id,
-            "sender": user['email'],
-            "recipient": recipient,
-            "image_path": path,
-            "token": token,  # Store plain token so recipient can view
-            "token_hash": token_hash,
-            "secret_code_hash": secret_code_hash,  # Store secret code hash for decryption
-            "created_at": datetime.now(timezone.utc),
-            "viewed": False
-        })
+        with span("insert"), Q_ONE_TIME.timeout():
+            Q_ONE_TIME.messages.insert_one({
+                "message_id": message_id,
+                "sender": user['email'],
+                "recipient": recipient,
+                "image_path": path,
+                "token": token,  # Store plain token so recipient can view
+                "token_hash": token_hash,
+                "secret_code_hash": secret_code_hash,  # Store secret code hash for decryption
+                "key_id": PRIMARY_KEY_ID,  # Key the payload is encrypted under (for rotation)
+                "created_at": datetime.now(timezone.utc),
+                "viewed": False,
+                **(display or {}),  # display_path / display_size / display_placeholder
+            })
+        bump_counts(recipient, unread=1)
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return get_db_error_msg()
 
     # Show success message to sender
-    success_html = """
-    <!doctype html>
-    <html>
-    <head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Message Sent</title>
-    <style>
-      * { margin: 0; padding: 0; box-sizing: border-box; }
-      body {
-        font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #f093fb 50%, #4facfe 75%, #00f2fe 100%);
-        background-size: 400% 400%;
-        animation: gradientShift 15s ease infinite;
-        min-height: 100vh;
-        display: flex;
-        align-items: center;
-        justify-content: center;
-        padding: 20px;
-      }
-      @keyframes gradientShift {
-        0% { background-position: 0% 50%; }
-        50% { background-position: 100% 50%; }
-        100% { background-position: 0% 50%; }
-      }
-      .container {
-        background: rgba(255, 255, 255, 0.95);
-        border-radius: 20px;
-        padding: 40px;
-        box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-        max-width: 600px;
-        text-align: center;
-      }
-      h1 { color: #667eea; font-size: 2.5em; margin-bottom: 20px; }
-      p { color: #555; font-size: 1.1em; margin: 20px 0; line-height: 1.6; }
-      .info-box {
-        background: #e8f5e9;
-        border-left: 4px solid #4caf50;
-        padding: 15px;
-        border-radius: 5px;
-        margin: 20px 0;
-        text-align: left;
-      }
-      a.button {
-        display: inline-block;
-        margin-top: 20px;
-        padding: 12px 25px;
-        background: linear-gradient(135deg, #667eea, #764ba2);
-        color: white;
-        text-decoration: none;
-        border-radius: 10px;
-        font-weight: 600;
-        transition: all 0.3s;
-      }
-      a.button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-      }
-    </style>
-    </head>
-    <body>
-    <div class="container">
-      <h1>✅ Message Sent!</h1>
-      <div class="info-box">
-        <strong>✓ Success!</strong> Your message has been sent securely. The recipient can view it directly from their inbox.
-      </div>
-      <p>The recipient will see this message in their inbox and can view it by entering the secret code you both share.</p>
-      <a href="/" class="button">← Back to Home</a>
-    </div>
-    </body>
-    </html>
-    """
-    return success_html
+    return error_page(200, "sent", "Message Sent!",
+        "The recipient will see this message in their inbox and can view it by entering the secret code you both share.",
+        icon="✅", tone="ok", back_label="← Back to Home", json_status=201, message_id=message_id,
+        notice=Markup("<strong>✓ Success!</strong> Your message has been sent securely. The recipient can view it directly from their inbox."))
 
 @app.route("/claim/<message_id>")
 def claim_link(message_id):
@@ -1482,502 +2993,84 @@ def claim_link(message_id):
 @app.route("/view/<token>", methods=["GET", "POST"])
 def view_token(token):
     if messages is None:
-        error_html = """
-        <!doctype html>
-        <html>
-        <head><meta charset="utf-8"><title>Database Error</title></head>
-        <body style="font-family: Arial; padding: 50px; text-align: center;">
-        <h2>Database Connection Error</h2>
-        <p>Please ensure MongoDB is running.</p>
-        <a href="/">Back to Home</a>
-        </body>
-        </html>
-        """
-        return error_html, 503
+        return error_page(503, "database_unavailable", "Database Connection Error",
+            "Please ensure MongoDB is running.", icon="⚠️", back_label="Back to Home")
     # find message by token hash
     th = hashlib.sha256(token.encode()).hexdigest()
     try:
-        doc = messages.find_one({"token_hash": th})
+        with span("lookup"), Q_ONE_TIME.timeout():
+            doc = Q_ONE_TIME.messages.find_one({"token_hash": th})
         if not doc:
-            error_html = """
-            <!doctype html>
-            <html>
-            <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>🔍 Link Not Found</title>
-            <style>
-              * { margin: 0; padding: 0; box-sizing: border-box; }
-              body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #f093fb 50%, #4facfe 75%, #00f2fe 100%);
-                background-size: 400% 400%;
-                animation: gradientShift 15s ease infinite;
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-              }
-              @keyframes gradientShift {
-                0% { background-position: 0% 50%; }
-                50% { background-position: 100% 50%; }
-                100% { background-position: 0% 50%; }
-              }
-              .container {
-                background: rgba(255, 255, 255, 0.95);
-                border-radius: 20px;
-                padding: 40px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                max-width: 500px;
-                text-align: center;
-                animation: slideIn 0.5s ease;
-              }
-              @keyframes slideIn {
-                from { opacity: 0; transform: translateY(-20px); }
-                to { opacity: 1; transform: translateY(0); }
-              }
-              h1 { color: #f93; font-size: 3em; margin-bottom: 20px; }
-              h2 { color: #555; margin-bottom: 20px; }
-              p { color: #555; font-size: 1.1em; margin: 20px 0; line-height: 1.6; }
-              a {
-                display: inline-block;
-                margin-top: 20px;
-                padding: 12px 25px;
-                background: linear-gradient(135deg, #667eea, #764ba2);
-                color: white;
-                text-decoration: none;
-                border-radius: 10px;
-                font-weight: 600;
-                transition: all 0.3s;
-                box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-              }
-              a:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-              }
-            </style>
-            </head>
-            <body>
-            <div class="container">
-              <h1>🔍</h1>
-              <h2>Link Not Found</h2>
-              <p>This link is invalid or has expired. The message may have already been viewed or deleted.</p>
-              <a href="/">← Back to Home</a>
-            </div>
-            </body>
-            </html>
-            """
-            return error_html, 404
+            return error_page(404, "link_not_found", "Link Not Found",
+                "This link is invalid or has expired. The message may have already been viewed or deleted.",
+                icon="🔍", tone="warn", back_label="← Back to Home")
         # ensure logged-in recipient
-        user = current_user()
+        with span("auth"):
+            user = current_user()
         if not user:
             # redirect to login then come back
             session['next'] = request.path
             return redirect(url_for('login'))
         if user.get('email') != doc.get('recipient'):
-            error_html = """
-            <!doctype html>
-            <html>
-            <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>⚠️ Access Denied</title>
-            <style>
-              * { margin: 0; padding: 0; box-sizing: border-box; }
-              body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #f093fb 50%, #4facfe 75%, #00f2fe 100%);
-                background-size: 400% 400%;
-                animation: gradientShift 15s ease infinite;
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-              }
-              @keyframes gradientShift {
-                0% { background-position: 0% 50%; }
-                50% { background-position: 100% 50%; }
-                100% { background-position: 0% 50%; }
-              }
-              .container {
-                background: rgba(255, 255, 255, 0.95);
-                border-radius: 20px;
-                padding: 40px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                max-width: 500px;
-                text-align: center;
-                animation: slideIn 0.5s ease;
-              }
-              @keyframes slideIn {
-                from { opacity: 0; transform: translateY(-20px); }
-                to { opacity: 1; transform: translateY(0); }
-              }
-              h1 { color: #c33; font-size: 3em; margin-bottom: 20px; }
-              p { color: #555; font-size: 1.2em; margin: 20px 0; line-height: 1.6; }
-              a {
-                display: inline-block;
-                margin-top: 20px;
-                padding: 12px 25px;
-                background: linear-gradient(135deg, #667eea, #764ba2);
-                color: white;
-                text-decoration: none;
-                border-radius: 10px;
-                font-weight: 600;
-                transition: all 0.3s;
-                box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-              }
-              a:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-              }
-            </style>
-            </head>
-            <body>
-            <div class="container">
-              <h1>⚠️</h1>
-              <h2 style="color: #c33; margin-bottom: 20px;">Access Denied</h2>
-              <p>This message was sent to someone else. You can only view messages that were sent to you.</p>
-              <a href="/">← Back to Home</a>
-            </div>
-            </body>
-            </html>
-            """
-            return error_html, 403
-        # Check if secret code is provided in session or form
-        secret_code = request.form.get("secret_code") or session.get(f"secret_code_{doc['message_id']}")
+            return error_page(403, "not_your_message", "Access Denied",
+                "This message was sent to someone else. You can only view messages that were sent to you.",
+                icon="⚠️", back_label="← Back to Home")
+        # Code from the form, or a grant from an earlier correct entry in this session
+        secret_code = request.form.get("secret_code")
+        granted = None if secret_code else reveal_grant(doc['message_id'])
         
-        if not secret_code:
+        if not secret_code and not granted:
             # Show secret code entry form
-            secret_code_html = """
-            <!doctype html>
-            <html>
-            <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Enter Secret Code</title>
-            <style>
-              * { margin: 0; padding: 0; box-sizing: border-box; }
-              body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #f093fb 50%, #4facfe 75%, #00f2fe 100%);
-                background-size: 400% 400%;
-                animation: gradientShift 15s ease infinite;
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-              }
-              @keyframes gradientShift {
-                0% { background-position: 0% 50%; }
-                50% { background-position: 100% 50%; }
-                100% { background-position: 0% 50%; }
-              }
-              .container {
-                background: rgba(255, 255, 255, 0.95);
-                border-radius: 20px;
-                padding: 40px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                max-width: 450px;
-                width: 100%;
-                animation: slideIn 0.5s ease;
-              }
-              @keyframes slideIn {
-                from { opacity: 0; transform: translateY(-20px); }
-                to { opacity: 1; transform: translateY(0); }
-              }
-              h1 { color: #667eea; text-align: center; margin-bottom: 10px; font-size: 2.5em; }
-              h2 { color: #764ba2; text-align: center; margin-bottom: 30px; }
-              form { margin-top: 20px; }
-              label { display: block; margin: 15px 0 5px 0; color: #555; font-weight: 600; }
-              input {
-                width: 100%;
-                padding: 12px;
-                border: 2px solid #e0e0e0;
-                border-radius: 8px;
-                font-size: 16px;
-                transition: all 0.3s;
-                font-family: inherit;
-              }
-              input:focus {
-                outline: none;
-                border-color: #667eea;
-                box-shadow: 0 0 0 3px rgba(102, 126, 234, 0.1);
-              }
-              button {
-                width: 100%;
-                background: linear-gradient(135deg, #667eea, #764ba2);
-                color: white;
-                padding: 15px;
-                border: none;
-                border-radius: 10px;
-                font-size: 18px;
-                font-weight: 600;
-                cursor: pointer;
-                transition: all 0.3s;
-                box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-                margin-top: 20px;
-              }
-              button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-              }
-              .error {
-                background: #fee;
-                color: #c33;
-                padding: 15px;
-                border-radius: 10px;
-                margin-bottom: 20px;
-                border-left: 4px solid #c33;
-              }
-            </style>
-            </head>
-            <body>
-            <div class="container">
-              <h1>🔐</h1>
-              <h2>Enter Secret Code</h2>
-              <p style="color: #666; text-align: center; margin-bottom: 20px;">
-                Enter the secret code you shared with the sender to view this message.
-              </p>
-              <form action="/view/""" + token + """" method="post">
-                <label>Secret Code:</label>
-                <input type="text" name="secret_code" placeholder="e.g., kiwi" required autofocus />
-                <button type="submit">🔓 View Message</button>
-              </form>
-            </div>
-            </body>
-            </html>
-            """
-            return secret_code_html
+            return error_page(200, "secret_code_required", "Enter Secret Code",
+                "Enter the secret code you shared with the sender to view this message.",
+                icon="🔐", tone="info", form_action=url_for('view_token', token=token), json_status=401)
         
         # Verify secret code
-        secret_hash = hashlib.sha256(secret_code.encode()).hexdigest()
+        secret_hash = hashlib.sha256(secret_code.encode()).hexdigest() if secret_code else granted
         if doc.get('secret_code_hash') != secret_hash:
-            secret_code_html = """
-            <!doctype html>
-            <html>
-            <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Invalid Secret Code</title>
-            <style>
-              * { margin: 0; padding: 0; box-sizing: border-box; }
-              body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #f093fb 50%, #4facfe 75%, #00f2fe 100%);
-                background-size: 400% 400%;
-                animation: gradientShift 15s ease infinite;
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-              }
-              @keyframes gradientShift {
-                0% { background-position: 0% 50%; }
-                50% { background-position: 100% 50%; }
-                100% { background-position: 0% 50%; }
-              }
-              .container {
-                background: rgba(255, 255, 255, 0.95);
-                border-radius: 20px;
-                padding: 40px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                max-width: 450px;
-                width: 100%;
-              }
-              h1 { color: #c33; text-align: center; margin-bottom: 10px; font-size: 2.5em; }
-              h2 { color: #764ba2; text-align: center; margin-bottom: 20px; }
-              .error {
-                background: #fee;
-                color: #c33;
-                padding: 15px;
-                border-radius: 10px;
-                margin-bottom: 20px;
-                border-left: 4px solid #c33;
-                text-align: center;
-              }
-              form { margin-top: 20px; }
-              label { display: block; margin: 15px 0 5px 0; color: #555; font-weight: 600; }
-              input {
-                width: 100%;
-                padding: 12px;
-                border: 2px solid #e0e0e0;
-                border-radius: 8px;
-                font-size: 16px;
-                font-family: inherit;
-              }
-              button {
-                width: 100%;
-                background: linear-gradient(135deg, #667eea, #764ba2);
-                color: white;
-                padding: 15px;
-                border: none;
-                border-radius: 10px;
-                font-size: 18px;
-                font-weight: 600;
-                cursor: pointer;
-                margin-top: 20px;
-              }
-            </style>
-            </head>
-            <body>
-            <div class="container">
-              <h1>❌</h1>
-              <h2>Invalid Secret Code</h2>
-              <div class="error">The secret code you entered is incorrect. Please try again.</div>
-              <form action="/view/""" + token + """" method="post">
-                <label>Secret Code:</label>
-                <input type="text" name="secret_code" placeholder="e.g., kiwi" required autofocus />
-                <button type="submit">🔓 View Message</button>
-              </form>
-            </div>
-            </body>
-            </html>
-            """
-            return secret_code_html
+            return error_page(200, "invalid_secret_code", "Invalid Secret Code",
+                notice="The secret code you entered is incorrect. Please try again.",
+                form_action=url_for('view_token', token=token), json_status=403)
         
         # Check if message is already viewed
         if doc.get("viewed"):
             # Show clean "already viewed" page without image
-            already_viewed_html = """
-            <!doctype html>
-            <html>
-            <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>🔒 Message Already Viewed</title>
-            <link rel="icon" type="image/x-icon" href="/favicon.ico">
-            <style>
-              * { margin: 0; padding: 0; box-sizing: border-box; }
-              body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #f093fb 50%, #4facfe 75%, #00f2fe 100%);
-                background-size: 400% 400%;
-                animation: gradientShift 15s ease infinite;
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-              }
-              @keyframes gradientShift {
-                0% { background-position: 0% 50%; }
-                50% { background-position: 100% 50%; }
-                100% { background-position: 0% 50%; }
-              }
-              .container {
-                background: rgba(255, 255, 255, 0.98);
-                border-radius: 16px;
-                padding: 40px;
-                box-shadow: 0 8px 32px rgba(0,0,0,0.12);
-                max-width: 500px;
-                width: 100%;
-                text-align: center;
-                animation: slideIn 0.5s ease;
-              }
-              @keyframes slideIn {
-                from { opacity: 0; transform: translateY(-20px); }
-                to { opacity: 1; transform: translateY(0); }
-              }
-              h1 {
-                color: #667eea;
-                margin-bottom: 20px;
-                font-size: 2.5em;
-              }
-              .icon {
-                font-size: 5em;
-                margin-bottom: 20px;
-                opacity: 0.7;
-              }
-              .message-box {
-                background: #f8f9fa;
-                border: 2px solid #e9ecef;
-                border-radius: 12px;
-                padding: 30px;
-                margin: 25px 0;
-                color: #6c757d;
-                font-size: 16px;
-                line-height: 1.6;
-              }
-              .info {
-                background: #fff3cd;
-                border: 1px solid #ffc107;
-                border-left: 4px solid #ffc107;
-                border-radius: 8px;
-                padding: 15px;
-                margin: 20px 0;
-                color: #856404;
-                font-size: 14px;
-              }
-              a {
-                display: inline-block;
-                margin-top: 25px;
-                padding: 12px 30px;
-                background: linear-gradient(135deg, #667eea, #764ba2);
-                color: white;
-                text-decoration: none;
-                border-radius: 10px;
-                font-weight: 600;
-                transition: all 0.3s;
-                box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-              }
-              a:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6);
-              }
-            </style>
-            </head>
-            <body>
-            <div class="container">
-              <div class="icon">🔒</div>
-              <h1>Message Already Viewed</h1>
-              <div class="info">
-                ⚠️ This message has already been viewed and has been permanently deleted for security.
-              </div>
-              <div class="message-box">
-                <p style="margin: 0;">For your security, messages can only be viewed once. Once revealed, they are automatically deleted and cannot be accessed again.</p>
-              </div>
-              <a href="/">← Back to Home</a>
-            </div>
-            </body>
-            </html>
-            """
-            return already_viewed_html
+            return error_page(200, "already_viewed", "Message Already Viewed",
+                "For your security, messages can only be viewed once. Once revealed, they are automatically deleted and cannot be accessed again.",
+                icon="🔒", tone="warn", back_label="← Back to Home", json_status=410,
+                notice="⚠️ This message has already been viewed and has been permanently deleted for security.")
         
-        # Store secret code in session for API reveal
-        session[f"secret_code_{doc['message_id']}"] = secret_code
+        # Let /api/reveal through without asking for the code again
+        grant_reveal(doc['message_id'], secret_hash)
         
         # render viewer HTML with image url and token
-        image_url = url_for('get_image', filename=os.path.basename(doc.get('image_path', '')), _external=True)
+        original_url = url_for('get_image', filename=os.path.basename(doc.get('image_path', '')), _external=True)
+        # messages sent before display copies existed only have the original
+        display_path = doc.get('display_path')
+        image_url = url_for('get_image', filename=os.path.basename(display_path), _external=True) if display_path else original_url
         try:
-            with open("viewer.html", "r", encoding="utf-8") as f:
-                viewer_content = f.read()
-            return render_template_string(viewer_content, image_url=image_url, token=token, secret_code=secret_code, already_viewed=False)
+            with span("render"):
+                with open("viewer.html", "r", encoding="utf-8") as f:
+                    viewer_content = f.read()
+                return render_template_string(viewer_content, image_url=image_url, token=token, already_viewed=False,
+                                              download_url=original_url if display_path else None,
+                                              display_size=doc.get('display_size'), placeholder=doc.get('display_placeholder'))
         except Exception as e:
             return f"Error loading viewer: {str(e)}", 500
     except (ServerSelectionTimeoutError, ConnectionFailure):
-        error_html = """
-        <!doctype html>
-        <html>
-        <head><meta charset="utf-8"><title>Database Error</title></head>
-        <body style="font-family: Arial; padding: 50px; text-align: center;">
-        <h2>Database Connection Error</h2>
-        <p>Please ensure MongoDB is running.</p>
-        <a href="/">Back to Home</a>
-        </body>
-        </html>
-        """
-        return error_html, 503
+        return error_page(503, "database_unavailable", "Database Connection Error",
+            "Please ensure MongoDB is running.", icon="⚠️", back_label="Back to Home")
+
+UPLOAD_MIMETYPES = {".png": "image/png", ".webp": "image/webp", ".jpg": "image/jpeg"}
 
 @app.route("/uploads/<filename>")
 def get_image(filename):
     path = os.path.join(UPLOAD_DIR, secure_filename(filename))
-    if not os.path.exists(path):
+    mimetype = UPLOAD_MIMETYPES.get(os.path.splitext(path)[1])
+    if not mimetype or not os.path.exists(path):
         abort(404)
-    return send_file(path, mimetype="image/png")
+    # ?download=1 saves the original stego PNG instead of displaying it
+    return send_file(path, mimetype=mimetype, as_attachment=bool(request.args.get("download")))
 
 @app.route("/favicon.ico")
 def favicon():
@@ -2001,7 +3094,8 @@ def api_reveal(token):
         return jsonify({"error": "Database connection error"}), 503
     th = hashlib.sha256(token.encode()).hexdigest()
     try:
-        doc = messages.find_one({"token_hash": th})
+        with span("lookup"), Q_ONE_TIME.timeout():
+            doc = Q_ONE_TIME.messages.find_one({"token_hash": th})
         if not doc:
             return jsonify({"error":"Invalid or expired link"}), 404
         user = current_user()
@@ -2012,20 +3106,34 @@ def api_reveal(token):
         if doc.get("viewed"):
             return jsonify({"error":"already viewed"}), 410
         
-        # Get secret code from session (stored when viewing)
-        secret_code = session.get(f"secret_code_{doc['message_id']}")
-        if not secret_code:
+        # Grant recorded by /view when the right code was entered
+        secret_hash = reveal_grant(doc['message_id'])
+        if not secret_hash:
             return jsonify({"error": "Secret code required. Please visit the view page first."}), 403
         
         # Verify secret code
-        secret_hash = hashlib.sha256(secret_code.encode()).hexdigest()
         if doc.get('secret_code_hash') != secret_hash:
-            # Clear invalid code from session
-            session.pop(f"secret_code_{doc['message_id']}", None)
+            revoke_reveal(doc['message_id'])
             return jsonify({"error": "Invalid secret code"}), 403
+        # Memory guard from the PNG header, before the message is marked viewed,
+        # so a refused reveal can simply be retried with the same grant
+        try:
+            with Image.open(doc.get('image_path') or "") as header:
+                error = memory_guard(header.size[0] * header.size[1], REVEAL_BYTES_PER_PIXEL)
+        except OSError:
+            error = None  # missing/corrupt file: reported by the extraction below
+        if error:
+            return jsonify({"error": error[0]}), error[1], {"Retry-After": "5"} if error[1] == 503 else {}
+        # one reveal per grant
+        revoke_reveal(doc['message_id'])
 
-        # mark viewed first
-        messages.update_one({"_id": doc['_id']}, {"$set":{"viewed": True, "viewed_at": datetime.now(timezone.utc)}})
+        # mark viewed first; only the request that flips the flag moves the counters
+        with span("mark_viewed"), Q_ONE_TIME.timeout():
+            marked = Q_ONE_TIME.messages.update_one({"_id": doc['_id'], "viewed": {"$ne": True}},
+                                                    {"$set":{"viewed": True, "viewed_at": datetime.now(timezone.utc)}})
+        if not marked.modified_count:
+            return jsonify({"error":"already viewed"}), 410
+        bump_counts(doc['recipient'], unread=-1, viewed=1)
 
         # extract payload from image and decrypt
         image_path = doc.get('image_path')
@@ -2033,27 +3141,397 @@ def api_reveal(token):
             return jsonify({"error": "Image path not found"}), 404
             
         try:
-            img = Image.open(image_path)
-            # Ensure image is fully loaded
-            img.load()
-            payload = extract_bytes_from_image(img)
+            payload, timings, size = run_stego(_extract_from_file, image_path)
+            add_spans(timings)
+            observe_stego("extract", timings, len(payload), size)
             if not payload:
                 return jsonify({"error": "No data found in image. The image may not contain embedded data."}), 400
-            plaintext = fernet.decrypt(payload).decode('utf-8')
+            with span("decrypt"):
+                plaintext = open_payload(payload).decode('utf-8')
         except ValueError as e:
             return jsonify({"error": f"Extraction error: {str(e)}"}), 400
         except Exception as e:
             return jsonify({"error": f"Decryption error: {str(e)}"}), 500
 
         # delete file to reduce future extraction (best-effort)
-        try:
-            os.remove(image_path)
-        except:
-            pass
+        with span("unlink"):
+            for leftover in (image_path, doc.get('display_path')):
+                try:
+                    if leftover:
+                        os.remove(leftover)
+                except:
+                    pass
 
         return jsonify({"message": plaintext, "view_seconds": VIEW_SECONDS})
     except (ServerSelectionTimeoutError, ConnectionFailure):
         return jsonify({"error": "Database connection error"}), 503
 
+@app.route("/api/inbox/count", methods=["GET"])
+def api_inbox_count():
+    """Badge numbers from the user document; never touches messages."""
+    if users is None or messages is None or pairings is None:
+        return jsonify({"error": "Database connection error"}), 503
+    try:
+        user = current_user()
+        if not user:
+            return jsonify({"error": "login required"}), 401
+        counts = user_counts(user)
+    except (ServerSelectionTimeoutError, ConnectionFailure):
+        return jsonify({"error": "Database connection error"}), 503
+    resp = jsonify({name: max(0, counts.get(name, 0)) for name in COUNT_FIELDS})
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# ---------- JSON API (v1) ----------
+# Same handlers and queries as the HTML routes; under /api/v1/ wants_json() is
+# always true, so error_page() and action_done() answer in JSON. Auth is the
+# regular session cookie.
+API_GZIP_MIN_BYTES = int(os.environ.get("API_GZIP_MIN_BYTES", "1024"))
+API_INBOX_LIMIT = 200
+
+def _api_time(value):
+    return value.replace(tzinfo=value.tzinfo or timezone.utc).isoformat() if value else None
+
+def _api_login_required():
+    return jsonify({"error": "login_required", "message": "login required"}), 401
+
+@app.after_request
+def _gzip_api_response(resp):
+    if (not request.path.startswith("/api/v1/") or resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or "gzip" not in request.headers.get("Accept-Encoding", "") or "Content-Encoding" in resp.headers):
+        return resp
+    resp.headers.add("Vary", "Accept-Encoding")
+    body = resp.get_data()
+    if len(body) < API_GZIP_MIN_BYTES:
+        return resp
+    resp.set_data(gzip.compress(body, compresslevel=5))
+    resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+@app.route("/api/v1/inbox", methods=["GET"])
+def api_inbox():
+    if db is None or messages is None or pairings is None:
+        return get_db_error_msg()
+    user = current_user()
+    if not user:
+        return _api_login_required()
+    try:
+        limit = min(max(int(request.args.get("limit", API_INBOX_LIMIT)), 1), API_INBOX_LIMIT)
+    except ValueError:
+        limit = API_INBOX_LIMIT
+    try:
+        docs = inbox_for(user["email"], limit)
+    except (ServerSelectionTimeoutError, ConnectionFailure):
+        return get_db_error_msg()
+    items = [{
+        "id": d["message_id"],
+        "from": d.get("sender"),
+        "at": _api_time(d.get("created_at")),
+        "viewed": d.get("viewed", False),
+        "token": None if d.get("viewed") else d.get("token"),
+    } for d in docs]
+    resp = jsonify({"messages": items})
+    # weak: the same representation may go out gzip-encoded or not
+    resp.set_etag(hashlib.sha256(resp.get_data()).hexdigest()[:20], weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+@app.route("/api/v1/pairings", methods=["GET"])
+def api_pairings():
+    if db is None or messages is None or pairings is None:
+        return get_db_error_msg()
+    user = current_user()
+    if not user:
+        return _api_login_required()
+    try:
+        pending = pending_requests_for(user["email"])
+        partners = user_partners(user)
+    except (ServerSelectionTimeoutError, ConnectionFailure):
+        return get_db_error_msg()
+    return jsonify({
+        "requests": [{"id": str(r["_id"]), "from": r.get("user1_email"), "at": _api_time(r.get("created_at"))} for r in pending],
+        "partners": [{"email": p["email"], "id": p["pairing_id"]} for p in partners],
+    })
+
+@app.route("/api/v1/pairings", methods=["POST"])
+def api_request_pairing():
+    return request_pairing()
+
+@app.route("/api/v1/pairings/<request_id>/accept", methods=["POST"])
+def api_accept_pairing(request_id):
+    return accept_pairing(request_id)
+
+@app.route("/api/v1/pairings/<request_id>/reject", methods=["POST"])
+def api_reject_pairing(request_id):
+    return reject_pairing(request_id)
+
+@app.route("/api/v1/messages", methods=["POST"])
+def api_send():
+    return send()
+
+@app.route("/api/v1/messages/<message_id>", methods=["GET"])
+def api_message_status(message_id):
+    """Delivery status of a message, for its sender (or recipient)."""
+    if db is None or messages is None or pairings is None:
+        return get_db_error_msg()
+    user = current_user()
+    if not user:
+        return _api_login_required()
+    try:
+        doc = messages.find_one({"message_id": message_id},
+                                {"_id": 0, "sender": 1, "recipient": 1, "created_at": 1, "viewed": 1, "viewed_at": 1})
+    except (ServerSelectionTimeoutError, ConnectionFailure):
+        return get_db_error_msg()
+    if not doc or user["email"] not in (doc.get("sender"), doc.get("recipient")):
+        return jsonify({"error": "not_found", "message": "message not found"}), 404
+    return jsonify({
+        "id": message_id,
+        "to": doc.get("recipient"),
+        "at": _api_time(doc.get("created_at")),
+        "viewed": doc.get("viewed", False),
+        "viewed_at": _api_time(doc.get("viewed_at")),
+    })
+
+@app.route("/api/v1/clear/<job_id>", methods=["GET"])
+def api_clear_progress(job_id):
+    """Progress of a background inbox clear started by /clear-logs or /clear-all."""
+    if db is None or messages is None or pairings is None:
+        return get_db_error_msg()
+    user = current_user()
+    if not user:
+        return _api_login_required()
+    try:
+        job = db.jobs.find_one({"_id": job_id, "kind": "clear", "user": user["email"]},
+                               {"_id": 0, "deleted": 1, "done": 1, "error": 1})
+    except (ServerSelectionTimeoutError, ConnectionFailure):
+        return get_db_error_msg()
+    if not job:
+        return jsonify({"error": "not_found", "message": "clear job not found"}), 404
+    return jsonify(job)
+
+# ---------- inbox events (SSE) ----------
+# One watcher thread per worker process fans changes out to per-client queues,
+# so the database cost is one change stream (or four poll queries per tick)
+# regardless of how many tabs are open. The watcher only starts with the first
+# subscriber and the poller sleeps while nobody is listening. Idle streams only
+# carry a comment line every SSE_HEARTBEAT_SECONDS.
+SSE_HEARTBEAT_SECONDS = 25
+SSE_QUEUE_SIZE = 100
+_EVENT_MESSAGE_FIELDS = {"_id": 0, "message_id": 1, "sender": 1, "recipient": 1, "created_at": 1, "viewed": 1, "token": 1}
+
+class InboxHub:
+    """Per-process registry of event-stream subscribers keyed by user email."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._subscribers = {}
+        self._thread = None
+        self._pid = None
+        self.backend = None
+
+    @property
+    def clients(self):
+        return sum(len(qs) for qs in self._subscribers.values())
+
+    def subscribe(self, email):
+        with self._cond:
+            if self.clients >= SSE_MAX_CLIENTS:
+                return None
+            q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+            self._subscribers.setdefault(email, set()).add(q)
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="inbox-events", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return q
+
+    def unsubscribe(self, email, q):
+        with self._cond:
+            qs = self._subscribers.get(email)
+            if qs:
+                qs.discard(q)
+                if not qs:
+                    del self._subscribers[email]
+
+    def publish(self, email, event, data):
+        with self._cond:
+            targets = list(self._subscribers.get(email, ()))
+        for q in targets:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                pass  # client is not reading; it resyncs from /api/v1/inbox on reconnect
+
+    def _wait_for_subscribers(self, timeout=None):
+        with self._cond:
+            while not self._subscribers:
+                self._cond.wait(timeout)
+            return list(self._subscribers)
+
+    def dispatch_message(self, doc):
+        if doc.get("viewed"):
+            for email in (doc.get("sender"), doc.get("recipient")):
+                self.publish(email, "viewed", {"id": doc.get("message_id")})
+        else:
+            self.publish(doc.get("recipient"), "message", {
+                "id": doc.get("message_id"),
+                "from": doc.get("sender"),
+                "at": _api_time(doc.get("created_at")),
+                "token": doc.get("token"),
+            })
+
+    def dispatch_pairing(self, doc):
+        if doc.get("status") == "pending":
+            self.publish(doc.get("user2_email"), "pairing_request", {"id": str(doc["_id"]), "from": doc.get("user1_email")})
+        elif doc.get("status") == "paired":
+            self.publish(doc.get("user1_email"), "paired", {"id": str(doc["_id"]), "partner": doc.get("user2_email")})
+
+    def _run(self):
+        if INBOX_EVENTS in ("auto", "changestream"):
+            try:
+                self._watch()
+                return
+            except Exception as e:
+                print(f"Inbox events: change streams unavailable ({e}), polling every {INBOX_POLL_SECONDS:g}s")
+        self._poll()
+
+    def _watch(self):
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": ["messages", "pairings"]},
+            "operationType": {"$in": ["insert", "update", "replace"]},
+        }}]
+        if db is None:
+            raise ConnectionFailure(NOT_CONNECTED)
+        resume_token = None
+        while True:
+            # fails right here on a standalone mongod, which sends us to _poll()
+            with db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                self.backend = "changestream"
+                try:
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        doc = change.get("fullDocument")
+                        if not doc:
+                            continue
+                        if change["ns"]["coll"] == "messages":
+                            updated = (change.get("updateDescription") or {}).get("updatedFields", {})
+                            if change["operationType"] == "insert" or "viewed" in updated:
+                                self.dispatch_message(doc)
+                        elif change["operationType"] == "insert" or "status" in (change.get("updateDescription") or {}).get("updatedFields", {}):
+                            self.dispatch_pairing(doc)
+                except PyMongoError as e:
+                    print(f"Inbox events: change stream interrupted ({e}), resuming")
+                    time.sleep(1)
+
+    def _poll(self):
+        self.backend = "poll"
+        seen = OrderedDict()
+        while True:
+            emails = self._wait_for_subscribers()
+            # overlapping window + seen-set tolerates clock skew between app hosts
+            since = datetime.now(timezone.utc) - timedelta(seconds=INBOX_POLL_SECONDS + 5)
+            try:
+                with Q_DASHBOARD.timeout():
+                    found = [
+                        ("m", Q_DASHBOARD.messages.find({"recipient": {"$in": emails}, "created_at": {"$gt": since}}, _EVENT_MESSAGE_FIELDS)),
+                        ("v", Q_DASHBOARD.messages.find({"viewed_at": {"$gt": since}, "$or": [
+                            {"sender": {"$in": emails}}, {"recipient": {"$in": emails}}]}, _EVENT_MESSAGE_FIELDS)),
+                        ("p", Q_DASHBOARD.pairings.find({"user2_email": {"$in": emails}, "status": "pending", "created_at": {"$gt": since}}, PAIRING_FIELDS)),
+                        ("a", Q_DASHBOARD.pairings.find({"user1_email": {"$in": emails}, "status": "paired", "accepted_at": {"$gt": since}}, PAIRING_FIELDS)),
+                    ]
+                    for kind, cursor in found:
+                        for doc in cursor:
+                            # keyed by the event it produces, so one doc matching two queries is sent once
+                            if kind in ("m", "v"):
+                                key = (doc.get("viewed", False), doc.get("message_id"))
+                            else:
+                                key = (doc.get("status"), str(doc.get("_id")))
+                            if key in seen:
+                                continue
+                            seen[key] = True
+                            if kind in ("m", "v"):
+                                self.dispatch_message(doc)
+                            else:
+                                self.dispatch_pairing(doc)
+                    while len(seen) > 10000:
+                        seen.popitem(last=False)
+            except PyMongoError as e:
+                print(f"Inbox events: poll failed: {e}")
+            time.sleep(INBOX_POLL_SECONDS)
+
+inbox_hub = InboxHub()
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+@app.route("/api/v1/events", methods=["GET"])
+def api_events():
+    """Server-sent inbox events: message, viewed, pairing_request, paired."""
+    if db is None or messages is None or pairings is None:
+        return get_db_error_msg()
+    user = current_user()
+    if not user:
+        return _api_login_required()
+    # a sync worker would be pinned for the life of the stream; 204 tells
+    # EventSource not to reconnect, and the page falls back to polling
+    if INBOX_EVENTS == "off" or not (request.environ.get("wsgi.multithread") or WEB_WORKER_CLASS == "gevent"):
+        return "", 204
+    email = user["email"]
+    q = inbox_hub.subscribe(email)
+    if q is None:
+        return "", 204
+
+    def stream():
+        try:
+            yield "retry: 5000\n" + _sse("ready", {})
+            while True:
+                try:
+                    event, data = q.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield _sse(event, data)
+        finally:
+            inbox_hub.unsubscribe(email, q)
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # keep nginx / proxies from buffering the stream
+    })
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["check-partners"]:
+        # python app.py check-partners [--repair]
+        if users is None:
+            sys.exit("Database connection error")
+        drift = check_partner_links(repair="--repair" in sys.argv)
+        for email, (want, have) in drift.items():
+            print(f"{email}: expected {sorted(e['email'] for e in want)}, found {sorted(e['email'] for e in have)}")
+        print(f"{len(drift)} user(s) out of sync" + (" - repaired" if drift and "--repair" in sys.argv else ""))
+        sys.exit(1 if drift and "--repair" not in sys.argv else 0)
+    if sys.argv[1:2] == ["profile-token"]:
+        # python app.py profile-token [seconds] -> curl -H "X-Profile: <token>" ...
+        if not PROFILE_SECRET:
+            sys.exit("Set PROFILE_SECRET (same value as the server) first")
+        print(profile_token(int(sys.argv[2]) if len(sys.argv) > 2 else 300))
+        sys.exit(0)
+    if sys.argv[1:2] == ["recount"]:
+        # python app.py recount [email]
+        if users is None:
+            sys.exit("Database connection error")
+        drift = recount_inbox(sys.argv[2] if len(sys.argv) > 2 else None)
+        for email, (stored, actual) in drift.items():
+            print(f"{email}: {stored} -> {actual}")
+        print(f"{len(drift)} user(s) recounted")
+        sys.exit(0)
+    if sys.argv[1:] == ["reembed"]:
+        # one-off migration after rotating FERNET_KEYS: python app.py reembed
+        if messages is None:
+            sys.exit("Database connection error")
+        # same lease as the background job, so the two never rewrite the same files
+        if not _acquire_job_lease("reembed", REEMBED_INTERVAL_SECONDS):
+            sys.exit("A re-embed is already running in another process; try again later")
+        print(f"Re-embedded {reembed_old_keys(lease='reembed')} message(s) under key {PRIMARY_KEY_ID}")
+        sys.exit(0)
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the LSB stego codec in stego.py.
+
+Times embed_bytes_in_image, extract_bytes_from_image and _bytes_to_bits
+across payload sizes (100 B up to the 20000 B cap), cover image modes
+(P, L, RGB, RGBA, I;16) and cover sizes, and reports the embedding mode
+picked, ns/pixel and MB/s of payload. Every embed is round-tripped, so a
+broken codec fails loudly.
+
+Examples:
+    python bench_codec.py
+    python bench_codec.py --payloads 100,20000 --modes RGB,RGBA --sizes 512 --json codec.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+DEFAULT_PAYLOADS = "100,1000,5000,20000"
+DEFAULT_MODES = "P,L,RGB,RGBA,I;16"
+DEFAULT_SIZES = "256,512,1024"
+
+
+def make_cover(mode, side):
+    from PIL import Image  # type: ignore
+    noise = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    if mode == "P":
+        return noise.convert("P", palette=Image.Palette.ADAPTIVE)
+    if mode == "I;16":
+        return noise.convert("L").convert("I;16")
+    return noise.convert(mode)
+
+
+def best_of(fn, repeat):
+    start = time.perf_counter()
+    result = fn()
+    best = time.perf_counter() - start
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payloads", default=DEFAULT_PAYLOADS, help="comma-separated payload sizes in bytes")
+    parser.add_argument("--modes", default=DEFAULT_MODES, help="comma-separated Pillow modes for the cover")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated square cover edge lengths in px")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, best time is reported")
+    parser.add_argument("--json", dest="json_out", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    # the codec lives in stego.py, which needs neither the database nor keys
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from stego import embed_bytes_in_image, extract_bytes_from_image, _bytes_to_bits
+    from stego import choose_embed_mode, image_has_alpha
+
+    results = []
+    print(f"{'mode':<6}{'size':>7}{'payload':>9}{'embed mode':>12}{'embed ns/px':>13}{'embed MB/s':>12}{'extract ns/px':>15}{'extract MB/s':>14}")
+    for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+        for side in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            cover = make_cover(mode, side)
+            pixels = side * side
+            for size in [int(p) for p in args.payloads.split(",") if p.strip()]:
+                payload = os.urandom(size)
+                has_alpha = image_has_alpha(cover)
+                embed_mode = choose_embed_mode(cover.size, size, has_alpha)
+                if embed_mode is None:
+                    continue  # cover too small for this payload
+                bits, alpha = embed_mode
+                embed_mode = f"{bits}bit-{'rgba' if alpha else 'rgb'}"
+                embed_t, stego = best_of(lambda: embed_bytes_in_image(cover, payload), args.repeat)
+                extract_t, out = best_of(lambda: extract_bytes_from_image(stego), args.repeat)
+                if out != payload:
+                    sys.exit(f"round-trip mismatch: mode={mode} size={side} payload={size}")
+                row = {
+                    "mode": mode,
+                    "side": side,
+                    "pixels": pixels,
+                    "payload_bytes": size,
+                    "embed_mode": embed_mode,
+                    "embed_sec": embed_t,
+                    "extract_sec": extract_t,
+                    "embed_ns_per_pixel": round(embed_t / pixels * 1e9, 1),
+                    "extract_ns_per_pixel": round(extract_t / pixels * 1e9, 1),
+                    "embed_mb_per_sec": round(size / embed_t / 1e6, 3),
+                    "extract_mb_per_sec": round(size / extract_t / 1e6, 3),
+                }
+                results.append(row)
+                print(f"{mode:<6}{side:>7}{size:>9}{embed_mode:>12}{row['embed_ns_per_pixel']:>13}{row['embed_mb_per_sec']:>12}"
+                      f"{row['extract_ns_per_pixel']:>15}{row['extract_mb_per_sec']:>14}")
+
+    bits_results = []
+    for size in [int(p) for p in args.payloads.split(",") if p.strip()]:
+        data = os.urandom(size)
+        t, _ = best_of(lambda: list(_bytes_to_bits(data)), args.repeat)
+        bits_results.append({"payload_bytes": size, "sec": t, "mb_per_sec": round(size / t / 1e6, 3)})
+        print(f"_bytes_to_bits {size:>6} B: {round(size / t / 1e6, 3)} MB/s")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"codec": results, "bytes_to_bits": bits_results}, f, indent=2)
+        print(f"\nResults written to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
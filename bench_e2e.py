@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for the send and reveal flows.
+
+Drives the real Flask routes in-process (Flask test client):
+    /register -> /pairing/request -> /pairing/accept -> /send -> /view -> /api/reveal
+with random-noise cover images from 0.3 MP up to 24 MP, and records per-stage
+throughput, p50/p95/p99 latency and bytes written to UPLOAD_DIR (stego PNG
+plus display copy), plus the peak RSS of the whole run (ru_maxrss only ever
+grows, so it is not split by size; run one --sizes value per invocation to get
+a per-size peak).
+
+Runs against the MongoDB at MONGO_URI, or against an in-memory stand-in with
+--mongomock (`pip install mongomock`). Uploads go to a temporary directory.
+
+Examples:
+    python bench_e2e.py --mongomock
+    python bench_e2e.py --sizes 0.3,1,4 --repeat 5 --json bench_output.json
+    python bench_e2e.py --mongomock --compare old.json new.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = "0.3,1,4,12,24"
+STAGES = ["register", "pairing", "send", "view", "reveal"]
+
+
+def process_peak_rss_bytes():
+    if sys.platform == "win32":  # no resource module
+        return None
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dir_bytes(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "n": len(samples),
+        "ops_per_sec": round(len(samples) / total, 2) if total else 0.0,
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+    }
+
+
+def make_cover(megapixels):
+    from PIL import Image  # type: ignore
+    side = int((megapixels * 1_000_000) ** 0.5)
+    img = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buf = io.BytesIO()
+    img.save(buf, "PNG", compress_level=1)
+    return buf.getvalue(), side
+
+
+def load_app(use_mongomock, max_megapixels):
+    # one client drives every flow, so per-user/IP rate limits would turn sends into 429s;
+    # the memory guard and upload limits would refuse the big covers this benchmark is about
+    os.environ["RATE_LIMIT_BACKEND"] = "off"
+    os.environ["MAX_IMAGE_MEGAPIXELS"] = str(max_megapixels + 1)
+    os.environ["MAX_UPLOAD_MB"] = str(max_megapixels * 4 + 1)  # noise PNGs are ~3 bytes per pixel
+    os.environ["REQUEST_MEMORY_BUDGET_MB"] = "0"
+    os.environ["WORKER_MEMORY_LIMIT_MB"] = "0"
+    if use_mongomock:
+        import mongomock  # type: ignore
+        import pymongo  # type: ignore
+        pymongo.MongoClient = mongomock.MongoClient
+    import app as secapp
+    if secapp.db is None:
+        sys.exit("MongoDB not reachable - start mongod or pass --mongomock")
+    secapp.app.testing = True
+    return secapp
+
+
+def timed(samples, stage, fn):
+    start = time.perf_counter()
+    resp = fn()
+    samples[stage].append(time.perf_counter() - start)
+    if resp.status_code >= 400:
+        raise RuntimeError(f"{stage} failed: HTTP {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+    return resp
+
+
+def run_size(secapp, megapixels, repeat, secret):
+    cover, side = make_cover(megapixels)
+    samples = {stage: [] for stage in STAGES}
+    bytes_before = dir_bytes(secapp.UPLOAD_DIR)
+    bytes_written = 0
+    for _ in range(repeat):
+        run_id = secrets.token_hex(4)
+        sender = secapp.app.test_client()
+        recipient = secapp.app.test_client()
+        a_email = f"bench-a-{run_id}@example.com"
+        b_email = f"bench-b-{run_id}@example.com"
+
+        timed(samples, "register", lambda: sender.post("/register", data={"email": a_email, "password": "bench-pw"}))
+        timed(samples, "register", lambda: recipient.post("/register", data={"email": b_email, "password": "bench-pw"}))
+
+        def pair():
+            sender.post("/pairing/request", data={"partner_email": b_email, "secret_code": "kiwi"})
+            req = secapp.pairings.find_one({"user1_email": a_email, "user2_email": b_email})
+            return recipient.post(f"/pairing/accept/{req['_id']}", data={"secret_code": "kiwi"})
+        timed(samples, "pairing", pair)
+
+        timed(samples, "send", lambda: sender.post(
+            "/send",
+            data={"recipient": b_email, "secret": secret, "image": (io.BytesIO(cover), "cover.png")},
+            content_type="multipart/form-data",
+        ))
+        doc = secapp.messages.find_one({"sender": a_email, "recipient": b_email})
+        # the stego PNG plus its display copy
+        bytes_written += sum(os.path.getsize(p) for p in (doc["image_path"], doc.get("display_path")) if p)
+
+        timed(samples, "view", lambda: recipient.post(f"/view/{doc['token']}", data={"secret_code": "kiwi"}))
+        resp = timed(samples, "reveal", lambda: recipient.get(f"/api/reveal/{doc['token']}"))
+        if resp.get_json().get("message") != secret:
+            raise RuntimeError("revealed message does not match what was sent")
+
+    return {
+        "megapixels": megapixels,
+        "dimensions": [side, side],
+        "cover_bytes": len(cover),
+        "repeat": repeat,
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "bytes_written": bytes_written,
+        "upload_dir_growth": dir_bytes(secapp.UPLOAD_DIR) - bytes_before,
+    }
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    old_by_mp = {r["megapixels"]: r for r in old["results"]}
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    print(f"{'MP':>6} {'stage':<10}{'old p50':>10}{'new p50':>10}{'old p95':>10}{'new p95':>10}{'change':>9}")
+    for r in new["results"]:
+        prev = old_by_mp.get(r["megapixels"])
+        if not prev:
+            continue
+        for stage, s in r["stages"].items():
+            p = prev["stages"].get(stage)
+            if not p or not p["p50_ms"]:
+                continue
+            change = (s["p50_ms"] - p["p50_ms"]) / p["p50_ms"] * 100
+            print(f"{r['megapixels']:>6} {stage:<10}{p['p50_ms']:>10}{s['p50_ms']:>10}{p['p95_ms']:>10}{s['p95_ms']:>10}{change:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated cover sizes in megapixels")
+    parser.add_argument("--repeat", type=int, default=3, help="full flows per cover size")
+    parser.add_argument("--secret-bytes", type=int, default=256, help="length of the secret message")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory mongomock client instead of MONGO_URI")
+    parser.add_argument("--json", dest="json_out", help="write machine-readable results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    upload_dir = tempfile.mkdtemp(prefix="secapp-bench-")
+    os.environ["UPLOAD_DIR"] = upload_dir
+    sizes = [float(s) for s in args.sizes.split(",") if s.strip()]
+    secapp = load_app(args.mongomock, max(sizes))
+    secret = ("x" * args.secret_bytes)
+
+    results = []
+    started = time.perf_counter()
+    for mp in sizes:
+        print(f"[{mp} MP] running {args.repeat} flow(s) ...", flush=True)
+        r = run_size(secapp, mp, args.repeat, secret)
+        results.append(r)
+        send, reveal = r["stages"]["send"], r["stages"]["reveal"]
+        print(f"    send   p50 {send['p50_ms']} ms  p95 {send['p95_ms']} ms  p99 {send['p99_ms']} ms")
+        print(f"    reveal p50 {reveal['p50_ms']} ms  p95 {reveal['p95_ms']} ms  p99 {reveal['p99_ms']} ms")
+        print(f"    bytes written {r['bytes_written']}")
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": "mongomock" if args.mongomock else "mongod",
+        "secret_bytes": args.secret_bytes,
+        "elapsed_sec": round(time.perf_counter() - started, 2),
+        "process_peak_rss_bytes": process_peak_rss_bytes(),
+        "results": results,
+    }
+    print(f"peak RSS of the whole run: {report['process_peak_rss_bytes']}")
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json_out}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Shared pytest fixtures.
+
+`secapp` imports a fresh copy of app.py wired to its own mongomock client,
+Fernet key and scratch directories, so importing it never touches MongoDB or
+writes key files into the checkout. Tests using it are skipped when mongomock
+is not installed (`pip install mongomock`).
+"""
+import sys
+
+import pytest
+from cryptography.fernet import Fernet  # type: ignore
+
+
+@pytest.fixture()
+def secapp(tmp_path, monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    import pymongo  # type: ignore
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setenv("FERNET_KEY", Fernet.generate_key().decode())
+    monkeypatch.setenv("REVEAL_GRANT_SQLITE", str(tmp_path / "reveal_grants.sqlite3"))
+    monkeypatch.setenv("RATE_LIMIT_SQLITE", str(tmp_path / "rate_limits.sqlite3"))
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "off")
+    monkeypatch.setenv("COUNTS_REPAIR_SECONDS", "0")
+    monkeypatch.setenv("INBOX_EVENTS", "off")
+    monkeypatch.setenv("TRACE_ENABLED", "false")
+    monkeypatch.setattr(pymongo, "MongoClient", mongomock.MongoClient)
+    monkeypatch.delitem(sys.modules, "app", raising=False)
+    import app
+    app.app.testing = True
+    return app
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Synthetic dataset generator for scale-testing the MongoDB schema.
+
+Bulk-loads users, pairings and messages shaped exactly like the documents
+app.py writes (partners arrays, inbox counters, token hashes, display copy
+metadata) with insert_many batches, then runs the hot queries behind
+index(), search_user, request_pairing, api_reveal and clear-logs and reports
+their latency next to explain() executionStats (plan stages, keys and
+documents examined).
+
+Load is skewed the way real inboxes are:
+  * message recipients follow a Zipf distribution (--skew), so user 0 has the
+    heaviest inbox and most users get a handful of messages;
+  * every user has --partners * 2 partners, and --power-users of them get an
+    extra --power-partners each;
+  * pending pairing requests pile up on the same heavy users.
+
+Senders are always a partner of the recipient. Image files are not written;
+image_path points at files that do not exist.
+
+Point it at a scratch mongod: it writes to --db (default secAppDB_scale) and
+--drop wipes that database first. Indexes and query projections come from
+schema.py; app.py itself is never imported (it would connect to MONGO_URI,
+start its background jobs and load or create Fernet keys). Messages carry
+--key-id as their key fingerprint.
+
+Examples:
+    python gen_dataset.py --users 10000 --messages 200000 --drop
+    python gen_dataset.py --users 1000000 --messages 50000000 --batch 20000 --drop --json scale.json
+    python gen_dataset.py --queries-only --users 1000000 --repeat 20
+    python gen_dataset.py --mongomock --users 2000 --messages 20000   # dry run, no explain()
+"""
+import argparse
+import base64
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_DB = "secAppDB_scale"
+PLACEHOLDER = "data:image/webp;base64," + "A" * 320  # typical display_placeholder size
+
+
+def email_of(i):
+    return f"user{i:07d}@scale.test"
+
+
+def pairing_oid(a, b):
+    """Deterministic pairing _id, so user docs can point at pairings without a lookup."""
+    from bson import ObjectId  # type: ignore
+    return ObjectId(b"\x5c\xa1\x00\x00" + a.to_bytes(4, "big") + b.to_bytes(4, "big"))
+
+
+def code_hash(a, b):
+    return hashlib.sha256(f"code-{min(a, b)}-{max(a, b)}".encode()).hexdigest()
+
+
+def token(rng, nbytes):
+    return base64.urlsafe_b64encode(rng.randbytes(nbytes)).rstrip(b"=").decode()
+
+
+class Shape:
+    """Who is paired with whom. Regular pairs are derived from fixed offsets, so
+    partners_of() needs no storage; power users' extra partners are kept in a dict."""
+
+    def __init__(self, n_users, partners, power_users, power_partners, seed):
+        self.n = n_users
+        # distinct offsets below n/2: pair (i, i+off) never repeats in reverse
+        span = max(1, (n_users - 1) // 2)
+        self.offsets = sorted({1 + (k * 7919) % span for k in range(min(partners, span))})
+        step = max(1, n_users // (power_users + 1)) if power_users else 0
+        self.power = [step * (k + 1) for k in range(power_users)] if power_users else []
+        self.extra = {}
+        self.power_pairs = set()  # (user1, user2) of every extra pairing
+        rng = random.Random(seed)
+        for p in self.power:
+            base = set(self._base(p))
+            for _ in range(power_partners):
+                j = rng.randrange(n_users)
+                if j == p or j in base or j in self.extra.get(p, ()):
+                    continue
+                self.power_pairs.add((p, j))
+                self.extra.setdefault(p, []).append(j)
+                self.extra.setdefault(j, []).append(p)
+
+    def _base(self, i):
+        return [(i + off) % self.n for off in self.offsets] + [(i - off) % self.n for off in self.offsets]
+
+    def partners_of(self, i):
+        return self._base(i) + self.extra.get(i, [])
+
+    def pairs(self):
+        """Every accepted pairing once, as (user1, user2)."""
+        for i in range(self.n):
+            for off in self.offsets:
+                yield i, (i + off) % self.n
+        yield from self.power_pairs
+
+    def ordered(self, a, b):
+        """(user1, user2) of the pairing between a and b."""
+        if (b - a) % self.n in self.offsets or (a, b) in self.power_pairs:
+            return a, b
+        return b, a
+
+
+class Loader:
+    def __init__(self, database, batch):
+        self.db = database
+        self.batch = batch
+        self.inserted = {}
+
+    def insert(self, name, docs):
+        coll = self.db[name]
+        started = time.perf_counter()
+        total = 0
+        for chunk in iter(lambda: list(itertools.islice(docs, self.batch)), []):
+            coll.insert_many(chunk, ordered=False)
+            total += len(chunk)
+            if total % (self.batch * 20) == 0:
+                rate = total / (time.perf_counter() - started)
+                print(f"    {name}: {total:,} ({rate:,.0f} docs/s)", flush=True)
+        elapsed = time.perf_counter() - started
+        self.inserted[name] = {"docs": total, "sec": round(elapsed, 1),
+                               "docs_per_sec": round(total / elapsed) if elapsed else 0}
+        print(f"  {name}: {total:,} docs in {elapsed:.1f}s", flush=True)
+
+
+def gen_pairings(shape, args, rng, pending_counts, now):
+    for a, b in shape.pairs():
+        created = now - timedelta(days=rng.uniform(args.days, args.days * 2))
+        yield {
+            "_id": pairing_oid(a, b),
+            "user1_email": email_of(a),
+            "user2_email": email_of(b),
+            "status": "paired",
+            "requested_by": email_of(a),
+            "secret_code_hash": code_hash(a, b),
+            "created_at": created,
+            "accepted_at": created + timedelta(hours=rng.uniform(0, 48)),
+        }
+    # pending requests land on heavy users too
+    for _ in range(int(args.users * args.pending)):
+        to = pick_recipient(rng, args.cum_weights)
+        frm = rng.randrange(args.users)
+        if frm == to:
+            continue
+        pending_counts[to] += 1
+        yield {
+            "user1_email": email_of(frm),
+            "user2_email": email_of(to),
+            "status": "pending",
+            "requested_by": email_of(frm),
+            "secret_code_hash": hashlib.sha256(token(rng, 6).encode()).hexdigest(),
+            "created_at": now - timedelta(days=rng.uniform(0, args.days)),
+        }
+
+
+def pick_recipient(rng, cum_weights):
+    return bisect.bisect(cum_weights, rng.random() * cum_weights[-1])
+
+
+def gen_messages(shape, args, rng, unread, viewed, key_id, now):
+    start = now - timedelta(days=args.days)
+    step = timedelta(days=args.days) / max(1, args.messages)
+    for n in range(args.messages):
+        to = pick_recipient(rng, args.cum_weights)
+        frm = rng.choice(shape.partners_of(to))
+        message_id = token(rng, 10)
+        tok = token(rng, 18)
+        created = start + step * n
+        seen = rng.random() < args.viewed
+        (viewed if seen else unread)[to] += 1
+        doc = {
+            "message_id": message_id,
+            "sender": email_of(frm),
+            "recipient": email_of(to),
+            "image_path": os.path.join("uploads", f"stego_{message_id}.png"),
+            "token": tok,
+            "token_hash": hashlib.sha256(tok.encode()).hexdigest(),
+            "secret_code_hash": code_hash(frm, to),
+            "key_id": key_id,
+            "created_at": created,
+            "viewed": seen,
+            "display_path": os.path.join("uploads", f"display_{message_id}.webp"),
+            "display_size": [1280, 960],
+            "display_placeholder": PLACEHOLDER,
+        }
+        if seen:
+            doc["viewed_at"] = created + timedelta(minutes=rng.uniform(1, 600))
+        yield doc
+
+
+def gen_users(shape, args, rng, unread, viewed, pending_counts, password_hash, now):
+    for i in range(args.users):
+        partners = []
+        for j in shape.partners_of(i):
+            partners.append({"email": email_of(j), "pairing_id": str(pairing_oid(*shape.ordered(i, j))),
+                             "code_hash": code_hash(i, j), "since": now - timedelta(days=args.days)})
+        yield {
+            "_id": token(rng, 12),
+            "email": email_of(i),
+            "password": password_hash,
+            "pairing_code": token(rng, 8).upper(),
+            "partners": partners,
+            "counts": {"unread": unread[i], "viewed": viewed[i], "pending": pending_counts[i]},
+        }
+
+
+def load(database, args):
+    import bcrypt  # type: ignore
+    from schema import ensure_indexes
+
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    shape = Shape(args.users, args.partners, args.power_users, args.power_partners, args.seed)
+    unread, viewed, pending_counts = (array("I", bytes(4 * args.users)) for _ in range(3))
+    loader = Loader(database, args.batch)
+
+    print(f"Loading {args.users:,} users / {args.messages:,} messages into {database.name} ...", flush=True)
+    loader.insert("pairings", gen_pairings(shape, args, rng, pending_counts, now))
+    loader.insert("messages", gen_messages(shape, args, rng, unread, viewed, args.key_id, now))
+    # one real bcrypt hash shared by every user; logins still take realistic time
+    password_hash = bcrypt.hashpw(b"scale-test", bcrypt.gensalt())
+    loader.insert("users", gen_users(shape, args, rng, unread, viewed, pending_counts, password_hash, now))
+
+    started = time.perf_counter()
+    ensure_indexes(database)
+    print(f"  indexes built in {time.perf_counter() - started:.1f}s", flush=True)
+    return loader.inserted, shape
+
+
+def plan_stages(plan):
+    """Stage names of a winning plan, outermost first (classic and SBE explain output)."""
+    stages = []
+    while plan:
+        plan = plan.get("queryPlan", plan)
+        stages.append(plan.get("stage", "?"))
+        inputs = plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else [])
+        plan = inputs[0] if inputs else None
+    return stages
+
+
+def explain_summary(cursor):
+    try:
+        info = cursor.explain()
+    except Exception as e:  # mongomock has no explain
+        return {"error": type(e).__name__}
+    stats = info.get("executionStats", {})
+    return {
+        "plan": plan_stages(info.get("queryPlanner", {}).get("winningPlan", {})),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "returned": stats.get("nReturned"),
+        "server_ms": stats.get("executionTimeMillis"),
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def hot_queries(database, user, partner, clear_batch):
+    """(name, cursor factory) pairs mirroring the app's queries for one user."""
+    from schema import INBOX_FIELDS, PAIRING_FIELDS
+    email = user["email"]
+    users, messages, pairings = database.users, database.messages, database.pairings
+    sample = messages.find_one({"recipient": email}, {"token_hash": 1}) or {"token_hash": "0" * 64}
+    return [
+        ("index: current_user", lambda: users.find({"_id": user["_id"]}).limit(1)),
+        ("index: inbox_for", lambda: messages.find({"recipient": email}, INBOX_FIELDS).sort("created_at", -1)),
+        ("index: pending_requests_for", lambda: pairings.find({"user2_email": email, "status": "pending"}, PAIRING_FIELDS)),
+        ("search_user: regex", lambda: users.find({"email": {"$regex": email[:9], "$options": "i"}})),
+        ("request_pairing: partner", lambda: users.find({"email": partner}).limit(1)),
+        ("request_pairing: find_pairing", lambda: pairings.find({"$or": [
+            {"user1_email": email, "user2_email": partner, "status": "paired"},
+            {"user1_email": partner, "user2_email": email, "status": "paired"},
+        ]}).limit(1)),
+        ("api_reveal: token lookup", lambda: messages.find({"token_hash": sample["token_hash"]}).limit(1)),
+        ("clear_logs: first batch", lambda: messages.find(
+            {"viewed": True, "recipient": email, "created_at": {"$lte": datetime.now(timezone.utc)}},
+            {"_id": 1, "viewed": 1, "image_path": 1, "display_path": 1}).sort("_id", 1).limit(clear_batch)),
+    ]
+
+
+def run_queries(database, shape, args):
+    import pymongo  # type: ignore
+    from pymongo.errors import PyMongoError  # type: ignore
+    typical = args.users // 2 + 1
+    while typical in shape.extra:
+        typical += 1
+    profiles = {"heavy": 0, "typical": typical}
+    if shape.power:
+        profiles["power"] = shape.power[0]
+
+    report = {}
+    print(f"\n{'profile':<9}{'query':<32}{'p50 ms':>9}{'p95 ms':>9}{'rows':>9}  plan / keys / docs examined")
+    for label, idx in profiles.items():
+        user = database.users.find_one({"email": email_of(idx)}, {"email": 1})
+        if not user:
+            sys.exit(f"{email_of(idx)} not found - load the dataset first (or match --users to the loaded one)")
+        partner = email_of(shape.partners_of(idx)[0])
+        report[label] = {"email": user["email"], "queries": {}}
+        for name, make in hot_queries(database, user, partner, args.clear_batch):
+            samples, rows, error = [], 0, None
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                try:
+                    with pymongo.timeout(args.query_timeout):
+                        rows = sum(1 for _ in make())
+                except PyMongoError as e:
+                    error = type(e).__name__
+                    break
+                samples.append(time.perf_counter() - started)
+            samples.sort()
+            row = {
+                "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                "p95_ms": round(percentile(samples, 95) * 1000, 2),
+                "rows": rows,
+                "explain": explain_summary(make()) if not error else None,
+                "error": error,
+            }
+            report[label]["queries"][name] = row
+            ex = row["explain"] or {}
+            detail = error or ex.get("error") or f"{'>'.join(ex.get('plan', []))} / {ex.get('keys_examined')} / {ex.get('docs_examined')}"
+            print(f"{label:<9}{name:<32}{row['p50_ms']:>9}{row['p95_ms']:>9}{rows:>9}  {detail}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default=os.environ.get("MONGO_URI") or "mongodb://localhost:27017/")
+    parser.add_argument("--db", default=DEFAULT_DB, help="database to fill (not the app's secAppDB)")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--batch", type=int, default=10_000, help="documents per insert_many")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for recipients (0 = uniform)")
+    parser.add_argument("--partners", type=int, default=2, help="regular pairings started per user (each user ends up with twice this)")
+    parser.add_argument("--power-users", type=int, default=100, help="users with --power-partners extra partners")
+    parser.add_argument("--power-partners", type=int, default=500)
+    parser.add_argument("--pending", type=float, default=0.05, help="pending pairing requests per user")
+    parser.add_argument("--viewed", type=float, default=0.6, help="share of messages already revealed")
+    parser.add_argument("--days", type=float, default=90, help="messages are spread over this many days")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--key-id", default="synthetic",
+                        help="key fingerprint stamped on messages (schema.key_id() of the app's primary Fernet key)")
+    parser.add_argument("--clear-batch", type=int, default=int(os.environ.get("CLEAR_BATCH", "500")),
+                        help="batch size of the clear-logs query (app.py's CLEAR_BATCH)")
+    parser.add_argument("--drop", action="store_true", help="drop --db before loading")
+    parser.add_argument("--queries-only", action="store_true", help="skip loading, only time the hot queries")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per query")
+    parser.add_argument("--query-timeout", type=float, default=60, help="seconds before a query counts as timed out")
+    parser.add_argument("--mongomock", action="store_true", help="dry run against an in-memory mongomock client")
+    parser.add_argument("--json", dest="json_out", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    if args.db == "secAppDB" and args.drop:
+        sys.exit("refusing to --drop the app's own database")
+
+    # schema.py provides ensure_indexes and the query projections
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pymongo  # type: ignore
+    from pymongo.errors import PyMongoError  # type: ignore
+    if args.mongomock:
+        import mongomock  # type: ignore
+        pymongo.MongoClient = mongomock.MongoClient
+    client = pymongo.MongoClient(args.uri, serverSelectionTimeoutMS=5000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError as e:
+        sys.exit(f"MongoDB not reachable at {args.uri}: {e}")
+    database = client[args.db]
+
+    weights = [1.0 / (i + 1) ** args.skew for i in range(args.users)]
+    args.cum_weights = list(itertools.accumulate(weights))
+
+    report = {"args": {k: v for k, v in vars(args).items() if k != "cum_weights"}}
+    if args.drop:
+        client.drop_database(args.db)
+    if args.queries_only:
+        shape = Shape(args.users, args.partners, args.power_users, args.power_partners, args.seed)
+    else:
+        report["load"], shape = load(database, args)
+    report["collections"] = {name: database[name].estimated_document_count() for name in ("users", "pairings", "messages")}
+    report["queries"] = run_queries(database, shape, args)
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"\nResults written to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
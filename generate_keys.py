@@ -19,6 +19,9 @@ print()
 fernet_key = Fernet.generate_key().decode()
 print("FERNET_KEY=" + fernet_key)
 print()
+print("To rotate keys later, put the new key first and keep the old ones:")
+print("FERNET_KEYS=<new key>,<old key>")
+print()
 
 print("=" * 60)
 print("Copy these values to your .env file")
@@ -0,0 +1,55 @@
+"""
+Gunicorn settings for SecApp.
+
+Gunicorn picks this file up automatically, so the Procfile / railway.json /
+render.yaml start command (`gunicorn app:app --bind 0.0.0.0:$PORT`) stays the same.
+
+Serving modes (set WEB_WORKER_CLASS):
+  sync    - default, one request per worker process
+  gthread - WEB_THREADS threads per worker
+  gevent  - WEB_WORKER_CONNECTIONS greenlets per worker (needs `pip install gevent`)
+
+Under gevent the worker monkey-patches the stdlib *before* app.py is imported,
+so pymongo's sockets and locks become cooperative. That is why preload_app
+stays off: the MongoClient must be created after patching, inside each worker.
+CPU-heavy stego work (embed/extract + PNG encode) would block the event loop
+(or hold the GIL against the other threads), so for gthread and gevent this
+file defaults STEGO_POOL_WORKERS (app.py) to 2, a process pool per worker.
+Set STEGO_POOL_WORKERS yourself to size it, or to 0 to run stego inline.
+
+Worker processes: WEB_CONCURRENCY, default 1 (gunicorn's own default). To scale
+up, set WEB_CONCURRENCY to about 2 * cores + 1 of the CPUs actually allotted to
+the container (os.cpu_count() reports the host's), make sure FERNET_KEY/
+FERNET_KEYS is set so every worker uses the same key, and budget memory per
+worker (the cover cache alone is COVER_CACHE_MB each).
+
+The live inbox stream (/api/v1/events) needs gthread or gevent: each open
+stream holds a thread or greenlet. Under sync workers it answers 204 and the
+dashboard polls instead.
+"""
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+
+worker_class = os.environ.get("WEB_WORKER_CLASS", "sync")
+if worker_class == "gevent":
+    try:
+        import gevent  # type: ignore  # noqa: F401
+    except ImportError:
+        print("⚠️  WEB_WORKER_CLASS=gevent but gevent is not installed, falling back to gthread")
+        worker_class = "gthread"
+
+if worker_class != "sync":
+    # read by app.py in each worker, which inherits the master's environment
+    os.environ.setdefault("STEGO_POOL_WORKERS", "2")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+threads = int(os.environ.get("WEB_THREADS", "8")) if worker_class == "gthread" else 1
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS", "200"))
+
+# Stego embeds of large covers can take several seconds
+timeout = int(os.environ.get("WEB_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+preload_app = False
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Load-test harness: compare requests/sec and tail latency across gunicorn worker classes.
+
+For each worker class it starts `gunicorn app:app` (using gunicorn.conf.py),
+hammers the given paths with N concurrent keep-alive clients for a fixed time
+and prints throughput plus p50/p95/p99 latency.
+
+Examples:
+    python loadtest.py
+    python loadtest.py --worker-classes sync,gthread,gevent --concurrency 64 --duration 20
+    python loadtest.py --paths / /view/<token> --cookie "session=..." --json results.json
+
+Use --url to test an already running server instead of spawning gunicorn.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def wait_for_server(host, port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request("GET", "/favicon.ico")
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.25)
+    return False
+
+
+def client_loop(host, port, paths, headers, stop_at, latencies, errors, lock):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    local_lat = []
+    local_err = 0
+    i = 0
+    while time.perf_counter() < stop_at:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status >= 500:
+                local_err += 1
+        except (OSError, http.client.HTTPException):
+            local_err += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        local_lat.append(time.perf_counter() - start)
+    conn.close()
+    with lock:
+        latencies.extend(local_lat)
+        errors[0] += local_err
+
+
+def run_load(host, port, paths, concurrency, duration, headers):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=client_loop, args=(host, port, paths, headers, stop_at, latencies, errors, lock))
+        for _ in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round((latencies[-1] if latencies else 0.0) * 1000, 2),
+    }
+
+
+def start_gunicorn(worker_class, port, workers):
+    env = dict(os.environ)
+    env["WEB_WORKER_CLASS"] = worker_class
+    env["WEB_CONCURRENCY"] = str(workers)
+    env["PORT"] = str(port)
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}", "--log-level", "warning"],
+        env=env,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker-classes", default="sync,gthread,gevent", help="comma-separated gunicorn worker classes")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes per run")
+    parser.add_argument("--paths", nargs="+", default=["/", "/favicon.ico"], help="paths to request round-robin")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per worker class")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cookie", help="Cookie header to send (e.g. a logged-in session)")
+    parser.add_argument("--url", help="test an already running server instead of spawning gunicorn")
+    parser.add_argument("--json", dest="json_out", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    headers = {"Connection": "keep-alive"}
+    if args.cookie:
+        headers["Cookie"] = args.cookie
+
+    results = {}
+    if args.url:
+        parts = urlsplit(args.url)
+        targets = [(parts.hostname, parts.port or 80, "external")]
+    else:
+        targets = [("127.0.0.1", args.port, wc.strip()) for wc in args.worker_classes.split(",") if wc.strip()]
+
+    for host, port, label in targets:
+        proc = None
+        if label == "gevent" and importlib.util.find_spec("gevent") is None:
+            # gunicorn.conf.py would quietly fall back to gthread and the numbers would be mislabeled
+            print("[gevent] gevent is not installed (pip install gevent), skipping")
+            continue
+        if label != "external":
+            proc = start_gunicorn(label, port, args.workers)
+        try:
+            if not wait_for_server(host, port):
+                print(f"[{label}] server did not come up, skipping")
+                continue
+            print(f"[{label}] {args.concurrency} clients x {args.duration:.0f}s ...")
+            results[label] = run_load(host, port, args.paths, args.concurrency, args.duration, headers)
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait(timeout=30)
+
+    print()
+    print(f"{'worker class':<14}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for label, r in results.items():
+        print(f"{label:<14}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['errors']:>8}")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({
+                "paths": args.paths,
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "results": results,
+            }, f, indent=2)
+        print(f"\nResults written to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
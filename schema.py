@@ -0,0 +1,32 @@
+"""
+MongoDB indexes and shared query projections.
+
+Kept free of side effects (no connection, no key loading) so tools such as
+gen_dataset.py can import it without starting the app.
+"""
+import hashlib
+
+# Projections keep documents small; nothing here needs the full message doc.
+INBOX_FIELDS = {"_id": 0, "message_id": 1, "sender": 1, "created_at": 1, "viewed": 1, "token": 1}
+PAIRING_FIELDS = {"user1_email": 1, "user2_email": 1, "status": 1, "created_at": 1, "secret_code_hash": 1}
+
+
+def key_id(key):
+    """Short, non-secret fingerprint of a key, stored on messages to track rotation."""
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+def ensure_indexes(database):
+    """Indexes the queries in app.py rely on (also used by gen_dataset.py)."""
+    # the inbox query filters on recipient and sorts by created_at
+    database.messages.create_index([("recipient", 1), ("created_at", -1)])
+    database.messages.create_index([("viewed_at", 1)], sparse=True)
+    database.messages.create_index([("recipient", 1), ("viewed", 1)])
+    # send-status polls (/api/v1/messages/<id>) look messages up by message_id
+    database.messages.create_index("message_id", unique=True)
+    database.users.create_index("partners.email")
+    database.pairings.create_index("status")
+    database.jobs.create_index("expires_at", expireAfterSeconds=0)
+    database.pairings.create_index([("user2_email", 1), ("status", 1)])
+    # the SSE poller's "accepted since" query (requester side)
+    database.pairings.create_index([("user1_email", 1), ("status", 1), ("accepted_at", 1)])
@@ -0,0 +1,210 @@
+"""
+LSB steganography codec: embed a payload in a cover image and extract it again.
+
+Pure functions on PIL images with no app state, so the codec tests and
+bench_codec.py can import it without the database or keys app.py loads.
+"""
+from PIL import Image  # type: ignore
+
+MAX_PAYLOAD_BYTES = 20000
+
+# Embedding modes, as (bits per channel, use alpha channel), in order of preference.
+# (1, False) is the original format: 4-byte length prefix, 1 LSB per R/G/B, no header.
+# It is always used when the payload fits, so those images stay readable by older
+# deployments. The denser modes write a 5-byte header (magic, mode, 3-byte length)
+# into the 1-bit R/G/B LSBs of the first HEADER_PIXELS pixels; the original format
+# always starts with a zero byte there, which is how extraction tells them apart.
+LEGACY_MODE = (1, False)
+EMBED_MODES = [LEGACY_MODE, (1, True), (2, False), (2, True)]
+STEGO_MAGIC = 0xA7
+HEADER_BYTES = 5
+HEADER_PIXELS = (HEADER_BYTES * 8 + 2) // 3
+RGB_CHANNELS = (0, 1, 2)
+RGBA_CHANNELS = (0, 1, 2, 3)
+
+def _bytes_to_bits(b: bytes):
+    for byte in b:
+        for i in range(8):
+            yield (byte >> (7 - i)) & 1
+
+def image_has_alpha(img: Image.Image) -> bool:
+    """True if the cover itself carries an alpha channel (known from the header alone)."""
+    return img.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in img.info
+
+def mode_capacity(size, mode) -> int:
+    """Bytes of payload a (width, height) cover can carry in the given embedding mode."""
+    pixels = size[0] * size[1]
+    bits, use_alpha = mode
+    if mode == LEGACY_MODE:
+        return max(0, (pixels * 3 - 32) // 8)
+    return max(0, (pixels - HEADER_PIXELS) * (4 if use_alpha else 3) * bits // 8)
+
+def choose_embed_mode(size, payload_len, use_alpha=False):
+    """Least dense mode that fits payload_len bytes, or None if none does."""
+    for mode in EMBED_MODES:
+        if mode[1] and not use_alpha:
+            continue
+        if mode_capacity(size, mode) >= payload_len:
+            return mode
+    return None
+
+def payload_capacity(size, use_alpha=False) -> int:
+    """Bytes of payload a cover of the given (width, height) can carry."""
+    return max(mode_capacity(size, mode) for mode in EMBED_MODES if use_alpha or not mode[1])
+
+def _lsb_positions(first_pixel, channels):
+    pixel = first_pixel
+    while True:
+        for c in channels:
+            yield pixel * 4 + c
+        pixel += 1
+
+def _lsb_write(raw: bytearray, data: bytes, first_pixel: int, channels, bits: int):
+    """Write data MSB-first into the low `bits` bits of the given RGBA channels."""
+    mask = (1 << bits) - 1
+    keep = 0xFF & ~mask
+    positions = _lsb_positions(first_pixel, channels)
+    for byte in data:
+        for shift in range(8 - bits, -1, -bits):
+            idx = next(positions)
+            raw[idx] = (raw[idx] & keep) | ((byte >> shift) & mask)
+
+def _lsb_read(raw: bytes, nbytes: int, first_pixel: int, channels, bits: int) -> bytes:
+    mask = (1 << bits) - 1
+    positions = _lsb_positions(first_pixel, channels)
+    out = bytearray()
+    for _ in range(nbytes):
+        byte = 0
+        for _ in range(8 // bits):
+            byte = (byte << bits) | (raw[next(positions)] & mask)
+        out.append(byte)
+    return bytes(out)
+
+def embed_bytes_in_image(img: Image.Image, payload: bytes, use_alpha=None) -> Image.Image:
+    """Embed encrypted payload into image using LSB steganography.
+
+    Uses the original 1-bit RGB format when the payload fits, otherwise the first
+    denser mode in EMBED_MODES that does. The alpha channel is only used when
+    use_alpha is true (default: when the image has one).
+    """
+    if len(payload) > MAX_PAYLOAD_BYTES:  # crude safety
+        raise ValueError("Payload too large")
+    if use_alpha is None:
+        use_alpha = image_has_alpha(img)
+
+    mode = choose_embed_mode(img.size, len(payload), use_alpha)
+    if mode is None:
+        raise ValueError(f"Image too small to hold payload. Need {len(payload)} bytes, "
+                         f"{img.size[0]}x{img.size[1]} holds {payload_capacity(img.size, use_alpha)}")
+
+    # Convert to RGBA to ensure we have RGB channels (read-only, so RGBA input is used as is)
+    rgba_img = img if img.mode == "RGBA" else img.convert("RGBA")
+
+    if mode != LEGACY_MODE:
+        bits, alpha = mode
+        raw = bytearray(rgba_img.tobytes())
+        header = bytes([STEGO_MAGIC, bits | (0x10 if alpha else 0)]) + len(payload).to_bytes(3, "big")
+        _lsb_write(raw, header, 0, RGB_CHANNELS, 1)
+        _lsb_write(raw, payload, HEADER_PIXELS, RGBA_CHANNELS if alpha else RGB_CHANNELS, bits)
+        return Image.frombytes("RGBA", rgba_img.size, bytes(raw))
+
+    pixels = list(rgba_img.getdata())  # type: ignore
+    
+    # Prepare data: 4-byte length prefix + payload
+    length_prefix = len(payload).to_bytes(4, "big")
+    data = length_prefix + payload
+    bits = list(_bytes_to_bits(data))
+    
+    # Embed bits into LSB of RGB channels
+    new_pixels = []
+    bit_idx = 0
+    for px in pixels:
+        r, g, b, a = px
+        if bit_idx < len(bits):
+            r = (r & ~1) | bits[bit_idx]  # Clear LSB, set to data bit
+            bit_idx += 1
+        if bit_idx < len(bits):
+            g = (g & ~1) | bits[bit_idx]
+            bit_idx += 1
+        if bit_idx < len(bits):
+            b = (b & ~1) | bits[bit_idx]
+            bit_idx += 1
+        new_pixels.append((r, g, b, a))
+    
+    if bit_idx < len(bits):
+        raise ValueError(f"Not all bits embedded. Embedded {bit_idx}/{len(bits)} bits")
+    
+    # Create new image with embedded data
+    out = Image.new("RGBA", rgba_img.size)
+    out.putdata(new_pixels)
+    return out
+
+def embed_mode_of(img: Image.Image):
+    """Embedding mode of a stego image, from its header (LEGACY_MODE if it has none)."""
+    rgba_img = img if img.mode == "RGBA" else img.convert("RGBA")
+    if rgba_img.size[0] * rgba_img.size[1] < HEADER_PIXELS:
+        return LEGACY_MODE
+    header = _lsb_read(rgba_img.tobytes(), 2, 0, RGB_CHANNELS, 1)
+    if header[0] != STEGO_MAGIC:
+        return LEGACY_MODE
+    return (header[1] & 0x0F, bool(header[1] & 0x10))
+
+def extract_bytes_from_image(img: Image.Image) -> bytes:
+    """Extract encrypted payload from image, auto-detecting the embedding mode."""
+    # Convert to RGBA to ensure consistent format
+    rgba_img = img if img.mode == "RGBA" else img.convert("RGBA")
+
+    if rgba_img.size[0] * rgba_img.size[1] >= HEADER_PIXELS:
+        raw = rgba_img.tobytes()
+        header = _lsb_read(raw, HEADER_BYTES, 0, RGB_CHANNELS, 1)
+        if header[0] == STEGO_MAGIC:
+            bits, alpha = header[1] & 0x0F, bool(header[1] & 0x10)
+            if (bits, alpha) not in EMBED_MODES:
+                raise ValueError(f"Unknown embedding mode: {header[1]:#x}")
+            length = int.from_bytes(header[2:], "big")
+            if length == 0 or length > MAX_PAYLOAD_BYTES:  # Sanity check
+                raise ValueError(f"Invalid payload length: {length}")
+            if length > mode_capacity(rgba_img.size, (bits, alpha)):
+                raise ValueError(f"Incomplete payload in image. Need {length} bytes")
+            return _lsb_read(raw, length, HEADER_PIXELS, RGBA_CHANNELS if alpha else RGB_CHANNELS, bits)
+
+    pixels = list(rgba_img.getdata())  # type: ignore
+    
+    # Extract LSB from RGB channels
+    bits = []
+    for px in pixels:
+        r, g, b, _ = px  # Alpha channel not used for extraction
+        bits.append(r & 1)  # Extract LSB from red channel
+        bits.append(g & 1)  # Extract LSB from green channel
+        bits.append(b & 1)  # Extract LSB from blue channel
+    
+    if len(bits) < 32:
+        raise ValueError("Image too small or contains no embedded data")
+    
+    # Read 32-bit length prefix
+    length = 0
+    for bit in bits[:32]:
+        length = (length << 1) | bit
+    
+    if length == 0 or length > MAX_PAYLOAD_BYTES:  # Sanity check
+        raise ValueError(f"Invalid payload length: {length}")
+    
+    # Calculate total bits needed
+    total_bits_needed = 32 + length * 8
+    if total_bits_needed > len(bits):
+        raise ValueError(f"Incomplete payload in image. Need {total_bits_needed} bits, have {len(bits)}")
+    
+    # Extract payload bits (after 32-bit length prefix)
+    payload_bits = bits[32:32 + length * 8]
+    
+    # Convert bits back to bytes
+    payload_bytes = bytearray()
+    for i in range(0, len(payload_bits), 8):
+        if i + 8 > len(payload_bits):
+            break
+        byte = 0
+        for bit in payload_bits[i:i+8]:
+            byte = (byte << 1) | bit
+        payload_bytes.append(byte)
+    
+    return bytes(payload_bytes)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+Route-level tests for app.py against an in-memory MongoDB (mongomock).
+
+Every test imports a fresh copy of app.py wired to its own mongomock client and
+upload directory (the `secapp` fixture in conftest.py); background jobs and rate
+limits are off unless a test turns them on. Skipped when mongomock is not
+installed (`pip install mongomock`).
+
+Run with: python -m pytest -q test_app.py
+"""
+import gzip
+import io
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+from cryptography.fernet import Fernet, MultiFernet  # type: ignore
+
+pytest.importorskip("mongomock")
+from PIL import Image  # type: ignore  # noqa: E402
+from pymongo.errors import ConnectionFailure  # type: ignore  # noqa: E402
+
+
+def cover_png(side=120):
+    buf = io.BytesIO()
+    Image.new("RGB", (side, side), (10, 20, 30)).save(buf, "PNG")
+    buf.seek(0)
+    return buf
+
+
+def register(secapp, email):
+    client = secapp.app.test_client()
+    client.post("/register", data={"email": email, "password": "pw-" + email})
+    return client
+
+
+def pair(secapp, requester, email_a, recipient, email_b, code="kiwi"):
+    requester.post("/pairing/request", data={"partner_email": email_b, "secret_code": code})
+    pairing = secapp.pairings.find_one({"user1_email": email_a, "user2_email": email_b})
+    return recipient.post(f"/pairing/accept/{pairing['_id']}", data={"secret_code": code})
+
+
+def send(client, recipient, secret="hello", image=None):
+    image = image if image is not None else cover_png()
+    return client.post("/send", data={"recipient": recipient, "secret": secret, "image": (image, "c.png")},
+                       content_type="multipart/form-data")
+
+
+def test_rate_limited_api_request_answers_json(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "rate_buckets", secapp.TokenBuckets())
+    monkeypatch.setattr(secapp, "RATE_LIMIT_BURST", secapp.ROUTE_COSTS["api_send"])
+    monkeypatch.setattr(secapp, "RATE_LIMIT_PER_SECOND", 0.001)
+    client = register(secapp, "a@x.com")
+    assert client.post("/api/v1/messages").status_code == 400  # spends the whole burst
+    resp = client.post("/api/v1/messages")
+    assert resp.status_code == 429
+    assert resp.get_json()["error"] == "rate_limited"
+    assert int(resp.headers["Retry-After"]) > 0
+
+
+def test_display_copy_of_opaque_cover_has_no_alpha(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "STEGO_POOL_WORKERS", 0)
+    monkeypatch.setattr(secapp, "DISPLAY_FORMAT", "webp")
+    saved, real_save = [], Image.Image.save
+    def spy(img, fp, format=None, **params):
+        saved.append((format, img.mode))
+        return real_save(img, fp, format, **params)
+    monkeypatch.setattr(Image.Image, "save", spy)
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    assert ("WEBP", "RGB") in saved  # the cover is converted to RGBA for embedding only
+    assert ("WEBP", "RGBA") not in saved
+
+
+def test_accept_between_partners_backfill_read_and_write_is_kept(secapp, monkeypatch):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    c = register(secapp, "c@x.com")
+    pair(secapp, c, "c@x.com", b, "b@x.com")
+    secapp.users.update_many({}, {"$unset": {"partners": ""}})  # accounts from before the array existed
+    a.post("/pairing/request", data={"partner_email": "b@x.com", "secret_code": "kiwi"})
+    real = secapp.partners_of
+    def stale_read(email):
+        found = real(email)
+        if email == "b@x.com":
+            monkeypatch.setattr(secapp, "partners_of", real)
+            pair_id = secapp.pairings.find_one({"user1_email": "a@x.com"})["_id"]
+            b.post(f"/pairing/accept/{pair_id}", data={"secret_code": "kiwi"})  # lands mid-backfill
+        return found
+    monkeypatch.setattr(secapp, "partners_of", stale_read)
+    secapp.user_partners(secapp.users.find_one({"email": "b@x.com"}))
+    stored = secapp.users.find_one({"email": "b@x.com"})["partners"]
+    assert sorted(p["email"] for p in stored) == ["a@x.com", "c@x.com"]
+    assert secapp.check_partner_links() == {}
+
+
+def test_send_right_after_accept(secapp):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    secapp.users.update_many({}, {"$unset": {"partners": ""}})
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    send(b, "a@x.com")
+    assert secapp.messages.count_documents({}) == 2
+    assert secapp.check_partner_links() == {}
+
+
+def test_recount_keeps_a_send_that_lands_during_the_tally(secapp, monkeypatch):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    secapp.user_counts(secapp.users.find_one({"email": "b@x.com"}))
+    real = secapp._tally_counts
+    def slow_tally(email=None):
+        tally = real(email)
+        send(a, "b@x.com")  # inserted and $inc'ed after the tally read messages
+        return tally
+    monkeypatch.setattr(secapp, "_tally_counts", slow_tally)
+    secapp.recount_inbox()
+    assert secapp.users.find_one({"email": "b@x.com"})["counts"]["unread"] == 2
+    monkeypatch.setattr(secapp, "_tally_counts", real)
+    assert secapp.recount_inbox() == {}
+
+
+def test_send_admission_rejects_before_decoding(secapp, monkeypatch):
+    a = register(secapp, "a@x.com")
+    register(secapp, "b@x.com")
+    assert send(a, "b@x.com", image=io.BytesIO(b"not an image at all")).status_code == 400
+    monkeypatch.setattr(secapp, "REQUEST_MEMORY_BUDGET_MB", 1)  # 120x120 at 200 B/px is ~2.7 MB
+    resp = send(a, "b@x.com")
+    assert resp.status_code == 413 and b"limit is 1 MB" in resp.data
+    monkeypatch.setattr(secapp, "MAX_IMAGE_MEGAPIXELS", 0.01)  # 120x120 is 0.0144 MP
+    resp = send(a, "b@x.com")
+    assert resp.status_code == 413 and b"120x120 (max 0.01 megapixels)" in resp.data
+    monkeypatch.setattr(secapp, "MAX_IMAGE_MEGAPIXELS", 40)
+    monkeypatch.setattr(secapp.Image, "MAX_IMAGE_PIXELS", 1000)  # Pillow's bomb check trips past twice this
+    resp = send(a, "b@x.com")
+    assert resp.status_code == 413 and b"image too large (max 40 megapixels)" in resp.data
+    assert secapp.messages.count_documents({}) == 0
+
+
+def test_send_rejects_cover_too_small_for_the_message(secapp):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    resp = send(a, "b@x.com", image=cover_png(side=4))
+    assert resp.status_code == 400 and b"Image Too Small" in resp.data
+
+
+def test_large_upload_spools_to_disk_and_still_sends(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "UPLOAD_SPOOL_KB", 1)
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    noise = io.BytesIO()
+    Image.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3)).save(noise, "PNG")  # ~12 KB
+    noise.seek(0)
+    send(a, "b@x.com", image=noise)
+    assert secapp.UPLOAD_BYTES.values.get(("True",))  # read back through the mmap
+    assert secapp.messages.count_documents({}) == 1
+
+
+def test_cover_cache_hits_on_the_same_upload_bytes(secapp):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    cache = secapp.cover_cache
+    send(a, "b@x.com")
+    send(a, "b@x.com")
+    send(a, "b@x.com", image=cover_png(side=100))
+    assert (cache.hits.values.get(()), cache.misses.values.get(())) == (1, 2)
+    key = next(iter(cache.items))
+    assert cache.get(key).tobytes() == Image.open(cover_png()).convert("RGBA").tobytes()  # untouched by embedding
+
+
+def test_cover_cache_evicts_least_recently_used_past_the_byte_cap(secapp):
+    cache = secapp.CoverCache(2 * 10 * 10 * 4)  # two 10x10 RGBA covers
+    covers = {k: Image.new("RGBA", (10, 10), (i, 0, 0, 255)) for i, k in enumerate("abc")}
+    cache.put("a", covers["a"])
+    cache.put("b", covers["b"])
+    assert cache.get("a") is not None  # a is now the most recently used
+    cache.put("c", covers["c"])
+    assert list(cache.items) == ["a", "c"] and cache.size == 800
+    assert cache.evictions.values.get(()) == 1
+    cache.put("big", Image.new("RGBA", (20, 20)))  # larger than the whole cache
+    assert "big" not in cache.items
+
+
+def test_cover_cache_returns_a_copy(secapp):
+    cache = secapp.CoverCache(10_000)
+    cache.put("k", Image.new("RGBA", (10, 10), (1, 2, 3, 255)))
+    got = cache.get("k")
+    got.putpixel((0, 0), (9, 9, 9, 9))
+    assert cache.get("k").getpixel((0, 0)) == (1, 2, 3, 255)
+
+
+def reveal(client, doc, code="kiwi"):
+    client.post(f"/view/{doc['token']}", data={"secret_code": code})
+    return client.get(f"/api/reveal/{doc['token']}")
+
+
+def rotate_keys(secapp, monkeypatch):
+    """Put a new primary key in front of the one messages were sent under."""
+    new = Fernet.generate_key().decode()
+    monkeypatch.setattr(secapp, "fernet", MultiFernet([Fernet(k) for k in [new, *secapp.FERNET_KEYS]]))
+    monkeypatch.setattr(secapp, "PRIMARY_KEY_ID", secapp.key_id(new))
+    return new
+
+
+def test_reembed_moves_messages_to_the_new_key(secapp, monkeypatch):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    for n in range(3):
+        send(a, "b@x.com", secret=f"secret {n}")
+    new = rotate_keys(secapp, monkeypatch)
+    assert secapp._acquire_job_lease("reembed", 60)
+    assert secapp.reembed_old_keys(pause=0, lease="reembed") == 3
+    assert secapp.messages.distinct("key_id") == [secapp.PRIMARY_KEY_ID]
+    assert not [f for f in os.listdir(secapp.UPLOAD_DIR) if f.endswith(".reembed")]
+    monkeypatch.setattr(secapp, "fernet", MultiFernet([Fernet(new)]))  # old key retired
+    docs = secapp.messages.find({}, {"token": 1, "created_at": 1}).sort("created_at", 1)
+    assert [reveal(b, d).get_json()["message"] for d in docs] == ["secret 0", "secret 1", "secret 2"]
+
+
+def test_reembed_leaves_a_message_revealed_midway_alone(secapp, monkeypatch):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com", secret="read me now")
+    doc = secapp.messages.find_one({})
+    old_key_id = doc["key_id"]
+    rotate_keys(secapp, monkeypatch)
+    rotate = secapp.rotate_payload
+    revealed = []
+    def reveal_then_rotate(payload):
+        revealed.append(reveal(b, doc).get_json()["message"])  # lands while the new PNG is being built
+        return rotate(payload)
+    monkeypatch.setattr(secapp, "rotate_payload", reveal_then_rotate)
+    assert secapp.reembed_old_keys(pause=0) == 0
+    after = secapp.messages.find_one({})
+    assert revealed == ["read me now"]
+    assert after["viewed"] and after["key_id"] == old_key_id and "reembed_failed" not in after
+    assert not os.path.exists(doc["image_path"])  # the rewritten file is not resurrected
+
+
+def test_reembed_stops_when_its_lease_is_taken_over(secapp, monkeypatch):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    for n in range(3):
+        send(a, "b@x.com", secret=f"secret {n}")
+    rotate_keys(secapp, monkeypatch)
+    assert secapp._acquire_job_lease("reembed", 60)
+    assert not secapp._acquire_job_lease("reembed", 60)  # held
+    reembed = secapp._reembed_message
+    def expire_after_first(doc):
+        moved = reembed(doc)
+        secapp.db.jobs.update_one({"_id": "reembed"}, {"$set": {"owner": "other-host:1"}})
+        return moved
+    monkeypatch.setattr(secapp, "_reembed_message", expire_after_first)
+    assert secapp.reembed_old_keys(pause=0, lease="reembed") == 1
+
+
+def test_error_page_negotiates_json_or_html(secapp):
+    client = secapp.app.test_client()
+    resp = client.post("/send")
+    assert resp.status_code == 401 and resp.mimetype == "text/html" and b"Login Required" in resp.data
+    for headers in ({"Accept": "application/json"}, {"X-Requested-With": "XMLHttpRequest"}):
+        resp = client.post("/send", headers=headers)
+        assert resp.status_code == 401
+        assert resp.get_json() == {"error": "login_required", "message": "Please log in first."}
+    resp = client.post("/send", headers={"Accept": "text/html,application/json;q=0.9"})  # browsers
+    assert resp.mimetype == "text/html"
+
+
+def test_error_page_escapes_user_input_and_keeps_status(secapp):
+    a = register(secapp, "a@x.com")
+    evil = "<script>alert(1)</script>@x.com"
+    resp = a.post("/pairing/request", data={"partner_email": evil, "secret_code": "kiwi"})
+    assert resp.status_code == 404
+    assert b"<script>alert(1)" not in resp.data and b"&lt;script&gt;alert(1)" in resp.data
+    resp = a.post("/pairing/request", data={"partner_email": evil, "secret_code": "kiwi"},
+                  headers={"Accept": "application/json"})
+    assert resp.status_code == 404 and resp.get_json()["error"] == "user_not_found"
+    assert "<strong>" not in resp.get_json()["message"]  # markup stripped for JSON
+    resp = a.post("/pairing/request", data={"partner_email": "a@x.com", "secret_code": "kiwi"},
+                  headers={"Accept": "application/json"})
+    assert resp.status_code == 400 and resp.get_json()["error"] == "cannot_pair_with_self"
+
+
+def test_api_inbox_etag_answers_304_until_the_inbox_changes(secapp):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    first = b.get("/api/v1/inbox")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and etag.startswith('W/"') and len(first.get_json()["messages"]) == 1
+    again = b.get("/api/v1/inbox", headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.data == b""
+    send(a, "b@x.com")
+    changed = b.get("/api/v1/inbox", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+
+def test_api_gzips_large_bodies_for_clients_that_accept_it(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "API_GZIP_MIN_BYTES", 10)
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    plain = b.get("/api/v1/inbox")
+    assert "Content-Encoding" not in plain.headers
+    packed = b.get("/api/v1/inbox", headers={"Accept-Encoding": "gzip, br"})
+    assert packed.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in packed.headers["Vary"]
+    assert json.loads(gzip.decompress(packed.data)) == plain.get_json()
+    monkeypatch.setattr(secapp, "API_GZIP_MIN_BYTES", 1 << 20)
+    assert "Content-Encoding" not in b.get("/api/v1/inbox", headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_api_errors_are_json_with_a_stable_code(secapp, monkeypatch):
+    anon = secapp.app.test_client()
+    resp = anon.get("/api/v1/inbox")
+    assert resp.status_code == 401 and resp.get_json() == {"error": "login_required", "message": "login required"}
+    a = register(secapp, "a@x.com")
+    resp = a.get("/api/v1/messages/nope")
+    assert resp.status_code == 404 and resp.get_json()["error"] == "not_found"
+    resp = a.post("/api/v1/pairings", data={"secret_code": "kiwi"})  # no text/html Accept needed
+    assert resp.status_code == 400 and resp.get_json()["error"] == "partner_email_required"
+    monkeypatch.setattr(secapp, "db", None)
+    resp = a.get("/api/v1/pairings")
+    assert resp.status_code == 503 and resp.get_json()["error"] == "database_unavailable"
+
+
+def test_query_class_handles_raise_connection_failure_without_a_database(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "users", None)
+    detached = secapp.QueryClass("auth", read_preference="primaryPreferred", write_concern=1)
+    with pytest.raises(ConnectionFailure):
+        detached.users.find_one({})
+    monkeypatch.setattr(secapp, "users", secapp.db.users)  # the route's own check passes ...
+    monkeypatch.setattr(secapp, "Q_AUTH", detached)  # ... but its query class has no handle
+    resp = secapp.app.test_client().post("/login", data={"email": "a@x.com", "password": "pw"})
+    assert resp.status_code == 503
+
+
+def test_clear_larger_than_one_batch_removes_every_message_and_file(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "CLEAR_BATCH", 2)
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    for n in range(5):
+        send(a, "b@x.com", secret=f"secret {n}")
+    files = [p for d in secapp.messages.find({}) for p in (d["image_path"], d.get("display_path")) if p]
+    assert len(files) == 10 and all(os.path.exists(p) for p in files)
+    started = b.post("/clear-all", headers={"Accept": "application/json"}).get_json()
+    assert started["status"] == "clearing" and started["deleted"] == 2
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = b.get(f"/api/v1/clear/{started['job']}").get_json()
+        if job["done"] and not any(os.path.exists(p) for p in files):
+            break
+        time.sleep(0.05)
+    assert job == {"deleted": 5, "done": True}
+    assert secapp.messages.count_documents({"recipient": "b@x.com"}) == 0
+    assert not any(os.path.exists(p) for p in files)
+    assert b.get("/api/inbox/count").get_json()["unread"] == 0
+
+
+def secapp_with(request, monkeypatch, **env):
+    """The secapp fixture imported with extra settings that app.py only reads at import."""
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    return request.getfixturevalue("secapp")
+
+
+def test_profiler_needs_a_valid_token(request, monkeypatch, caplog):
+    profiled = secapp_with(request, monkeypatch, PROFILE_SECRET="profile-test-secret")
+    client = profiled.app.test_client()
+    expired = profiled.profile_token(-10)
+    forged = profiled.profile_token().rsplit(".", 1)[0] + ".00"
+    for headers in ({}, {"X-Profile": expired}, {"X-Profile": forged}):
+        resp = client.get("/login", headers=headers)
+        assert resp.status_code == 200 and "X-Profile-File" not in resp.headers
+    assert not os.path.exists(profiled.PROFILE_DIR)
+
+    with caplog.at_level("INFO", logger="secapp.profile"):
+        resp = client.get("/login", headers={"X-Profile": profiled.profile_token()})
+    name = resp.headers["X-Profile-File"]
+    assert name.endswith(".prof") and os.listdir(profiled.PROFILE_DIR) == [name]
+    logged = caplog.records[-1].getMessage()
+    assert '"reason": "header"' in logged and "ms cum" in logged
+
+
+def test_memory_guard_refuses_send_while_the_worker_is_full(secapp, monkeypatch):
+    monkeypatch.setattr(secapp, "WORKER_MEMORY_LIMIT_MB", 100)
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    monkeypatch.setattr(secapp, "rss_bytes", lambda: 99 * secapp.MB)  # 120x120 at 200 B/px needs ~2.7 MB more
+    resp = send(a, "b@x.com")
+    assert resp.status_code == 503 and b"server is busy" in resp.data
+    assert secapp.MEMORY_REJECTED.values == {("send", "worker"): 1}
+    monkeypatch.setattr(secapp, "rss_bytes", lambda: 90 * secapp.MB)
+    assert send(a, "b@x.com").status_code in (200, 302)
+    assert secapp.messages.count_documents({}) == 1
+
+
+def test_send_reports_its_rss_peak(secapp, monkeypatch):
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    readings = []
+    def rss():
+        readings.append(None)  # the first reading is the request's baseline
+        return 50 * secapp.MB if len(readings) == 1 else 55 * secapp.MB
+    monkeypatch.setattr(secapp, "rss_bytes", rss)
+    send(a, "b@x.com")
+    bucket_counts = secapp.REQUEST_MEMORY.values[("/send", "rss")]
+    assert bucket_counts[-2:] == [5 * secapp.MB, 1]  # sum, count
+    assert 'secapp_request_memory_peak_bytes_count{route="/send",source="rss"} 1' in \
+        secapp.app.test_client().get("/metrics").get_data(as_text=True)
+
+
+def test_send_reports_its_tracemalloc_peak(request, monkeypatch):
+    import tracemalloc
+    tracked = secapp_with(request, monkeypatch, MEMORY_TRACKING="tracemalloc")
+    request.addfinalizer(tracemalloc.stop)
+    monkeypatch.setattr(tracked, "STEGO_POOL_WORKERS", 0)  # embed in this process, where it is traced
+    a, b = register(tracked, "a@x.com"), register(tracked, "b@x.com")
+    pair(tracked, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    py_sum, py_count = tracked.REQUEST_MEMORY.values[("/send", "tracemalloc")][-2:]
+    assert py_count == 1 and py_sum > 120 * 120 * 3  # at least the decoded cover
+
+
+@pytest.mark.parametrize("store", ["mongo", "sqlite"])
+def test_reveal_grant_is_single_use(request, monkeypatch, store):
+    secapp = secapp_with(request, monkeypatch, REVEAL_GRANT_STORE=store)
+    assert type(secapp.reveal_grants).__name__ == {"mongo": "MongoGrantStore", "sqlite": "SqliteGrantStore"}[store]
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com", secret="only once")
+    doc = secapp.messages.find_one({})
+    assert reveal(b, doc).get_json()["message"] == "only once"
+    assert b.get(f"/api/reveal/{doc['token']}").status_code == 410
+    # the grant is gone too, not just the message flag
+    secapp.messages.update_one({"_id": doc["_id"]}, {"$set": {"viewed": False}})
+    resp = b.get(f"/api/reveal/{doc['token']}")
+    assert resp.status_code == 403 and "view page first" in resp.get_json()["error"]
+    if store == "sqlite":
+        with sqlite3.connect(secapp.REVEAL_GRANT_SQLITE) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM grants").fetchone() == (0,)
+
+
+@pytest.mark.parametrize("store", ["mongo", "sqlite"])
+def test_reveal_grant_expires(request, monkeypatch, store):
+    secapp = secapp_with(request, monkeypatch, REVEAL_GRANT_STORE=store)
+    monkeypatch.setattr(secapp, "REVEAL_GRANT_SECONDS", 1)
+    a, b = register(secapp, "a@x.com"), register(secapp, "b@x.com")
+    pair(secapp, a, "a@x.com", b, "b@x.com")
+    send(a, "b@x.com")
+    doc = secapp.messages.find_one({})
+    b.post(f"/view/{doc['token']}", data={"secret_code": "kiwi"})
+    with secapp.app.test_request_context():
+        assert secapp.reveal_grant(doc["message_id"]) is None  # a different session has no grant
+    time.sleep(1.1)
+    resp = b.get(f"/api/reveal/{doc['token']}")
+    assert resp.status_code == 403 and "view page first" in resp.get_json()["error"]
+    assert secapp.messages.find_one({})["viewed"] is False
+    assert reveal(b, doc).status_code == 200  # entering the code again issues a fresh grant
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Round-trip property tests for the LSB stego codec in stego.py.
+
+The reference functions below are a frozen, deliberately simple copy of the
+on-disk format (4-byte big-endian length + payload, one bit per R/G/B LSB,
+MSB first, pixel order). Any optimized embed/extract must stay compatible
+with images produced by it, and must keep writing it whenever the payload fits.
+Payloads that don't fit use the headered 1/2-bit RGB/RGBA modes.
+
+Run with: python -m pytest -q test_stego.py
+"""
+import os
+import random
+
+from PIL import Image  # type: ignore
+
+from stego import (
+    embed_bytes_in_image, extract_bytes_from_image, _bytes_to_bits,
+    mode_capacity, payload_capacity, LEGACY_MODE,
+)
+
+MODES = ["P", "L", "RGB", "RGBA", "I;16"]
+MAX_PAYLOAD = 20000
+
+
+def reference_embed(img, payload):
+    """Reference encoder for the original 1-bit RGB format."""
+    data = len(payload).to_bytes(4, "big") + payload
+    bits = [(byte >> (7 - i)) & 1 for byte in data for i in range(8)]
+    rgba = img.convert("RGBA")
+    raw = bytearray(rgba.tobytes())
+    for n, bit in enumerate(bits):
+        # bit n goes into channel n % 3 (R, G, B) of pixel n // 3
+        idx = (n // 3) * 4 + n % 3
+        raw[idx] = (raw[idx] & ~1) | bit
+    return Image.frombytes("RGBA", rgba.size, bytes(raw))
+
+
+def reference_extract(img):
+    """Reference decoder for the original 1-bit RGB format."""
+    raw = img.convert("RGBA").tobytes()
+    bits = [raw[i] & 1 for i in range(len(raw)) if i % 4 != 3]
+    length = int("".join(map(str, bits[:32])), 2)
+    body = bits[32:32 + length * 8]
+    return bytes(int("".join(map(str, body[i:i + 8])), 2) for i in range(0, len(body), 8))
+
+
+def make_cover(mode, size, rng):
+    raw = bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3))
+    noise = Image.frombytes("RGB", size, raw)
+    if mode == "P":
+        return noise.convert("P", palette=Image.Palette.ADAPTIVE)
+    if mode == "I;16":
+        return noise.convert("L").convert("I;16")
+    return noise.convert(mode)
+
+
+def random_payload(rng, max_len):
+    return bytes(rng.getrandbits(8) for _ in range(rng.randint(1, max_len)))
+
+
+def test_bytes_to_bits_matches_reference():
+    rng = random.Random(1)
+    for _ in range(50):
+        data = random_payload(rng, 64)
+        expected = [(byte >> (7 - i)) & 1 for byte in data for i in range(8)]
+        assert list(_bytes_to_bits(data)) == expected
+
+
+def test_round_trip_all_modes():
+    rng = random.Random(2)
+    for mode in MODES:
+        for _ in range(5):
+            cover = make_cover(mode, (rng.randint(40, 90), rng.randint(40, 90)), rng)
+            payload = random_payload(rng, 400)
+            stego = embed_bytes_in_image(cover, payload)
+            assert stego.size == cover.size
+            assert extract_bytes_from_image(stego) == payload
+
+
+def test_reference_images_still_decode():
+    """Images written in the original format must keep decoding."""
+    rng = random.Random(3)
+    for mode in MODES:
+        cover = make_cover(mode, (64, 64), rng)
+        payload = random_payload(rng, 500)
+        assert extract_bytes_from_image(reference_embed(cover, payload)) == payload
+
+
+def test_reference_decoder_reads_default_output():
+    rng = random.Random(4)
+    cover = make_cover("RGB", (80, 80), rng)
+    payload = random_payload(rng, 500)
+    assert reference_extract(embed_bytes_in_image(cover, payload)) == payload
+
+
+def test_round_trip_survives_png_save(tmp_path):
+    rng = random.Random(5)
+    cover = make_cover("RGBA", (120, 120), rng)
+    payload = os.urandom(2000)
+    path = tmp_path / "stego.png"
+    embed_bytes_in_image(cover, payload).save(path, "PNG", compress_level=0)
+    with Image.open(path) as img:
+        img.load()
+        assert extract_bytes_from_image(img) == payload
+
+
+def test_max_payload_round_trip():
+    rng = random.Random(6)
+    payload = os.urandom(MAX_PAYLOAD)
+    side = int(((4 + MAX_PAYLOAD) * 8 / 3) ** 0.5) + 1
+    cover = make_cover("RGB", (side, side), rng)
+    assert extract_bytes_from_image(embed_bytes_in_image(cover, payload)) == payload
+
+
+def test_rejects_oversized_payload_and_small_cover():
+    rng = random.Random(7)
+    cover = make_cover("RGB", (10, 10), rng)
+    for payload in (os.urandom(MAX_PAYLOAD + 1), os.urandom(200)):
+        try:
+            embed_bytes_in_image(cover, payload)
+        except ValueError:
+            continue
+        raise AssertionError(f"payload of {len(payload)} bytes should be rejected")
+
+
+def test_extract_rejects_blank_image():
+    try:
+        extract_bytes_from_image(Image.new("RGB", (50, 50)))
+    except ValueError:
+        return
+    raise AssertionError("blank image should not decode")
+
+
+def test_default_mode_is_original_format_when_it_fits():
+    rng = random.Random(8)
+    cover = make_cover("RGBA", (60, 60), rng)
+    payload = random_payload(rng, 300)
+    assert reference_extract(embed_bytes_in_image(cover, payload)) == payload
+
+
+def test_dense_modes_round_trip_on_small_covers():
+    rng = random.Random(9)
+    for mode, use_alpha in (("RGB", False), ("RGBA", True), ("P", False), ("L", False)):
+        cover = make_cover(mode, (40, 40), rng)
+        legacy = mode_capacity(cover.size, LEGACY_MODE)
+        payload = os.urandom(payload_capacity(cover.size, use_alpha))
+        assert len(payload) > legacy
+        stego = embed_bytes_in_image(cover, payload)
+        assert extract_bytes_from_image(stego) == payload
+
+
+def test_alpha_only_used_when_present():
+    rng = random.Random(10)
+    rgb = make_cover("RGB", (40, 40), rng)
+    stego = embed_bytes_in_image(rgb, os.urandom(mode_capacity(rgb.size, (2, False))))
+    assert stego.getchannel("A").getextrema() == (255, 255)
+    payload = os.urandom(mode_capacity(rgb.size, (2, False)) + 1)
+    try:
+        embed_bytes_in_image(rgb, payload)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("RGB cover must not borrow the alpha channel")
+    assert extract_bytes_from_image(embed_bytes_in_image(rgb, payload, use_alpha=True)) == payload
+
+
+def test_modes_change_only_the_low_bits():
+    rng = random.Random(11)
+    cover = make_cover("RGBA", (30, 30), rng)
+    payload = os.urandom(payload_capacity(cover.size, True))
+    stego = embed_bytes_in_image(cover, payload)
+    for before, after in zip(cover.tobytes(), stego.tobytes()):
+        assert before >> 2 == after >> 2
+
+
+# The payload envelope needs app.py's Fernet keys, so these import the app
+# through the mongomock-backed `secapp` fixture (conftest.py).
+def test_payload_envelope_round_trip(secapp):
+    for plaintext in (b"hi", "secret ü".encode(), b"long secret " * 200, os.urandom(3000)):
+        sealed = secapp.seal_payload(plaintext)
+        assert sealed[0] == secapp.ENVELOPE_VERSION
+        assert secapp.open_payload(sealed) == plaintext
+
+
+def test_payload_envelope_is_smaller_than_fernet_token(secapp):
+    plaintext = b"meet me at the usual place at nine " * 20
+    fernet = secapp.fernet
+    assert len(secapp.seal_payload(plaintext)) < len(fernet.encrypt(plaintext)) // 4
+    assert len(secapp.seal_payload(os.urandom(1000))) < len(fernet.encrypt(os.urandom(1000)))
+
+
+def test_legacy_fernet_payloads_still_open(secapp):
+    assert secapp.open_payload(secapp.fernet.encrypt(b"old message")) == b"old message"